@@ -0,0 +1,93 @@
+# atomic_file.py
+# Crash-safe file replacement and cross-process write locks for the JSON storage layouts
+
+import os
+import json
+import uuid
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl  # POSIX only; used to serialise writers across processes
+except ImportError:
+    fcntl = None
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def _lock_for(path):
+    with _locks_guard:
+        return _locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+# Make a rename inside `directory` durable (no-op where directories can't be opened, e.g. Windows)
+def fsync_directory(directory):
+    try:
+        fd = os.open(directory or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# Open a fresh temp file next to `path`. It's created 0666 so the kernel applies the umask,
+# exactly as a plain open() would (mkstemp's files are always 0600); reading the umask
+# ourselves would need os.umask(0), which briefly changes it for every thread.
+def _create_temp(path):
+    while True:
+        temp_path = f"{path}.{uuid.uuid4().hex[:12]}.tmp"
+        try:
+            return os.open(temp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0), 0o666), temp_path
+        except FileExistsError:
+            continue
+
+
+# Replace `path` with `data`: write a temp file in the same directory, fsync it, rename it
+# over the target and fsync the directory. Readers see the old or the new contents, never
+# a truncated file. The file keeps its permissions (new files get the usual default).
+def write_atomic(path, data):
+    directory = os.path.dirname(path)
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = None
+    fd, temp_path = _create_temp(path)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if mode is not None and hasattr(os, 'fchmod'):
+                os.fchmod(f.fileno(), mode)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    fsync_directory(directory)
+
+
+def write_json_atomic(path, obj, indent=4):
+    write_atomic(path, json.dumps(obj, indent=indent).encode('utf-8'))
+
+
+# Exclusive lock for read-modify-write of `path`, held against other threads of this process
+# and (on POSIX) other processes. The lock lives in a `<path>.lock` sidecar, so it survives
+# the target being replaced by write_atomic.
+@contextmanager
+def locked(path):
+    with _lock_for(path), open(path + '.lock', 'ab') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,172 @@
+# batch_faces.py
+# Headless batch enrollment / identification over a directory of face images.
+#
+#   python batch_faces.py enroll  photos/ --out enrolled.csv [--names names.csv]
+#   python batch_faces.py identify photos/ --out matches.jsonl
+#
+# Images are decoded and encoded across a process pool; identification matches the whole batch
+# against the gallery with blocked matrix products. Enrollment names come from --names
+# (a CSV with filename,name columns) or else from the file name ("jane_doe.jpg" -> "Jane Doe").
+# A face that is not in the gallery but whose name is already registered is reported as
+# name_taken rather than enrolled under a duplicate name.
+
+import os
+import csv
+import sys
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from embedding_index import EmbeddingIndex, MATCH_THRESHOLD
+from face_pipeline import embedding_from_bytes
+from storage_backends import open_storage
+from user_repository import UserRepository
+
+STORAGE_DIR = "user_storage_5"
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+RESULT_FIELDS = ['path', 'status', 'user_id', 'name', 'distance', 'error']
+
+
+def list_images(directory):
+    return sorted(
+        os.path.join(root, filename)
+        for root, _, filenames in os.walk(directory)
+        for filename in filenames
+        if filename.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# Worker: read and encode one image (runs in a child process). Only the embedding travels
+# back to the parent; image bytes are re-read at enrollment time to keep memory flat.
+def encode_file(path):
+    try:
+        embedding = embedding_from_bytes(read_file(path))
+        if embedding is None:
+            return path, None, "no face detected"
+        return path, embedding, None
+    except Exception as e:
+        return path, None, str(e)
+
+
+# Encode every image across a process pool, yielding (path, embedding, error) in input order
+def encode_files(paths, workers=None):
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(encode_file, paths, chunksize=4)
+
+
+def name_from_filename(path):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return " ".join(part.capitalize() for part in stem.replace('-', '_').split('_') if part)
+
+
+def load_names(names_path):
+    with open(names_path, newline='') as f:
+        return {row['filename']: row['name'] for row in csv.DictReader(f)}
+
+
+def result(path, status, user_id=None, name=None, distance=None, error=None):
+    return {
+        'path': path,
+        'status': status,
+        'user_id': user_id,
+        'name': name,
+        'distance': None if distance is None else round(distance, 4),
+        'error': error,
+    }
+
+
+def identify(repository, paths, workers=None):
+    encoded = list(encode_files(paths, workers))
+    results = {path: result(path, 'error', error=error) for path, embedding, error in encoded if error}
+    ok = [(path, embedding) for path, embedding, error in encoded if not error]
+    if ok:
+        users = repository.all()
+        matches = repository.index.search_batch(np.stack([embedding for _, embedding in ok]), threshold=MATCH_THRESHOLD)
+        for (path, _), (user_id, distance) in zip(ok, matches):
+            if user_id:
+                results[path] = result(path, 'matched', user_id, users[user_id]['name'], distance)
+            else:
+                results[path] = result(path, 'unknown', distance=distance)
+    return [results[path] for path in paths]
+
+
+def enroll(repository, paths, names=None, workers=None):
+    names = names or {}
+    encoded = list(encode_files(paths, workers))
+    results = {path: result(path, 'error', error=error) for path, embedding, error in encoded if error}
+    ok = [(path, embedding) for path, embedding, error in encoded if not error]
+    if ok:
+        users = repository.all()
+        # One batched pass against the existing gallery, then a small index of this batch's
+        # new enrollments to catch several photos of the same new person
+        existing = repository.index.search_batch(np.stack([embedding for _, embedding in ok]))
+        enrolled = EmbeddingIndex()
+        for (path, embedding), (user_id, distance) in zip(ok, existing):
+            if user_id is None:
+                user_id, distance = enrolled.search(embedding)
+            if user_id:
+                results[path] = result(path, 'already_enrolled', user_id, users[user_id]['name'], distance)
+                continue
+            name = names.get(os.path.basename(path)) or name_from_filename(path)
+            # Same rule as interactive registration: a name that belongs to someone else (already
+            # registered, or enrolled earlier in this batch) is reported, not enrolled again
+            if repository.name_taken(name):
+                results[path] = result(path, 'name_taken', name=name)
+                continue
+            new_id = repository.next_user_id()
+            repository.insert(new_id, name, embedding, read_file(path))
+            enrolled.add(new_id, embedding)
+            results[path] = result(path, 'enrolled', new_id, name)
+    return [results[path] for path in paths]
+
+
+def write_results(rows, out_path):
+    if out_path.endswith('.jsonl'):
+        with open(out_path, 'w') as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+    else:
+        with open(out_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch face enrollment and identification")
+    parser.add_argument('command', choices=['enroll', 'identify'])
+    parser.add_argument('directory', help="directory of .jpg/.jpeg/.png images (searched recursively)")
+    parser.add_argument('--out', required=True, help="results file (.csv or .jsonl)")
+    parser.add_argument('--storage', default=STORAGE_DIR, help=f"user storage directory (default: {STORAGE_DIR})")
+    parser.add_argument('--names', help="CSV with filename,name columns (enroll only)")
+    parser.add_argument('--workers', type=int, default=None, help="encoding processes (default: CPU count)")
+    args = parser.parse_args(argv)
+
+    paths = list_images(args.directory)
+    if not paths:
+        sys.exit(f"No images found in {args.directory}")
+
+    repository = UserRepository(
+        open_storage(args.storage),
+        on_error=lambda filename, e: print(f"Error decoding {filename}. Skipping.", file=sys.stderr)
+    )
+    if args.command == 'enroll':
+        names = load_names(args.names) if args.names else None
+        rows = enroll(repository, paths, names, args.workers)
+    else:
+        rows = identify(repository, paths, args.workers)
+
+    write_results(rows, args.out)
+    counts = {}
+    for row in rows:
+        counts[row['status']] = counts.get(row['status'], 0) + 1
+    print(f"{len(rows)} image(s): " + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+# benchmark.py
+# Reproducible benchmarks for the recognition and storage hot paths.
+#
+#   python benchmark.py                                   1k/10k/100k users, JSON, SQLite and Mongo backends
+#   python benchmark.py --sizes 1000 10000 --out bench.json
+#   python benchmark.py --compare bench_old.json          flag operations slower than last time
+#
+# Galleries are synthetic: random 128-d embeddings, small random profile images and a few
+# conversations per user, generated from --seed so every run sees the same data. Each
+# (backend, size) case runs in its own process, so peak RSS is not inflated by earlier cases.
+# The Mongo backend runs against mongomock as a local stand-in (skipped if it isn't installed).
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import multiprocessing
+from queue import Empty
+from functools import partial
+from datetime import datetime, timedelta, timezone
+import numpy as np
+
+try:
+    import resource  # POSIX only; used for peak RSS
+except ImportError:
+    resource = None
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from embedding_index import EMBEDDING_DIM, MATCH_THRESHOLD
+from user_storage import JsonUserStorage
+from sqlite_storage import SqliteUserStorage
+from user_repository import UserRepository
+
+SIZES = [1000, 10000, 100000]
+BACKENDS = ['json', 'sqlite', 'mongo', 'pipeline']
+# Spread of synthetic embedding components; random pairs end up ~1.4 apart, far above the threshold
+EMBEDDING_SCALE = 0.09
+# Noise added to a stored embedding to fake another photo of the same person (~0.3 away)
+QUERY_NOISE = 0.02
+IMAGE_BYTES = 512
+USERS_WITH_HISTORY = 1000
+CONVERSATIONS_PER_USER = 5
+MESSAGES_PER_CONVERSATION = 10
+# p50 slowdown, relative to --compare, reported as a regression
+REGRESSION_RATIO = 1.2
+# Seconds one (backend, size) case may run before it is killed and reported as failed
+CASE_TIMEOUT = 3600
+
+MESSAGES = [
+    "Hi there", "I have a headache", "It started yesterday", "Can I see a doctor tomorrow?",
+    "I need a refill of my pills", "Thanks a lot", "Goodbye",
+]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def summarize(samples):
+    samples = np.asarray(samples, dtype=np.float64)
+    return {
+        'count': int(len(samples)),
+        'mean_ms': float(samples.mean() * 1000),
+        'p50_ms': float(np.percentile(samples, 50) * 1000),
+        'p90_ms': float(np.percentile(samples, 90) * 1000),
+        'p99_ms': float(np.percentile(samples, 99) * 1000),
+        'max_ms': float(samples.max() * 1000),
+        'throughput_per_s': float(len(samples) / samples.sum()) if samples.sum() > 0 else None,
+    }
+
+
+# Time `operation(item)` for each item; returns the summary row for the results file
+def measure(name, operation, items):
+    samples = []
+    for item in items:
+        start = time.perf_counter()
+        operation(item)
+        samples.append(time.perf_counter() - start)
+    row = {'operation': name, **summarize(samples), 'peak_rss_mb': peak_rss_mb()}
+    print(f"    {name:<28} p50 {row['p50_ms']:9.3f}ms  p99 {row['p99_ms']:9.3f}ms  "
+          f"{row['throughput_per_s'] or 0:10.1f}/s  rss {row['peak_rss_mb'] or 0:7.1f}MB", flush=True)
+    return row
+
+
+def synthetic_embeddings(rng, n):
+    return rng.normal(0.0, EMBEDDING_SCALE, size=(n, EMBEDDING_DIM)).astype(np.float32)
+
+
+# Half genuine (a stored face plus noise), half impostors (fresh random faces)
+def synthetic_queries(rng, embeddings, n):
+    genuine = embeddings[rng.integers(0, len(embeddings), n - n // 2)]
+    genuine = genuine + rng.normal(0.0, QUERY_NOISE, size=genuine.shape).astype(np.float32)
+    return np.concatenate([genuine, synthetic_embeddings(rng, n // 2)])
+
+
+def synthetic_conversation(rng):
+    messages = []
+    for i in range(MESSAGES_PER_CONVERSATION):
+        messages.append(["You" if i % 2 else "Bot", MESSAGES[int(rng.integers(len(MESSAGES)))]])
+    return {'timestamp': datetime(2024, 1, 1 + int(rng.integers(28))).isoformat(), 'messages': messages}
+
+
+def build_gallery(storage_class, directory, rng, n, image_bytes):
+    storage = storage_class(directory)
+    user_ids = [f"user_{i + 1}_000000" for i in range(n)]
+    embeddings = synthetic_embeddings(rng, n)
+    storage.embeddings.extend(user_ids, embeddings)
+    storage.write_users([
+        {
+            'user_id': user_id,
+            'name': f"Patient {i + 1}",
+            'created_at': datetime(2024, 1, 1).isoformat(),
+            'image_hash': storage.save_image(rng.bytes(image_bytes)),
+        }
+        for i, user_id in enumerate(user_ids)
+    ])
+    for user_id in user_ids[:USERS_WITH_HISTORY]:
+        storage.import_conversations(user_id, [synthetic_conversation(rng) for _ in range(CONVERSATIONS_PER_USER)])
+    return user_ids, embeddings
+
+
+# The same workload against a JSON directory or a SQLite database
+def bench_storage(storage_class, size, args, rng):
+    directory = tempfile.mkdtemp(prefix="bench_storage_")
+    try:
+        start = time.perf_counter()
+        user_ids, embeddings = build_gallery(storage_class, directory, rng, size, args.image_bytes)
+        print(f"    (generated in {time.perf_counter() - start:.1f}s)", flush=True)
+        rows = [measure('load_all_users (cold)', lambda _: UserRepository(storage_class(directory)), range(args.cold_repeats))]
+        repository = UserRepository(storage_class(directory))
+        rows.append(measure('load_all_users (warm)', lambda _: repository.all(), range(args.queries)))
+        rows.append(measure('recognize_user', lambda query: repository.search(query, threshold=MATCH_THRESHOLD),
+                            synthetic_queries(rng, embeddings, args.queries)))
+        new_users = [(f"user_{size + i + 1}_999999", embedding) for i, embedding in enumerate(synthetic_embeddings(rng, args.writes))]
+        rows.append(measure('save_user', lambda user: repository.insert(user[0], "New Patient", user[1], rng.bytes(args.image_bytes)),
+                            new_users))
+        history_users = user_ids[:min(USERS_WITH_HISTORY, size)]
+        rows.append(measure('add_conversation', lambda user_id: repository.add_conversation(user_id, synthetic_conversation(rng)['messages']),
+                            [history_users[int(i)] for i in rng.integers(0, len(history_users), args.writes)]))
+        rows.append(measure('load_recent_conversations', lambda user_id: repository.load_recent_conversations(user_id, 20),
+                            [history_users[int(i)] for i in rng.integers(0, len(history_users), args.queries)]))
+        rows.append(measure('load_conversation_page', lambda user_id: repository.storage.load_conversation_page(user_id, 1, 2),
+                            [history_users[int(i)] for i in rng.integers(0, len(history_users), args.queries)]))
+        rows.append(measure('name_taken', lambda i: repository.name_taken(f"PATIENT {i + 1}"),
+                            [int(i) for i in rng.integers(0, size, args.queries)]))
+        rows.append(measure('find_user_by_name', lambda i: repository.storage.find_user_by_name(f"patient {i + 1}"),
+                            [int(i) for i in rng.integers(0, size, args.queries)]))
+        return rows
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_mongo(size, args, rng):
+    import mongo_storage
+    collection = mongomock.MongoClient()[mongo_storage.DATABASE_NAME][mongo_storage.PATIENTS_COLLECTION]
+    embeddings = synthetic_embeddings(rng, size)
+    # Distinct, increasing updated_at values, as real registrations would have
+    start = datetime.now(timezone.utc) - timedelta(seconds=size)
+    collection.insert_many([
+        {'patient_id': f"P{i + 1:03d}", 'name': f"Patient {i + 1}", 'embeddings': [mongo_storage.encode_embedding(embedding)],
+         'created_at': start + timedelta(seconds=i), 'updated_at': start + timedelta(seconds=i)}
+        for i, embedding in enumerate(embeddings)
+    ])
+    rows = [measure('load_db (cold)', lambda _: mongo_storage.PatientCache(collection).refresh(), range(args.cold_repeats))]
+    cache = mongo_storage.PatientCache(collection)
+    cache.refresh()
+    rows.append(measure('load_db (warm)', lambda _: cache.refresh(), range(args.queries)))
+    rows.append(measure('recognize_user', lambda query: cache.search(query, threshold=MATCH_THRESHOLD),
+                        synthetic_queries(rng, embeddings, args.queries)))
+
+    def save(patient):
+        mongo_storage.save_patient(collection, patient[0], "New Patient", patient[1])
+        cache.refresh()
+    rows.append(measure('save_to_db', save,
+                        [(f"P{size + i + 1:03d}", embedding) for i, embedding in enumerate(synthetic_embeddings(rng, args.writes))]))
+    return rows
+
+
+# get_embedding: decode, detect and encode a synthetic photo-sized JPEG (or the images in --images)
+def bench_pipeline(size, args, rng):
+    import io
+    from PIL import Image
+    from face_pipeline import embedding_from_bytes
+    if args.images:
+        paths = sorted(os.path.join(args.images, name) for name in os.listdir(args.images))
+        images = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                images.append(f.read())
+    else:
+        images = []
+        for _ in range(4):
+            buffer = io.BytesIO()
+            Image.fromarray(rng.integers(0, 256, size=(960, 1280, 3), dtype=np.uint8)).save(buffer, 'JPEG')
+            images.append(buffer.getvalue())
+    items = [images[i % len(images)] for i in range(args.pipeline_repeats)]
+    return [measure('get_embedding', embedding_from_bytes, items)]
+
+
+BENCHMARKS = {
+    'json': partial(bench_storage, JsonUserStorage),
+    'sqlite': partial(bench_storage, SqliteUserStorage),
+    'mongo': bench_mongo,
+    'pipeline': bench_pipeline,
+}
+
+
+def run_case(backend, size, args, queue):
+    rng = np.random.default_rng([args.seed, size])
+    try:
+        queue.put(('ok', BENCHMARKS[backend](size, args, rng)))
+    except Exception as e:
+        queue.put(('error', f"{type(e).__name__}: {e}"))
+
+
+# Run one case in a child process. Returns (rows, failure): failure describes a child that
+# crashed (e.g. OOM-killed) or ran past --case-timeout without reporting back, else None.
+def run_isolated(backend, size, args):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_case, args=(backend, size, args, queue))
+    process.start()
+    deadline = time.monotonic() + args.case_timeout
+    result, failure = None, None
+    while result is None and failure is None:
+        try:
+            result = queue.get(timeout=1)
+        except Empty:
+            if time.monotonic() > deadline:
+                process.terminate()
+                failure = f"timed out after {args.case_timeout:g}s"
+            elif not process.is_alive():
+                # The result may still be in flight from a child that exited normally
+                try:
+                    result = queue.get(timeout=1)
+                except Empty:
+                    process.join()
+                    failure = f"worker died with exit code {process.exitcode}"
+    process.join()
+    if failure is None and process.exitcode != 0:
+        print(f"    warning: worker exited with code {process.exitcode} after reporting")
+    if failure is not None:
+        print(f"    FAILED: {failure}")
+        return [], failure
+    status, payload = result
+    if status != 'ok':
+        print(f"    skipped: {payload}")
+        return [], None
+    return [{'backend': backend, 'size': size, **row} for row in payload], None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(row['backend'], row['size'], row['operation']): row for row in json.load(f)['results']}
+    regressions = 0
+    print(f"\nCompared with {baseline_path} (p50):")
+    for row in results:
+        old = baseline.get((row['backend'], row['size'], row['operation']))
+        if old is None or not old['p50_ms']:
+            continue
+        ratio = row['p50_ms'] / old['p50_ms']
+        flag = "  REGRESSION" if ratio > REGRESSION_RATIO else ""
+        regressions += bool(flag)
+        print(f"  {row['backend']:<8} {row['size']:>7} {row['operation']:<28} "
+              f"{old['p50_ms']:9.3f}ms -> {row['p50_ms']:9.3f}ms  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the recognition and storage hot paths")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help="gallery sizes (users)")
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=BACKENDS)
+    parser.add_argument('--queries', type=int, default=200, help="recognitions / reads per case")
+    parser.add_argument('--writes', type=int, default=50, help="registrations / conversation saves per case")
+    parser.add_argument('--cold-repeats', type=int, default=3, help="full loads per case")
+    parser.add_argument('--pipeline-repeats', type=int, default=8, help="images encoded by the pipeline benchmark")
+    parser.add_argument('--image-bytes', type=int, default=IMAGE_BYTES, help="size of each synthetic profile image")
+    parser.add_argument('--images', help="directory of real face photos for the pipeline benchmark")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default="benchmark_results.json")
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    parser.add_argument('--case-timeout', type=float, default=CASE_TIMEOUT, help="seconds allowed per case")
+    args = parser.parse_args(argv)
+
+    results = []
+    failures = []
+    for backend in args.backends:
+        if backend == 'mongo' and mongomock is None:
+            print("mongo: skipped (pip install mongomock for the local stand-in)")
+            continue
+        # The pipeline doesn't depend on the gallery size
+        for size in (args.sizes[:1] if backend == 'pipeline' else args.sizes):
+            print(f"{backend} @ {size} users", flush=True)
+            rows, failure = run_isolated(backend, size, args)
+            results.extend(rows)
+            if failure:
+                failures.append({'backend': backend, 'size': size, 'error': failure})
+
+    with open(args.out, 'w') as f:
+        json.dump({
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'args': vars(args),
+            'results': results,
+            'failures': failures,
+        }, f, indent=2)
+    print(f"\nSaved {len(results)} result(s) to {args.out}")
+    for failure in failures:
+        print(f"FAILED: {failure['backend']} @ {failure['size']} users: {failure['error']}")
+
+    regressions = compare(results, args.compare) if args.compare else 0
+    return 1 if regressions or failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
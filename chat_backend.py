@@ -0,0 +1,97 @@
+# chat_backend.py
+# The login / registration / chat rules without Streamlit, shared by face_detection4.py and chat_server.py
+#
+# Methods are synchronous and take an already computed face embedding; the server decides
+# where the encoding and the blocking file I/O run.
+
+import os
+import context
+import metrics
+from chatbot import generate_bot_response
+from embedding_index import MATCH_THRESHOLD
+from name_index import names_match
+from response_templates import CONTEXT_TEMPLATES
+from storage_backends import open_storage
+from user_repository import UserRepository
+
+STORAGE_DIR = "user_storage_5"
+# Number of past conversations returned by history()
+HISTORY_LIMIT = 20
+
+
+class ChatBackend:
+    def __init__(self, storage_dir=STORAGE_DIR, on_error=None):
+        os.makedirs(storage_dir, exist_ok=True)
+        self.storage = open_storage(storage_dir)
+        self.repository = UserRepository(self.storage, on_error=on_error)
+
+    def user(self, user_id):
+        return self.repository.get(user_id)
+
+    # Id of the registered user this face belongs to (None if nobody is close enough)
+    def find_user(self, embedding):
+        with metrics.span("recognize_user"):
+            user_id, _ = self.repository.search(embedding, threshold=MATCH_THRESHOLD)
+        return user_id
+
+    # Login with a face. Returns {'status': ...}:
+    #   recognized     user_id, name and a greeting; the face may also refine the user's templates
+    #   unknown        nobody matches; the client should register
+    #   name_mismatch  the face belongs to a user registered under another name (security alert)
+    def recognize(self, embedding, name=None):
+        user_id = self.find_user(embedding)
+        if user_id is None:
+            return {'status': 'unknown'}
+        user_data = self.repository.get(user_id)
+        if name and name.strip() and not names_match(name, user_data['name']):
+            return {'status': 'name_mismatch'}
+        self.repository.record_visit(user_id, embedding)
+        return {
+            'status': 'recognized',
+            'user_id': user_id,
+            'name': user_data['name'],
+            'greeting': CONTEXT_TEMPLATES.choose("greeting", user_data['name']),
+        }
+
+    # Register a new user. Returns {'status': ...}:
+    #   registered          user_id, name and a welcome message
+    #   already_registered  the face matches an existing user (log in instead)
+    #   name_taken          the name belongs to someone else (security alert)
+    #   name_required       no name given
+    def register(self, embedding, name, image_bytes=None):
+        name = (name or '').strip()
+        if not name:
+            return {'status': 'name_required'}
+        if self.find_user(embedding) is not None:
+            return {'status': 'already_registered'}
+        if self.repository.name_taken(name):
+            return {'status': 'name_taken'}
+        user_id = self.repository.next_user_id()
+        with metrics.span("save_user"):
+            self.repository.insert(user_id, name, embedding, image_bytes)
+        return {
+            'status': 'registered',
+            'user_id': user_id,
+            'name': name,
+            'greeting': f"Hello {name}! I'm {context.BOT_NAME}, your medical assistant. How can I help you today?",
+        }
+
+    # One chat turn: the bot's reply to the user's message (None for an unknown user)
+    def chat_turn(self, user_id, message):
+        user_data = self.repository.get(user_id)
+        if user_data is None:
+            return None
+        with metrics.span("generate_bot_response"):
+            return generate_bot_response(message, user_data['name'])
+
+    # Save a finished conversation ([[sender, message], ...]); False for an unknown user
+    def save_conversation(self, user_id, messages):
+        return self.repository.add_conversation(user_id, [list(message) for message in messages])
+
+    def history(self, user_id, limit=HISTORY_LIMIT):
+        return self.repository.load_recent_conversations(user_id, limit)
+
+    def profile_image(self, user_id):
+        if user_id not in self.repository:
+            return None
+        return self.repository.load_image(user_id)
@@ -0,0 +1,333 @@
+# chat_server.py
+# Asyncio HTTP/WebSocket backend for MediBot: face login, registration, chat turns and history.
+#
+#   python chat_server.py [--host 127.0.0.1] [--port 8080] [--storage user_storage_5]
+#
+#   POST /recognize?name=NAME       body: image bytes      -> {"status": "recognized" | "unknown" | "name_mismatch" | "no_face", ...}
+#   POST /register?name=NAME        body: image bytes      -> {"status": "registered" | "already_registered" | "name_taken" | ..., ...}
+#   POST /chat                      {"user_id", "message"} -> {"reply"}
+#   GET  /ws/chat?user_id=ID&token=T  WebSocket: send a message as text, receive {"reply"}
+#   POST /conversations             {"user_id", "messages": [[sender, text], ...]}
+#   GET  /history/{user_id}?limit=N -> {"conversations": [...]}
+#   GET  /users/{user_id}/image     profile image bytes
+#   GET  /metrics                   per-endpoint latency (count, mean, p50, p95, p99, max in ms)
+#   GET  /metrics/prometheus        span histograms (metrics.py) in Prometheus text format
+#
+# A successful recognize or register also returns a session "token". The per-user endpoints
+# (chat, ws/chat, conversations, history, image) require it as "Authorization: Bearer <token>"
+# (?token= for the WebSocket) and only serve that token's own user. Undecodable images and
+# malformed JSON bodies get a 400.
+#
+# One process serves many clients: face encoding runs in the EncodingService worker pool and
+# storage access in the default thread pool, so the event loop only ever waits on futures.
+
+import os
+import time
+import asyncio
+import secrets
+import argparse
+import threading
+from collections import deque
+from aiohttp import web, WSMsgType
+from chat_backend import ChatBackend, STORAGE_DIR, HISTORY_LIMIT
+from encoding_service import EncodingService, ServiceBusy
+from face_pipeline import InvalidImage
+from recognition_cache import RecognitionCache, image_key
+import metrics
+
+DEFAULT_HOST = os.environ.get("CHAT_SERVER_HOST", "127.0.0.1")
+DEFAULT_PORT = int(os.environ.get("CHAT_SERVER_PORT", "8080"))
+# Largest accepted upload
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+# Requests remembered per endpoint for the latency summary
+LATENCY_WINDOW = 1000
+# Latency/metrics label for requests that match no route
+UNMATCHED_ENDPOINT = "unmatched"
+# Seconds a session token stays valid after login
+SESSION_TTL = float(os.environ.get("CHAT_SESSION_TTL", str(12 * 3600)))
+
+
+# Session tokens handed out by recognize/register: token -> (user_id, expiry)
+class SessionStore:
+    def __init__(self, ttl=SESSION_TTL, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def create(self, user_id):
+        token = secrets.token_urlsafe(32)
+        now = self.clock()
+        with self._lock:
+            for expired in [t for t, (_, expiry) in self._sessions.items() if expiry <= now]:
+                del self._sessions[expired]
+            self._sessions[token] = (user_id, now + self.ttl)
+        return token
+
+    # The user a token was issued to (None if unknown or expired)
+    def user_id(self, token):
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None or session[1] <= self.clock():
+                self._sessions.pop(token, None)
+                return None
+            return session[0]
+
+
+# Recent request durations per endpoint
+class LatencyTracker:
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self._samples = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds):
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None:
+                samples = self._samples[endpoint] = deque(maxlen=self.window)
+            samples.append(seconds)
+            self._counts[endpoint] = self._counts.get(endpoint, 0) + 1
+
+    def summary(self):
+        with self._lock:
+            snapshot = {endpoint: sorted(samples) for endpoint, samples in self._samples.items()}
+            counts = dict(self._counts)
+        summary = {}
+        for endpoint, samples in snapshot.items():
+            def quantile(q):
+                return samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+            summary[endpoint] = {
+                'count': counts[endpoint],
+                'mean_ms': sum(samples) / len(samples) * 1000,
+                'p50_ms': quantile(0.50),
+                'p95_ms': quantile(0.95),
+                'p99_ms': quantile(0.99),
+                'max_ms': samples[-1] * 1000,
+            }
+        return summary
+
+
+# Route template of a request ("GET /history/{user_id}"). Requests that match no route share
+# one label, so scanners probing random paths can't grow the metrics without bound.
+def endpoint_name(request):
+    resource = request.match_info.route.resource
+    if resource is None:
+        return UNMATCHED_ENDPOINT
+    return f"{request.method} {resource.canonical}"
+
+
+@web.middleware
+async def latency_middleware(request, handler):
+    if request.path == '/ws/chat':
+        # Long-lived; its messages are timed individually
+        return await handler(request)
+    start = time.perf_counter()
+    try:
+        return await handler(request)
+    finally:
+        seconds = time.perf_counter() - start
+        request.app['latency'].record(endpoint_name(request), seconds)
+        metrics.observe(f"http {endpoint_name(request)}", seconds)
+
+
+# Run blocking backend work on the default thread pool
+async def run_sync(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+# Face embedding of an uploaded image (None if no face). Encodings are cached by image content,
+# so a recognize followed by a register with the same photo encodes it only once.
+async def embed(app, image_bytes):
+    key = image_key(image_bytes)
+    found, embedding = app['embeddings'].embedding(key)
+    if found:
+        return embedding
+    service = app['encoder']
+    try:
+        future = service.submit(image_bytes)
+    except ServiceBusy as e:
+        raise web.HTTPServiceUnavailable(text=str(e))
+    try:
+        embedding = await asyncio.wait_for(asyncio.wrap_future(future), service.timeout)
+    except asyncio.TimeoutError:
+        raise web.HTTPGatewayTimeout(text="Timed out waiting for the face encoding")
+    except InvalidImage as e:
+        raise web.HTTPBadRequest(text=str(e))
+    app['embeddings'].put_embedding(key, embedding)
+    return embedding
+
+
+async def read_image(request):
+    image_bytes = await request.read()
+    if not image_bytes:
+        raise web.HTTPBadRequest(text="Request body must be the image bytes")
+    return image_bytes
+
+
+async def read_json(request, *fields):
+    try:
+        body = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text="Request body must be JSON")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="Request body must be a JSON object")
+    missing = [field for field in fields if field not in body]
+    if missing:
+        raise web.HTTPBadRequest(text=f"Missing field(s): {', '.join(missing)}")
+    return body
+
+
+# A saved conversation is a list of [sender, text] string pairs
+def is_message_list(messages):
+    return isinstance(messages, list) and all(
+        isinstance(message, list) and len(message) == 2 and all(isinstance(part, str) for part in message)
+        for message in messages
+    )
+
+
+# Reject the request unless it carries a live session token of `user_id`
+def authorize(request, user_id, allow_query=False):
+    header = request.headers.get('Authorization', '')
+    if header.startswith('Bearer '):
+        token = header[len('Bearer '):].strip()
+    else:
+        token = request.query.get('token') if allow_query else None
+    if not token:
+        raise web.HTTPUnauthorized(text="Session token required (log in with /recognize or /register)")
+    session_user = request.app['sessions'].user_id(token)
+    if session_user is None:
+        raise web.HTTPUnauthorized(text="Invalid or expired session token")
+    if session_user != user_id:
+        raise web.HTTPForbidden(text="The session token belongs to another user")
+
+
+# Login/registration result, plus a session token when it identified a user
+def with_session(app, result):
+    if result['status'] in ('recognized', 'registered'):
+        result['token'] = app['sessions'].create(result['user_id'])
+    return web.json_response(result)
+
+
+async def recognize(request):
+    embedding = await embed(request.app, await read_image(request))
+    if embedding is None:
+        return web.json_response({'status': 'no_face'})
+    return with_session(
+        request.app, await run_sync(request.app['backend'].recognize, embedding, request.query.get('name'))
+    )
+
+
+async def register(request):
+    image_bytes = await read_image(request)
+    embedding = await embed(request.app, image_bytes)
+    if embedding is None:
+        return web.json_response({'status': 'no_face'})
+    return with_session(
+        request.app, await run_sync(request.app['backend'].register, embedding, request.query.get('name'), image_bytes)
+    )
+
+
+async def chat(request):
+    body = await read_json(request, 'user_id', 'message')
+    if not isinstance(body['message'], str):
+        raise web.HTTPBadRequest(text="message must be a string")
+    authorize(request, body['user_id'])
+    reply = await run_sync(request.app['backend'].chat_turn, body['user_id'], body['message'])
+    if reply is None:
+        raise web.HTTPNotFound(text="Unknown user")
+    return web.json_response({'reply': reply})
+
+
+async def chat_socket(request):
+    user_id = request.query.get('user_id')
+    authorize(request, user_id, allow_query=True)
+    backend = request.app['backend']
+    if not user_id or backend.user(user_id) is None:
+        raise web.HTTPNotFound(text="Unknown user")
+    socket = web.WebSocketResponse(heartbeat=30)
+    await socket.prepare(request)
+    async for message in socket:
+        if message.type != WSMsgType.TEXT:
+            continue
+        start = time.perf_counter()
+        reply = await run_sync(backend.chat_turn, user_id, message.data)
+        await socket.send_json({'reply': reply})
+        request.app['latency'].record("WS /ws/chat", time.perf_counter() - start)
+    return socket
+
+
+async def save_conversation(request):
+    body = await read_json(request, 'user_id', 'messages')
+    if not is_message_list(body['messages']):
+        raise web.HTTPBadRequest(text="messages must be a list of [sender, text] pairs")
+    authorize(request, body['user_id'])
+    if not await run_sync(request.app['backend'].save_conversation, body['user_id'], body['messages']):
+        raise web.HTTPNotFound(text="Unknown user")
+    return web.json_response({'saved': True}, status=201)
+
+
+async def history(request):
+    try:
+        limit = int(request.query.get('limit', HISTORY_LIMIT))
+    except ValueError:
+        raise web.HTTPBadRequest(text="limit must be an integer")
+    authorize(request, request.match_info['user_id'])
+    conversations = await run_sync(request.app['backend'].history, request.match_info['user_id'], limit)
+    return web.json_response({'conversations': conversations})
+
+
+async def profile_image(request):
+    authorize(request, request.match_info['user_id'])
+    image_bytes = await run_sync(request.app['backend'].profile_image, request.match_info['user_id'])
+    if not image_bytes:
+        raise web.HTTPNotFound(text="No profile image")
+    return web.Response(body=image_bytes, content_type='application/octet-stream')
+
+
+async def latency_summary(request):
+    return web.json_response(request.app['latency'].summary())
+
+
+async def prometheus_metrics(request):
+    return web.Response(text=metrics.render_prometheus(), content_type='text/plain')
+
+
+async def shutdown_encoder(app):
+    app['encoder'].shutdown(wait=False)
+
+
+def create_app(storage_dir=STORAGE_DIR, encoder=None):
+    app = web.Application(middlewares=[latency_middleware], client_max_size=MAX_IMAGE_BYTES)
+    app['backend'] = ChatBackend(storage_dir)
+    app['encoder'] = encoder or EncodingService()
+    app['embeddings'] = RecognitionCache()
+    app['latency'] = LatencyTracker()
+    app['sessions'] = SessionStore()
+    app.on_cleanup.append(shutdown_encoder)
+    app.add_routes([
+        web.post('/recognize', recognize),
+        web.post('/register', register),
+        web.post('/chat', chat),
+        web.get('/ws/chat', chat_socket),
+        web.post('/conversations', save_conversation),
+        web.get('/history/{user_id}', history),
+        web.get('/users/{user_id}/image', profile_image),
+        web.get('/metrics', latency_summary),
+        web.get('/metrics/prometheus', prometheus_metrics),
+    ])
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MediBot chat backend")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--storage', default=STORAGE_DIR, help=f"user storage directory (default: {STORAGE_DIR})")
+    args = parser.parse_args(argv)
+    web.run_app(create_app(args.storage), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
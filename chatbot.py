@@ -0,0 +1,17 @@
+# chatbot.py
+# MediBot's reply to one chat message, shared by the Streamlit apps and the chat backend
+
+from intents import match_intent
+from response_templates import CONTEXT_TEMPLATES
+from intent_classifier import classify_intent, INTENT_CONFIDENCE_THRESHOLD
+
+
+# Generate bot response based on context
+def generate_bot_response(user_input, user_name, templates=CONTEXT_TEMPLATES):
+    # The local classifier ranks intents and copes with paraphrases; when it isn't confident,
+    # fall back to the precompiled keyword matcher (see intent_classifier.py and intents.py)
+    intent, confidence = classify_intent(user_input)
+    if confidence < INTENT_CONFIDENCE_THRESHOLD:
+        intent = match_intent(user_input)
+    # Replies are prevalidated and cached per user (see response_templates.py)
+    return templates.choose(intent or "fallback", user_name)
@@ -57,6 +57,18 @@ RESPONSE_TEMPLATES = {
     "fallback": "I'm here to help with medical questions and guidance. Could you tell me a bit more about what you're experiencing so I can assist you better? I can help with symptoms discussion, appointment scheduling, prescription questions, and general health advice."
 }
 
+# Keywords that select each response category, in priority order: when a message mentions
+# several intents, the first one listed here wins. Keywords match whole words (plus simple
+# inflections such as "pills" or "hurting"); multi-word keywords match as a phrase.
+INTENT_KEYWORDS = {
+    "greeting": ["hello", "hi", "hey", "hola"],
+    "symptoms": ["symptom", "pain", "hurt", "headache", "fever", "nausea", "dizzy", "cough", "cold", "ache"],
+    "appointment": ["appointment", "schedule", "doctor", "see a", "meeting"],
+    "prescription": ["prescription", "medication", "refill", "pill", "medicine", "drug"],
+    "thanks": ["thank", "thanks", "thank you", "appreciate"],
+    "goodbye": ["bye", "goodbye", "end", "quit", "exit", "see you"]
+}
+
 # Bot configuration
 BOT_NAME = "MediBot"
 BOT_ROLE = "Medical Assistant"
\ No newline at end of file
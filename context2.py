@@ -40,7 +40,7 @@ RESPONSE_TEMPLATES = {
     "goodbye": [
         "Thank you for chatting, {name}. Please take care and don't hesitate to return if you have more questions later!",
         "Goodbye, {name}! Wishing you the best with your health. Remember to follow up with your doctor if needed.",
-        "Take care, {name!} It was a pleasure assisting you today. Be well!"
+        "Take care, {name}! It was a pleasure assisting you today. Be well!"
     ],
     "fallback": "I'm here to help with medical questions and guidance. Could you tell me a bit more about what you're experiencing so I can assist you better?"
 }
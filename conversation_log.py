@@ -0,0 +1,149 @@
+# conversation_log.py
+# Append-only per-user conversation journal (one JSON record per line)
+#
+#   python conversation_log.py compact user_storage_5/conversations   # drop torn/corrupt lines (e.g. from cron)
+
+import os
+import json
+import argparse
+from contextlib import contextmanager
+from atomic_file import write_atomic, locked
+
+# Block size used when scanning a journal backwards for the newest entries
+READ_BLOCK_SIZE = 64 * 1024
+
+# Parse journal lines, skipping anything that is not a complete JSON record (e.g. a torn last write)
+def _parse_lines(lines):
+    records = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue
+    return records
+
+
+# Every record of the journal at `path`, oldest first (empty if there is none)
+def read_journal(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return _parse_lines(f)
+
+
+# One <user_id>.jsonl file per user. Saving a conversation appends a single line and fsyncs it,
+# so the cost no longer depends on the size of the history, and concurrent sessions can't
+# overwrite each other's saves.
+class ConversationLog:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, user_id):
+        return os.path.join(self.directory, f'{user_id}.jsonl')
+
+    # A user's journal, opened for appending under atomic_file.locked. The lock is on a sidecar,
+    # so it still holds after compact() renames a rewritten journal into place.
+    @contextmanager
+    def _exclusive(self, user_id):
+        path = self.path(user_id)
+        with locked(path), open(path, 'ab+') as f:
+            yield f
+
+    # Replace a journal with exactly these records (see atomic_file.write_atomic)
+    def _write_atomic(self, user_id, records):
+        data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        write_atomic(self.path(user_id), data.encode('utf-8'))
+
+    # Durably append one conversation record
+    def append(self, user_id, record):
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        with self._exclusive(user_id) as f:
+            # Drop a torn tail from an earlier crash so the new record starts on its own line
+            size = f.seek(0, os.SEEK_END)
+            if size:
+                f.seek(size - 1)
+                if f.read(1) != b'\n':
+                    f.seek(0)
+                    data = f.read()
+                    f.truncate(data.rfind(b'\n') + 1)
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    # Every record, oldest first
+    def read_all(self, user_id):
+        return read_journal(self.path(user_id))
+
+    # The newest `limit` records, oldest first, reading backwards from the end of the file
+    def read_latest(self, user_id, limit):
+        path = self.path(user_id)
+        if limit <= 0 or not os.path.exists(path):
+            return []
+        with open(path, 'rb') as f:
+            position = f.seek(0, os.SEEK_END)
+            data = b''
+            # limit + 1 newlines guarantees `limit` complete lines (plus a possibly torn tail)
+            while position > 0 and data.count(b'\n') <= limit:
+                step = min(READ_BLOCK_SIZE, position)
+                position -= step
+                f.seek(position)
+                data = f.read(step) + data
+        lines = data.decode('utf-8', errors='replace').split('\n')
+        if position > 0:
+            lines = lines[1:]  # first line is only partially read
+        return _parse_lines(lines)[-limit:]
+
+    def exists(self, user_id):
+        return os.path.exists(self.path(user_id))
+
+    # Rewrite a journal with only its valid records. Returns the number of lines dropped;
+    # a journal with nothing to drop is left untouched.
+    def compact(self, user_id):
+        with self._exclusive(user_id) as f:
+            f.seek(0)
+            data = f.read()
+            lines = data.decode('utf-8', errors='replace').split('\n')
+            records = _parse_lines(lines)
+            dropped = sum(1 for line in lines if line.strip()) - len(records)
+            if dropped or (data and not data.endswith(b'\n')):
+                self._write_atomic(user_id, records)
+        return dropped
+
+    # Compact every journal in the directory; run periodically (`python conversation_log.py compact DIR`).
+    # Returns {user_id: lines dropped} for the journals that were rewritten.
+    def compact_all(self):
+        compacted = {}
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.jsonl'):
+                dropped = self.compact(filename[:-6])
+                if dropped:
+                    compacted[filename[:-6]] = dropped
+        return compacted
+
+    # Seed a user's journal from existing records (migrations), under the same lock as append().
+    # A non-empty journal means an earlier, interrupted migration already got this far (or the
+    # user has saved conversations since), so it is left alone.
+    def import_records(self, user_id, records):
+        with self._exclusive(user_id) as journal:
+            if os.fstat(journal.fileno()).st_size == 0:
+                self._write_atomic(user_id, records)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Conversation journal maintenance")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    compact_parser = subparsers.add_parser('compact', help="rewrite journals without torn or corrupt lines")
+    compact_parser.add_argument('directories', nargs='+', help="conversation directories (e.g. user_storage_5/conversations)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'compact':
+        for directory in args.directories:
+            compacted = ConversationLog(directory).compact_all()
+            print(f"{directory}: {len(compacted)} journal(s) compacted, {sum(compacted.values())} line(s) dropped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,503 @@
+# embedding_index.py
+# In-memory index over face embeddings for fast recognition
+
+import os
+import numpy as np
+
+# face_recognition produces 128-d encodings; two faces match below this distance
+EMBEDDING_DIM = 128
+MATCH_THRESHOLD = 0.6
+
+# Search backend configuration ("templates" = per-user multi-template gallery over exact scans,
+# "flat" = exact scan of every stored embedding, "ivf" = approximate inverted-file index)
+INDEX_BACKEND = os.environ.get("FACE_INDEX_BACKEND", "templates")
+# Number of IVF partitions probed per query: higher = better recall, slower search
+IVF_N_PROBE = int(os.environ.get("FACE_INDEX_N_PROBE", "8"))
+# Below this many embeddings the IVF backend just scans exhaustively
+IVF_MIN_TRAIN_SIZE = int(os.environ.get("FACE_INDEX_MIN_TRAIN_SIZE", "10000"))
+# Confirm an IVF miss with a full scan (set to 0 to trust the probed partitions alone)
+IVF_EXHAUSTIVE_ON_MISS = os.environ.get("FACE_INDEX_EXHAUSTIVE_ON_MISS", "1") not in ("", "0")
+# Samples kept per user by the template gallery
+TEMPLATE_MAX_SAMPLES = int(os.environ.get("FACE_TEMPLATE_MAX_SAMPLES", "10"))
+# Summary matches this close to the threshold are re-checked against the user's individual samples
+TEMPLATE_RECHECK_MARGIN = float(os.environ.get("FACE_TEMPLATE_RECHECK_MARGIN", "0.1"))
+# Index holding the template gallery's summary rows ("flat" or "ivf", for very large galleries)
+TEMPLATE_SUMMARY_BACKEND = os.environ.get("FACE_TEMPLATE_SUMMARY_BACKEND", "flat")
+# A recognised face is kept as a new sample only if it is confidently the same person
+# (closer than SAMPLE_MAX_DISTANCE) yet adds something new (at least SAMPLE_MIN_NOVELTY away)
+SAMPLE_MAX_DISTANCE = 0.45
+SAMPLE_MIN_NOVELTY = 0.15
+
+
+# Contiguous float32 (N, 128) matrix of embeddings plus a parallel array of user ids.
+# Built once, appended to in place on registration, searched with one vectorized pass.
+class EmbeddingIndex:
+    def __init__(self, dim=EMBEDDING_DIM, capacity=1024):
+        self.dim = dim
+        self._size = 0
+        self._matrix = np.empty((capacity, dim), dtype=np.float32)
+        self._sq_norms = np.empty(capacity, dtype=np.float32)
+        self._ids = np.empty(capacity, dtype=object)
+
+    # Build an index in one shot from a users_db dictionary ({user_id: {'embedding': [...]}})
+    @classmethod
+    def from_users(cls, users_db, dim=EMBEDDING_DIM):
+        user_ids = [user_id for user_id, user_data in users_db.items() if 'embedding' in user_data]
+        embeddings = [users_db[user_id]['embedding'] for user_id in user_ids]
+        return cls.from_arrays(user_ids, embeddings, dim=dim)
+
+    # Build an index from parallel sequences of ids and embeddings
+    @classmethod
+    def from_arrays(cls, user_ids, embeddings, dim=EMBEDDING_DIM):
+        matrix = np.asarray(embeddings, dtype=np.float32).reshape(-1, dim)
+        if len(user_ids) != len(matrix):
+            raise ValueError(f"Got {len(user_ids)} ids for {len(matrix)} embeddings")
+        if len(matrix) == 0:
+            return cls(dim=dim)
+        # Adopt the matrix as-is (e.g. a memory-mapped EmbeddingStore) instead of copying it;
+        # the first add() moves everything into a growable buffer
+        index = cls(dim=dim, capacity=0)
+        index._matrix = matrix
+        index._sq_norms = np.einsum('ij,ij->i', matrix, matrix)
+        index._ids = np.empty(len(matrix), dtype=object)
+        index._ids[:] = list(user_ids)
+        index._size = len(matrix)
+        return index
+
+    def __len__(self):
+        return self._size
+
+    # View of the populated rows (no copy)
+    @property
+    def matrix(self):
+        return self._matrix[:self._size]
+
+    @property
+    def ids(self):
+        return self._ids[:self._size]
+
+    # Append one embedding for a user, growing the buffers geometrically when full
+    def add(self, user_id, embedding):
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if vector.shape[0] != self.dim:
+            raise ValueError(f"Expected a {self.dim}-d embedding, got {vector.shape[0]}")
+        if self._size == len(self._matrix):
+            self._grow(max(2 * len(self._matrix), 1))
+        self._matrix[self._size] = vector
+        self._sq_norms[self._size] = vector @ vector
+        self._ids[self._size] = user_id
+        self._size += 1
+
+    # Overwrite the embedding stored in one row (the user id stays the same)
+    def set_row(self, row, embedding):
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        self._matrix[row] = vector
+        self._sq_norms[row] = vector @ vector
+
+    def _grow(self, capacity):
+        matrix = np.empty((capacity, self.dim), dtype=np.float32)
+        sq_norms = np.empty(capacity, dtype=np.float32)
+        ids = np.empty(capacity, dtype=object)
+        matrix[:self._size] = self._matrix[:self._size]
+        sq_norms[:self._size] = self._sq_norms[:self._size]
+        ids[:self._size] = self._ids[:self._size]
+        self._matrix, self._sq_norms, self._ids = matrix, sq_norms, ids
+
+    # Euclidean distance from the query to every stored embedding, in a single matrix-vector pass
+    def distances(self, embedding):
+        query = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        sq = self._sq_norms[:self._size] - 2.0 * (self.matrix @ query) + query @ query
+        return np.sqrt(np.maximum(sq, 0.0))
+
+    # Rows closer than `radius` to the query and their distances; just the nearest row if none is
+    def within(self, embedding, radius):
+        distances = self.distances(embedding)
+        rows = np.flatnonzero(distances < radius)
+        if not len(rows):
+            rows = np.array([np.argmin(distances)])
+        return rows, distances[rows]
+
+    # Best match for the query: (user_id, distance), with user_id None if nothing is under the threshold
+    def search(self, embedding, threshold=MATCH_THRESHOLD):
+        if self._size == 0:
+            return None, None
+        distances = self.distances(embedding)
+        best = int(np.argmin(distances))
+        distance = float(distances[best])
+        if distance < threshold:
+            return self._ids[best], distance
+        return None, distance
+
+    # Best match for each row of a (Q, 128) query matrix, computed as blocked matrix products
+    # (||a||^2 - 2ab + ||b||^2) rather than Q separate scans. Returns a list of (user_id, distance).
+    def search_batch(self, embeddings, threshold=MATCH_THRESHOLD, block_size=1024):
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        if self._size == 0:
+            return [(None, None)] * len(queries)
+        results = []
+        for start in range(0, len(queries), block_size):
+            block = queries[start:start + block_size]
+            sq = (self._sq_norms[:self._size][None, :] - 2.0 * (block @ self.matrix.T)
+                  + np.einsum('ij,ij->i', block, block)[:, None])
+            best = np.argmin(sq, axis=1)
+            distances = np.sqrt(np.maximum(sq[np.arange(len(block)), best], 0.0))
+            for row, distance in zip(best, distances):
+                distance = float(distance)
+                results.append((self._ids[row] if distance < threshold else None, distance))
+        return results
+
+
+# Plain k-means (Lloyd's algorithm) in NumPy, used to learn the IVF coarse partitions
+def kmeans(data, n_clusters, n_iter=10, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = nearest_centroids(data, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, data)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        empty = counts == 0
+        # Re-seed empty clusters from random points so every partition stays in use
+        if empty.any():
+            sums[empty] = data[rng.choice(len(data), int(empty.sum()))]
+            counts[empty] = 1
+        centroids = (sums / counts[:, None]).astype(np.float32)
+    return centroids
+
+
+# Index of the nearest centroid for each row, computed in chunks to bound memory
+def nearest_centroids(data, centroids, chunk_size=8192):
+    centroid_sq = np.einsum('ij,ij->i', centroids, centroids)
+    assignments = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        # ||x||^2 is constant per row, so it can be dropped from the argmin
+        scores = centroid_sq[None, :] - 2.0 * (chunk @ centroids.T)
+        assignments[start:start + chunk_size] = np.argmin(scores, axis=1)
+    return assignments
+
+
+# Approximate nearest-neighbour index: k-means coarse partitions (inverted lists) plus probing.
+# Vectors live in a flat EmbeddingIndex; each query only scans the n_probe closest partitions.
+class IVFIndex:
+    def __init__(self, dim=EMBEDDING_DIM, n_lists=None, n_probe=IVF_N_PROBE,
+                 min_train_size=IVF_MIN_TRAIN_SIZE, retrain_factor=4, exhaustive_on_miss=IVF_EXHAUSTIVE_ON_MISS):
+        self.dim = dim
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.min_train_size = min_train_size
+        self.retrain_factor = retrain_factor
+        # A miss usually means "new patient", so confirm it with a full scan before
+        # registering a duplicate; logins (hits) stay on the fast path
+        self.exhaustive_on_miss = exhaustive_on_miss
+        self._flat = EmbeddingIndex(dim=dim)
+        self._centroids = None
+        self._centroid_sq = None
+        self._trained_size = 0
+        self._lists = []
+        self._list_arrays = []
+        # Partition of each row, so set_row can move a row between inverted lists
+        self._row_lists = []
+
+    @classmethod
+    def from_users(cls, users_db, dim=EMBEDDING_DIM, **params):
+        user_ids = [user_id for user_id, user_data in users_db.items() if 'embedding' in user_data]
+        embeddings = [users_db[user_id]['embedding'] for user_id in user_ids]
+        return cls.from_arrays(user_ids, embeddings, dim=dim, **params)
+
+    @classmethod
+    def from_arrays(cls, user_ids, embeddings, dim=EMBEDDING_DIM, **params):
+        index = cls(dim=dim, **params)
+        index._flat = EmbeddingIndex.from_arrays(user_ids, embeddings, dim=dim)
+        if len(index) >= index.min_train_size:
+            index.train()
+        return index
+
+    def __len__(self):
+        return len(self._flat)
+
+    @property
+    def matrix(self):
+        return self._flat.matrix
+
+    @property
+    def ids(self):
+        return self._flat.ids
+
+    @property
+    def is_trained(self):
+        return self._centroids is not None
+
+    # Learn the coarse partitions from (a sample of) the stored vectors and rebuild the inverted lists
+    def train(self, seed=0):
+        data = self._flat.matrix
+        n_lists = self.n_lists or max(int(np.sqrt(len(data))), 1)
+        n_lists = min(n_lists, len(data))
+        # ~32 points per centroid is plenty for k-means on face encodings
+        sample_size = min(len(data), 32 * n_lists)
+        rng = np.random.default_rng(seed)
+        sample = data[rng.choice(len(data), sample_size, replace=False)]
+        self._centroids = kmeans(sample, n_lists, seed=seed)
+        self._centroid_sq = np.einsum('ij,ij->i', self._centroids, self._centroids)
+        assignments = nearest_centroids(data, self._centroids)
+        order = np.argsort(assignments, kind='stable')
+        bounds = np.searchsorted(assignments[order], np.arange(n_lists + 1))
+        self._lists = [order[bounds[i]:bounds[i + 1]].tolist() for i in range(n_lists)]
+        self._list_arrays = [np.asarray(rows, dtype=np.int64) for rows in self._lists]
+        self._row_lists = assignments.tolist()
+        self._trained_size = len(data)
+
+    def _needs_training(self):
+        if len(self) < self.min_train_size:
+            return False
+        return not self.is_trained or len(self) > self.retrain_factor * self._trained_size
+
+    # Append one embedding; once trained, it goes straight into its partition's inverted list
+    def add(self, user_id, embedding):
+        row = len(self._flat)
+        self._flat.add(user_id, embedding)
+        if self.is_trained:
+            list_id = int(nearest_centroids(self._flat.matrix[row:row + 1], self._centroids)[0])
+            self._lists[list_id].append(row)
+            self._list_arrays[list_id] = None
+            self._row_lists.append(list_id)
+
+    # Overwrite the embedding stored in one row, moving it to its new partition if that changed
+    def set_row(self, row, embedding):
+        self._flat.set_row(row, embedding)
+        if self.is_trained:
+            old, new = self._row_lists[row], int(nearest_centroids(self._flat.matrix[row:row + 1], self._centroids)[0])
+            if new != old:
+                self._lists[old].remove(row)
+                self._lists[new].append(row)
+                self._list_arrays[old] = self._list_arrays[new] = None
+                self._row_lists[row] = new
+
+    def _candidate_rows(self, query):
+        centroid_scores = self._centroid_sq - 2.0 * (self._centroids @ query)
+        n_probe = min(self.n_probe, len(self._centroids))
+        probed = np.argpartition(centroid_scores, n_probe - 1)[:n_probe]
+        for list_id in probed:
+            if self._list_arrays[list_id] is None:
+                self._list_arrays[list_id] = np.asarray(self._lists[list_id], dtype=np.int64)
+        return np.concatenate([self._list_arrays[list_id] for list_id in probed])
+
+    # Best match for the query: (user_id, distance), with user_id None if nothing is under the threshold
+    def search(self, embedding, threshold=MATCH_THRESHOLD):
+        if len(self) == 0:
+            return None, None
+        if self._needs_training():
+            self.train()
+        if not self.is_trained:
+            return self._flat.search(embedding, threshold=threshold)
+
+        query = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        rows = self._candidate_rows(query)
+        if len(rows):
+            flat = self._flat
+            sq = flat._sq_norms[rows] - 2.0 * (flat._matrix[rows] @ query) + query @ query
+            best = int(np.argmin(sq))
+            distance = float(np.sqrt(max(sq[best], 0.0)))
+            if distance < threshold:
+                return flat._ids[rows[best]], distance
+        if self.exhaustive_on_miss or not len(rows):
+            return self._flat.search(embedding, threshold=threshold)
+        return None, distance
+
+    # Rows closer than `radius` to the query among the probed partitions, and their distances.
+    # If none is, the nearest row: from a full scan when exhaustive_on_miss, else the nearest probed one.
+    def within(self, embedding, radius):
+        if self._needs_training():
+            self.train()
+        if not self.is_trained:
+            return self._flat.within(embedding, radius)
+        query = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        rows = self._candidate_rows(query)
+        if not len(rows):
+            return self._flat.within(embedding, radius)
+        flat = self._flat
+        distances = np.sqrt(np.maximum(flat._sq_norms[rows] - 2.0 * (flat._matrix[rows] @ query) + query @ query, 0.0))
+        close = distances < radius
+        if close.any():
+            return rows[close], distances[close]
+        if self.exhaustive_on_miss:
+            return self._flat.within(embedding, radius)
+        best = int(np.argmin(distances))
+        return rows[best:best + 1], distances[best:best + 1]
+
+    # Probed search per query (each query visits different partitions)
+    def search_batch(self, embeddings, threshold=MATCH_THRESHOLD):
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        return [self.search(query, threshold=threshold) for query in queries]
+
+
+# Sum-of-distances medoid: the row of `samples` closest, in total, to all the others
+def medoid(samples):
+    sq_norms = np.einsum('ij,ij->i', samples, samples)
+    sq = sq_norms[:, None] - 2.0 * (samples @ samples.T) + sq_norms[None, :]
+    return samples[int(np.argmin(np.sqrt(np.maximum(sq, 0.0)).sum(axis=1)))]
+
+
+# Multi-template gallery: up to max_samples embeddings per user, summarised by a running centroid
+# (mean of every sample ever added) and the medoid of the kept samples. Queries scan only the
+# two summary rows per user; the user's individual samples are compared only when the best
+# summary distance lands within recheck_margin of the threshold. Search cost therefore grows
+# with the number of users, not with the number of visits each user has made. The summary rows
+# live in an index of their own (summary_backend, with **summary_params), so a very large
+# gallery can probe them through IVF instead of scanning them all.
+class TemplateGallery:
+    def __init__(self, dim=EMBEDDING_DIM, max_samples=TEMPLATE_MAX_SAMPLES, recheck_margin=TEMPLATE_RECHECK_MARGIN,
+                 summary_backend=TEMPLATE_SUMMARY_BACKEND, **summary_params):
+        if summary_backend == 'templates':
+            raise ValueError("The template gallery's summaries need a flat or ivf index")
+        self.dim = dim
+        self.max_samples = max_samples
+        self.recheck_margin = recheck_margin
+        # Rows 2i and 2i+1 hold user i's centroid and medoid
+        self.summaries = make_index(summary_backend, dim=dim, **summary_params)
+        self._users = {}
+        self._order = []
+        self._added = 0
+
+    @classmethod
+    def from_users(cls, users_db, dim=EMBEDDING_DIM, **params):
+        gallery = cls(dim=dim, **params)
+        for user_id, user_data in users_db.items():
+            if 'embedding' in user_data:
+                gallery.add(user_id, user_data['embedding'])
+        return gallery
+
+    @classmethod
+    def from_arrays(cls, user_ids, embeddings, dim=EMBEDDING_DIM, **params):
+        matrix = np.asarray(embeddings, dtype=np.float32).reshape(-1, dim)
+        if len(user_ids) != len(matrix):
+            raise ValueError(f"Got {len(user_ids)} ids for {len(matrix)} embeddings")
+        gallery = cls(dim=dim, **params)
+        for user_id, embedding in zip(user_ids, matrix):
+            gallery.add(user_id, embedding)
+        return gallery
+
+    # Number of embeddings added (not users), so callers can mirror an append-only store row for row
+    def __len__(self):
+        return self._added
+
+    def __contains__(self, user_id):
+        return user_id in self._users
+
+    def samples(self, user_id):
+        return self._users[user_id]['samples']
+
+    # Add one sample for a user. Once max_samples are kept, the new sample replaces whichever
+    # kept sample is most redundant (closest to another one), so the templates stay diverse.
+    def add(self, user_id, embedding):
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if vector.shape[0] != self.dim:
+            raise ValueError(f"Expected a {self.dim}-d embedding, got {vector.shape[0]}")
+        self._added += 1
+        user = self._users.get(user_id)
+        if user is None:
+            row = len(self.summaries)
+            self.summaries.add(user_id, vector)
+            self.summaries.add(user_id, vector)
+            self._users[user_id] = {'samples': vector[None, :].copy(), 'centroid': vector.copy(), 'count': 1, 'row': row}
+            self._order.append(user_id)
+            return
+
+        user['count'] += 1
+        user['centroid'] += (vector - user['centroid']) / user['count']
+        samples = np.vstack([user['samples'], vector])
+        if len(samples) > self.max_samples:
+            sq_norms = np.einsum('ij,ij->i', samples, samples)
+            sq = sq_norms[:, None] - 2.0 * (samples @ samples.T) + sq_norms[None, :]
+            np.fill_diagonal(sq, np.inf)
+            samples = np.delete(samples, int(np.argmin(sq.min(axis=1))), axis=0)
+        user['samples'] = samples
+        self.summaries.set_row(user['row'], user['centroid'])
+        self.summaries.set_row(user['row'] + 1, medoid(samples))
+
+    # Smallest distance from the query to any kept sample of one user
+    def sample_distance(self, user_id, embedding):
+        samples = self._users[user_id]['samples']
+        query = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        return float(np.sqrt(np.maximum(((samples - query) ** 2).sum(axis=1), 0.0)).min())
+
+    # Whether a face just recognised as user_id is worth keeping as another sample
+    def wants_sample(self, user_id, embedding):
+        if user_id not in self._users:
+            return False
+        distance = self.sample_distance(user_id, embedding)
+        return SAMPLE_MIN_NOVELTY <= distance < SAMPLE_MAX_DISTANCE
+
+    # Decide from the summary rows near the query (row numbers and distances, as from within())
+    def _best(self, rows, row_distances, embedding, threshold):
+        # Nearest summary row per user
+        summary_distances = {}
+        for row, distance in zip(rows, row_distances):
+            user_id = self._order[row // 2]
+            summary_distances[user_id] = min(float(distance), summary_distances.get(user_id, np.inf))
+        best_id = min(summary_distances, key=summary_distances.get)
+        distance = summary_distances[best_id]
+        if distance < threshold - self.recheck_margin:
+            return best_id, distance
+        # Borderline or miss: compare the few nearby users' individual samples
+        best_id, best_sample = None, np.inf
+        for candidate, summary_distance in summary_distances.items():
+            if summary_distance >= threshold + self.recheck_margin:
+                continue
+            sample_distance = self.sample_distance(candidate, embedding)
+            if sample_distance < best_sample:
+                best_id, best_sample = candidate, sample_distance
+        if best_sample < threshold:
+            return best_id, best_sample
+        return None, min(distance, best_sample)
+
+    # Best match for the query: (user_id, distance), with user_id None if nothing is under the threshold
+    def search(self, embedding, threshold=MATCH_THRESHOLD):
+        if not self._order:
+            return None, None
+        rows, row_distances = self.summaries.within(embedding, threshold + self.recheck_margin)
+        return self._best(rows, row_distances, embedding, threshold)
+
+    # Best match for each row of a (Q, 128) query matrix. Flat summaries are scanned in blocked
+    # matrix products; other summary indexes are searched one query at a time.
+    def search_batch(self, embeddings, threshold=MATCH_THRESHOLD, block_size=1024):
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        if not self._order:
+            return [(None, None)] * len(queries)
+        if not isinstance(self.summaries, EmbeddingIndex):
+            return [self.search(query, threshold=threshold) for query in queries]
+        radius = threshold + self.recheck_margin
+        matrix, sq_norms = self.summaries.matrix, self.summaries._sq_norms[:len(self.summaries)]
+        results = []
+        for start in range(0, len(queries), block_size):
+            block = queries[start:start + block_size]
+            sq = sq_norms[None, :] - 2.0 * (block @ matrix.T) + np.einsum('ij,ij->i', block, block)[:, None]
+            distances = np.sqrt(np.maximum(sq, 0.0))
+            for row_distances, query in zip(distances, block):
+                rows = np.flatnonzero(row_distances < radius)
+                if not len(rows):
+                    rows = np.array([np.argmin(row_distances)])
+                results.append(self._best(rows, row_distances[rows], query, threshold))
+        return results
+
+
+INDEX_BACKENDS = {
+    'templates': TemplateGallery,
+    'flat': EmbeddingIndex,
+    'ivf': IVFIndex,
+}
+
+
+# Create an empty index for the configured (or given) backend
+def make_index(backend=None, **params):
+    return INDEX_BACKENDS[backend or INDEX_BACKEND](**params)
+
+
+# Build an index for the configured (or given) backend from parallel ids and embeddings
+def build_index(user_ids, embeddings, backend=None, **params):
+    return INDEX_BACKENDS[backend or INDEX_BACKEND].from_arrays(user_ids, embeddings, **params)
+
+
+# Build an index for the configured (or given) backend from a users_db dictionary
+def index_from_users(users_db, backend=None, **params):
+    return INDEX_BACKENDS[backend or INDEX_BACKEND].from_users(users_db, **params)
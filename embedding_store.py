@@ -0,0 +1,134 @@
+# embedding_store.py
+# Compact on-disk store for face embeddings: a raw float32 matrix plus an id sidecar
+
+import os
+import threading
+from contextlib import contextmanager
+import numpy as np
+from atomic_file import locked
+from embedding_index import EMBEDDING_DIM
+
+EMBEDDINGS_FILE = "embeddings.f32"
+IDS_FILE = "embedding_ids.txt"
+
+# The committed (ids, matrix) of a store directory, read without locking or repairing it, for
+# tools that only read someone else's storage (imports). A torn tail is ignored, not trimmed.
+def read_committed(directory, dim=EMBEDDING_DIM):
+    ids_path = os.path.join(directory, IDS_FILE)
+    embeddings_path = os.path.join(directory, EMBEDDINGS_FILE)
+    if not os.path.exists(ids_path):
+        return [], np.empty((0, dim), dtype='<f4')
+    with open(ids_path, 'rb') as f:
+        data = f.read()
+    ids = data[:data.rfind(b'\n') + 1].decode('utf-8').splitlines()
+    matrix = np.fromfile(embeddings_path, dtype='<f4', count=len(ids) * dim) if ids else np.empty(0, dtype='<f4')
+    if matrix.size < len(ids) * dim:
+        raise ValueError(f"{embeddings_path} holds {matrix.size // dim} rows but {len(ids)} ids are committed")
+    return ids, matrix.reshape(len(ids), dim)
+
+
+# Append-only store of (user_id, embedding) rows.
+# embeddings.f32 holds little-endian float32 rows of `dim` values, read through a read-only memory map;
+# embedding_ids.txt holds one id per line. A row only counts once its id line is on disk, so a crash
+# between the two writes leaves a tail that is trimmed on the next open.
+class EmbeddingStore:
+    def __init__(self, directory, dim=EMBEDDING_DIM):
+        self.directory = directory
+        self.dim = dim
+        self.row_bytes = dim * 4
+        self.embeddings_path = os.path.join(directory, EMBEDDINGS_FILE)
+        self.ids_path = os.path.join(directory, IDS_FILE)
+        # Guards this instance's view (ids, matrix) between refresh() and appends
+        self._lock = threading.Lock()
+        self._ids = []
+        self._id_set = set()
+        self._matrix = np.empty((0, dim), dtype='<f4')
+        self._ids_offset = 0
+        os.makedirs(directory, exist_ok=True)
+        with self._exclusive():
+            self._repair()
+            self._reload()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, user_id):
+        return user_id in self._id_set
+
+    # Read-only (N, dim) float32 view of the mapped file; no parsing, no copy
+    @property
+    def matrix(self):
+        return self._matrix
+
+    @property
+    def ids(self):
+        return self._ids
+
+    # Exclusive access to the store against other threads and processes (atomic_file.locked on
+    # the id sidecar), yielding the id sidecar opened for appending
+    @contextmanager
+    def _exclusive(self):
+        with self._lock, locked(self.ids_path), open(self.ids_path, 'ab') as ids_file:
+            yield ids_file
+
+    # Trim a torn tail left by a crash: partial id line, or embedding rows without a committed id
+    def _repair(self):
+        open(self.embeddings_path, 'ab').close()
+        with open(self.ids_path, 'rb+') as f:
+            data = f.read()
+            committed = data.rfind(b'\n') + 1
+            if committed != len(data):
+                f.truncate(committed)
+        n_ids = data[:committed].count(b'\n')
+        expected = n_ids * self.row_bytes
+        size = os.path.getsize(self.embeddings_path)
+        if size > expected:
+            with open(self.embeddings_path, 'rb+') as f:
+                f.truncate(expected)
+        elif size < expected:
+            raise ValueError(f"{self.embeddings_path} holds {size // self.row_bytes} rows but {n_ids} ids are committed")
+
+    # Pick up rows appended since the last read (by this or another process)
+    def _reload(self):
+        with open(self.ids_path, 'rb') as f:
+            f.seek(self._ids_offset)
+            data = f.read()
+        committed = data.rfind(b'\n') + 1
+        for line in data[:committed].decode('utf-8').splitlines():
+            self._ids.append(line)
+            self._id_set.add(line)
+        self._ids_offset += committed
+        if self._ids:
+            self._matrix = np.memmap(self.embeddings_path, dtype='<f4', mode='r', shape=(len(self._ids), self.dim))
+        else:
+            self._matrix = np.empty((0, self.dim), dtype='<f4')
+
+    def refresh(self):
+        with self._lock:
+            if os.path.getsize(self.ids_path) != self._ids_offset:
+                self._reload()
+
+    # Durably append one embedding: write + fsync the row, then commit it by appending + fsyncing its id
+    def append(self, user_id, embedding):
+        self.extend([user_id], [embedding])
+
+    # Durably append many embeddings with a single pair of fsyncs (bulk imports, synthetic galleries)
+    def extend(self, user_ids, embeddings):
+        if not user_ids:
+            return
+        if any('\n' in user_id for user_id in user_ids):
+            raise ValueError("user_id must not contain newlines")
+        matrix = np.asarray(embeddings, dtype='<f4').reshape(len(user_ids), -1)
+        if matrix.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-d embeddings, got {matrix.shape[1]}")
+        with self._exclusive() as ids_file:
+            # Another process may have appended since we last looked
+            self._reload()
+            with open(self.embeddings_path, 'ab') as f:
+                f.write(matrix.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            ids_file.write(''.join(f"{user_id}\n" for user_id in user_ids).encode('utf-8'))
+            ids_file.flush()
+            os.fsync(ids_file.fileno())
+            self._reload()
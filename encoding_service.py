@@ -0,0 +1,87 @@
+# encoding_service.py
+# Bounded process pool for face encoding, shared by every Streamlit session in the process
+
+import os
+import threading
+import multiprocessing
+from concurrent.futures import Future, InvalidStateError, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from face_pipeline import embedding_from_bytes, record_stage_timings
+
+# Worker processes (default: one per CPU core)
+ENCODING_WORKERS = int(os.environ.get("FACE_ENCODING_WORKERS", "0")) or None
+# Uploads allowed in flight (queued + running) before new ones are turned away
+ENCODING_MAX_PENDING = int(os.environ.get("FACE_ENCODING_MAX_PENDING", "16"))
+# Seconds a caller waits for its encoding
+ENCODING_TIMEOUT = float(os.environ.get("FACE_ENCODING_TIMEOUT", "30"))
+# How workers are started. Never fork: the Streamlit server is multi-threaded, and a forked
+# child can inherit locks (logging, Mongo client, dlib) held by another thread and deadlock.
+ENCODING_START_METHOD = os.environ.get("FACE_ENCODING_START_METHOD") or (
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+
+# Worker: the embedding plus its per-stage timings, which are recorded in the parent process
+# (a worker's own metrics would never be exported)
+def encode_timed(image_bytes):
+    timings = {}
+    return embedding_from_bytes(image_bytes, timings=timings), timings
+
+
+class ServiceBusy(Exception):
+    pass
+
+
+class EncodingTimeout(Exception):
+    pass
+
+
+# Encoding runs in worker processes, so it neither holds the GIL in the Streamlit server nor
+# serialises concurrent logins; throughput scales with cores. The request queue is bounded:
+# once max_pending uploads are in flight, submit() fails fast with ServiceBusy (backpressure).
+class EncodingService:
+    def __init__(self, workers=ENCODING_WORKERS, max_pending=ENCODING_MAX_PENDING, timeout=ENCODING_TIMEOUT,
+                 start_method=ENCODING_START_METHOD):
+        self.timeout = timeout
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method))
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    # Queue one image; returns a Future resolving to the embedding (or None if no face)
+    def submit(self, image_bytes):
+        if not self._slots.acquire(blocking=False):
+            raise ServiceBusy("Too many images are being processed right now")
+        try:
+            work = self._executor.submit(encode_timed, image_bytes)
+        except BaseException:
+            self._slots.release()
+            raise
+        future = Future()
+        # Cancelling the caller's future cancels the work too (which only succeeds if it hasn't started)
+        future.add_done_callback(lambda f: f.cancelled() and work.cancel())
+
+        # The slot is held until the worker actually finishes, even if the caller gave up waiting
+        def finished(work):
+            self._slots.release()
+            try:
+                if work.cancelled():
+                    future.cancel()
+                elif work.exception() is not None:
+                    future.set_exception(work.exception())
+                else:
+                    embedding, timings = work.result()
+                    record_stage_timings(timings)
+                    future.set_result(embedding)
+            except InvalidStateError:
+                pass  # the caller already cancelled
+        work.add_done_callback(finished)
+        return future
+
+    # Submit and wait for the result, up to `timeout` seconds
+    def encode(self, image_bytes, timeout=None):
+        future = self.submit(image_bytes)
+        try:
+            return future.result(timeout=self.timeout if timeout is None else timeout)
+        except FutureTimeoutError:
+            future.cancel()  # drops the result; the work itself is only cancelled if it hasn't started
+            raise EncodingTimeout("Timed out waiting for the face encoding")
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
@@ -1,25 +1,32 @@
 import streamlit as st
-import face_recognition
-import numpy as np
 import os, json
+import threading
 import base64
 from datetime import datetime
+from embedding_index import make_index, MATCH_THRESHOLD
+from face_pipeline import read_upload, embedding_from_bytes
+from recognition_cache import RecognitionCache
+from intents import match_intent
+import metrics
+from atomic_file import write_json_atomic, locked
+
+# Simple bot responses by intent (see intents.py for the keywords)
+BOT_RESPONSES = {
+    "greeting": "Hello! How can I assist you with your medical concerns today?",
+    "symptoms": "I understand you're describing symptoms. Can you tell me more about when they started and how severe they are?",
+    "appointment": "I can help you schedule an appointment. What day would work best for you?",
+    "prescription": "For prescription refills, please provide your medication name and dosage.",
+    "thanks": "You're welcome! Is there anything else I can help with?",
+    "goodbye": "Thank you for chatting. Feel free to return if you have more questions. Take care!",
+}
+FALLBACK_RESPONSE = "I'm here to help with medical questions. Can you tell me more about your concern?"
 
 # Create storage directory if it doesn't exist
 STORAGE_DIR = "user_storage"
 os.makedirs(STORAGE_DIR, exist_ok=True)
 
-# Helper function to convert image to base64
-def image_to_base64(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
-
-# Helper function to save base64 as image
-def base64_to_image(base64_str, output_path):
-    with open(output_path, "wb") as image_file:
-        image_file.write(base64.b64decode(base64_str))
-
 # Load all user data from storage
+@metrics.timed("load_all_users")
 def load_all_users():
     users = {}
     if os.path.exists(STORAGE_DIR):
@@ -31,7 +38,8 @@ def load_all_users():
     return users
 
 # Save user data to storage
-def save_user(user_id, name, embedding, image_path=None):
+@metrics.timed("save_user")
+def save_user(user_id, name, embedding, image_bytes=None):
     # Convert embedding to list for JSON serialization
     embedding_list = embedding.tolist() if hasattr(embedding, 'tolist') else embedding
     
@@ -43,20 +51,22 @@ def save_user(user_id, name, embedding, image_path=None):
         'conversations': []
     }
     
-    # If image path is provided, convert image to base64 and store it
-    if image_path and os.path.exists(image_path):
-        user_data['image_base64'] = image_to_base64(image_path)
+    # If image bytes are provided, store them as base64
+    if image_bytes:
+        user_data['image_base64'] = base64.b64encode(image_bytes).decode('utf-8')
     
-    # Save user data to JSON file
-    with open(os.path.join(STORAGE_DIR, f'{user_id}.json'), 'w') as f:
-        json.dump(user_data, f, indent=4)
+    # Save user data to JSON file (temp file + fsync + rename: never left half-written)
+    write_json_atomic(os.path.join(STORAGE_DIR, f'{user_id}.json'), user_data)
     
     return user_data
 
 # Add conversation to user's history
 def add_conversation(user_id, messages):
     user_file = os.path.join(STORAGE_DIR, f'{user_id}.json')
-    if os.path.exists(user_file):
+    if not os.path.exists(user_file):
+        return False
+    # Hold the file's write lock so concurrent sessions can't lose each other's conversations
+    with locked(user_file):
         with open(user_file, 'r') as f:
             user_data = json.load(f)
         
@@ -65,45 +75,76 @@ def add_conversation(user_id, messages):
             'messages': messages
         })
         
-        with open(user_file, 'w') as f:
-            json.dump(user_data, f, indent=4)
-
-# Extract face embedding from uploaded image
-def get_embedding(uploaded_image):
-    # Save the uploaded image temporarily
-    temp_path = os.path.join(STORAGE_DIR, 'temp_image.jpg')
-    with open(temp_path, "wb") as f:
-        f.write(uploaded_image.getbuffer())
-    
+        write_json_atomic(user_file, user_data)
+    return True
+
+# Recognition results shared by all sessions, keyed by image content
+@st.cache_resource
+def get_recognition_cache():
+    return RecognitionCache()
+
+# Extract the face embedding from an uploaded image and match it against the gallery.
+# Reruns and re-uploads of the same image skip detection and encoding via the recognition cache.
+@metrics.timed("get_embedding")
+def get_embedding(uploaded_image, users_db, index, generation):
+    # Decode straight from the upload buffer; the bytes are returned for registration
+    image_bytes = read_upload(uploaded_image)
     try:
-        image = face_recognition.load_image_file(temp_path)
-        encodings = face_recognition.face_encodings(image)
-        return encodings[0] if encodings else None, temp_path
+        emb, user_id = get_recognition_cache().recognize(
+            image_bytes, embedding_from_bytes, lambda embedding: recognize_user(embedding, users_db, index),
+            generation=generation
+        )
+        return emb, user_id, image_bytes
     except Exception as e:
         st.error(f"Error processing image: {str(e)}")
-        return None, temp_path
+        return None, None, image_bytes
 
-# Compare embeddings
-def recognize_user(embedding, users_db):
-    known_embeddings, ids = [], []
+# Build the in-memory embedding index (exact or approximate, see embedding_index.INDEX_BACKEND)
+def build_embedding_index(users_db):
+    index = make_index()
     for user_id, user_data in users_db.items():
         if 'embedding' in user_data:
-            known_embeddings.append(np.array(user_data['embedding']))
-            ids.append(user_id)
+            index.add(user_id, user_data['embedding'])
+    return index
+
+# Process-wide index shared by every session, with the user set it was built from
+@st.cache_resource
+def get_shared_gallery():
+    return {'user_ids': frozenset(), 'index': make_index(), 'generation': 0, 'lock': threading.Lock()}
+
+# Load the users (as on every rerun) and the shared index over them, with the recognition cache
+# generation the index belongs to. The index is rebuilt whenever the set of users on disk
+# changes, so faces registered by other sessions or processes are recognised instead of being
+# registered again, and every match cached against the old index becomes stale.
+def load_gallery():
+    users_db = load_all_users()
+    gallery = get_shared_gallery()
+    with gallery['lock']:
+        user_ids = frozenset(users_db)
+        if user_ids != gallery['user_ids']:
+            gallery['index'] = build_embedding_index(users_db)
+            gallery['user_ids'] = user_ids
+            get_recognition_cache().invalidate()
+            gallery['generation'] = get_recognition_cache().generation
+        return users_db, gallery['index'], gallery['generation']
 
-    if not known_embeddings:
-        return None
+# Compare embeddings
+@metrics.timed("recognize_user")
+def recognize_user(embedding, users_db, index=None):
+    if index is None:
+        index = build_embedding_index(users_db)
 
-    matches = face_recognition.compare_faces(known_embeddings, embedding)
-    dist = face_recognition.face_distance(known_embeddings, embedding)
+    if len(index) == 0:
+        return None
 
-    if True in matches:
-        match_index = np.argmin(dist)
-        return ids[match_index]
-    return None
+    user_id, _ = index.search(embedding, threshold=MATCH_THRESHOLD)
+    return user_id
 
 # ------------------- Streamlit App -------------------
 
+# Export the timing histograms if configured (FACE_METRICS_PORT / FACE_METRICS_FILE, see metrics.py)
+metrics.start_exporters()
+
 st.title("🩺 Medical Chatbot with Face Recognition")
 
 # Initialize session state for chat
@@ -114,18 +155,20 @@ if 'chat_messages' not in st.session_state:
 if 'current_user' not in st.session_state:
     st.session_state.current_user = None
 
-# Load all users
-users_db = load_all_users()
+# Load all users and the shared index over them
+users_db, embedding_index, index_generation = load_gallery()
 
 uploaded_image = st.file_uploader("Upload your face image", type=["jpg", "jpeg", "png"])
 name = st.text_input("Enter your name (if new user)")
 
 if uploaded_image:
-    emb, temp_image_path = get_embedding(uploaded_image)
+    emb, user_id, image_bytes = get_embedding(uploaded_image, users_db, embedding_index, index_generation)
+    if user_id and user_id not in users_db:
+        # Matched a user registered since this rerun loaded the directory
+        users_db, embedding_index, index_generation = load_gallery()
     if emb is None:
         st.error("No face detected in the image. Try another one.")
     else:
-        user_id = recognize_user(emb, users_db)
         if user_id:
             st.success(f"✅ Welcome back {users_db[user_id]['name']} (ID: {user_id})")
             st.session_state.current_user = user_id
@@ -139,17 +182,14 @@ if uploaded_image:
             if name:
                 new_id = f"user_{len(users_db) + 1}"
                 # Save new user
-                save_user(new_id, name, emb, temp_image_path)
+                save_user(new_id, name, emb, image_bytes)
                 st.success(f"🎉 New user registered: {name} (ID: {new_id})")
-                # Reload the database to include the new user
-                users_db = load_all_users()
+                # Reload the database to include the new user; rebuilding the shared index
+                # invalidates the recognition cache for every session
+                users_db, embedding_index, index_generation = load_gallery()
                 st.session_state.current_user = new_id
             else:
                 st.warning("Unknown user. Please enter your name to register.")
-    
-    # Clean up temporary image
-    if os.path.exists(temp_image_path):
-        os.remove(temp_image_path)
 
 # Chatbot functionality
 if st.button("Start Chatbot Conversation") and st.session_state.current_user:
@@ -172,23 +212,8 @@ if st.session_state.chat_active and st.session_state.current_user:
         # Add user message to chat
         st.session_state.chat_messages.append(("You", user_input))
         
-        # Simple bot responses based on keywords
-        user_input_lower = user_input.lower()
-        
-        if any(word in user_input_lower for word in ["hello", "hi", "hey"]):
-            bot_response = "Hello! How can I assist you with your medical concerns today?"
-        elif any(word in user_input_lower for word in ["symptom", "pain", "hurt"]):
-            bot_response = "I understand you're describing symptoms. Can you tell me more about when they started and how severe they are?"
-        elif any(word in user_input_lower for word in ["appointment", "schedule"]):
-            bot_response = "I can help you schedule an appointment. What day would work best for you?"
-        elif any(word in user_input_lower for word in ["prescription", "medication", "refill"]):
-            bot_response = "For prescription refills, please provide your medication name and dosage."
-        elif any(word in user_input_lower for word in ["thank", "thanks"]):
-            bot_response = "You're welcome! Is there anything else I can help with?"
-        elif any(word in user_input_lower for word in ["bye", "goodbye", "end"]):
-            bot_response = "Thank you for chatting. Feel free to return if you have more questions. Take care!"
-        else:
-            bot_response = "I'm here to help with medical questions. Can you tell me more about your concern?"
+        # Simple bot responses based on keywords, matched as whole words in one pass
+        bot_response = BOT_RESPONSES.get(match_intent(user_input), FALLBACK_RESPONSE)
         
         # Add bot response to chat
         st.session_state.chat_messages.append(("Bot", bot_response))
@@ -208,9 +233,4 @@ if st.session_state.current_user and st.session_state.current_user in users_db:
     if 'image_base64' in user_data:
         # Display the user's image
         st.sidebar.subheader("Your Profile Image")
-        st.sidebar.image(base64_to_image(user_data['image_base64'], os.path.join(STORAGE_DIR, "display_temp.jpg")), 
-                         use_column_width=True)
-        
-        # Clean up temporary display image
-        if os.path.exists(os.path.join(STORAGE_DIR, "display_temp.jpg")):
-            os.remove(os.path.join(STORAGE_DIR, "display_temp.jpg"))
\ No newline at end of file
+        st.sidebar.image(base64.b64decode(user_data['image_base64']), use_column_width=True)
\ No newline at end of file
@@ -1,11 +1,10 @@
 import streamlit as st
-import face_recognition
-import numpy as np
-import os, json
-from pymongo import MongoClient
-from bson import Binary
-import pickle
-from datetime import datetime
+import os
+from embedding_index import make_index, MATCH_THRESHOLD
+import mongo_storage
+from face_pipeline import read_upload, embedding_from_bytes
+from recognition_cache import RecognitionCache
+import metrics
 
 # MongoDB Atlas connection using environment variable
 def get_database():
@@ -16,92 +15,75 @@ def get_database():
         st.stop()
     
     try:
-        client = MongoClient(CONNECTION_STRING)
-        # Test the connection
-        client.admin.command('ping')
-        return client['medical_chatbot_db']
+        # Pooled client, created (and pinged) once per process
+        return mongo_storage.get_database(CONNECTION_STRING)
     except Exception as e:
         st.error(f"Failed to connect to MongoDB: {str(e)}")
         st.stop()
 
-# Load patient database from MongoDB
+# Patient cache shared by every session and rerun; refreshed incrementally from MongoDB
+@st.cache_resource
+def get_patient_cache():
+    return mongo_storage.PatientCache(get_database()[mongo_storage.PATIENTS_COLLECTION])
+
+# Recognition results shared by all sessions, keyed by image content
+@st.cache_resource
+def get_recognition_cache():
+    return RecognitionCache()
+
+# Load patient database from MongoDB (only new/changed patients are fetched)
+@metrics.timed("load_db")
 def load_db():
-    db = get_database()
-    patients_collection = db['patients']
-    patients = list(patients_collection.find({}))
-    
-    # Convert to dictionary format similar to the original JSON structure
-    patients_dict = {}
-    for patient in patients:
-        patient_id = patient['patient_id']
-        # Convert Binary embeddings back to lists
-        embeddings = [pickle.loads(emb) for emb in patient.get('embeddings', [])]
-        patients_dict[patient_id] = {
-            "name": patient['name'],
-            "embeddings": embeddings,
-            "created_at": patient.get('created_at', datetime.now())
-        }
-    
-    return patients_dict
+    cache = get_patient_cache()
+    if cache.refresh():
+        # The gallery changed, so cached matches may be wrong now
+        get_recognition_cache().invalidate()
+    return cache.snapshot()
 
 # Save patient to MongoDB
+@metrics.timed("save_to_db")
 def save_to_db(patient_id, name, embedding):
     db = get_database()
-    patients_collection = db['patients']
-    
-    # Convert embedding to Binary for storage
-    embedding_binary = Binary(pickle.dumps(embedding.tolist(), protocol=2))
-    
-    # Check if patient already exists
-    existing_patient = patients_collection.find_one({'patient_id': patient_id})
-    
-    if existing_patient:
-        # Update existing patient with new embedding
-        patients_collection.update_one(
-            {'patient_id': patient_id},
-            {'$push': {'embeddings': embedding_binary}}
-        )
-    else:
-        # Insert new patient
-        patient_data = {
-            'patient_id': patient_id,
-            'name': name,
-            'embeddings': [embedding_binary],
-            'created_at': datetime.now()
-        }
-        patients_collection.insert_one(patient_data)
-
-# Extract face embedding from uploaded image
-def get_embedding(uploaded_image):
+    mongo_storage.save_patient(db[mongo_storage.PATIENTS_COLLECTION], patient_id, name, embedding)
+
+# Extract the face embedding from an uploaded image and match it against the patients.
+# Reruns and re-uploads of the same image skip detection and encoding via the recognition cache.
+@metrics.timed("get_embedding")
+def get_embedding(uploaded_image, db):
     try:
-        image = face_recognition.load_image_file(uploaded_image)
-        encodings = face_recognition.face_encodings(image)
-        return encodings[0] if encodings else None
+        return get_recognition_cache().recognize(
+            read_upload(uploaded_image), embedding_from_bytes,
+            lambda embedding: recognize_user(embedding, db, get_patient_cache())
+        )
     except Exception as e:
         st.error(f"Error processing image: {str(e)}")
-        return None
+        return None, None
 
-# Compare embeddings
-def recognize_user(embedding, db):
-    known_embeddings, ids = [], []
+# Build the in-memory embedding index over every stored embedding of every patient
+def build_embedding_index(db):
+    index = make_index()
     for pid, pdata in db.items():
         for emb in pdata["embeddings"]:
-            known_embeddings.append(np.array(emb))
-            ids.append(pid)
+            index.add(pid, emb)
+    return index
 
-    if not known_embeddings:
-        return None
+# Compare embeddings
+@metrics.timed("recognize_user")
+def recognize_user(embedding, db, index=None):
+    if index is None:
+        index = build_embedding_index(db)
 
-    matches = face_recognition.compare_faces(known_embeddings, embedding)
-    dist = face_recognition.face_distance(known_embeddings, embedding)
+    if len(index) == 0:
+        return None
 
-    if True in matches:
-        match_index = np.argmin(dist)
-        return ids[match_index]
-    return None
+    pid, _ = index.search(embedding, threshold=MATCH_THRESHOLD)
+    return pid
 
 # ------------------- Streamlit App -------------------
 
+# Export the timing histograms if configured (FACE_METRICS_PORT / FACE_METRICS_FILE, see metrics.py)
+metrics.start_exporters()
+
 st.title("🩺 Medical Chatbot with Face Recognition")
 
 # Initialize session state for chat
@@ -121,14 +103,22 @@ uploaded_image = st.file_uploader("Upload your face image", type=["jpg", "jpeg",
 name = st.text_input("Enter your name (if new user)")
 
 if uploaded_image:
-    emb = get_embedding(uploaded_image)
+    emb, user_id = get_embedding(uploaded_image, db)
     if emb is None:
         st.error("No face detected in the image. Try another one.")
     else:
-        user_id = recognize_user(emb, db)
-        if user_id:
-            st.success(f"✅ Welcome back {db[user_id]['name']} (ID: {user_id})")
+        # The match comes from the shared index, which another session may have refreshed
+        # since `db` was copied; read the record through the cache
+        patient = get_patient_cache().get(user_id) if user_id else None
+        if patient:
+            st.success(f"✅ Welcome back {patient['name']} (ID: {user_id})")
             st.session_state.current_user = user_id
+            # Each visit can refine the patient's face templates
+            try:
+                if get_patient_cache().record_visit(user_id, emb):
+                    get_recognition_cache().invalidate()
+            except Exception as e:
+                st.warning(f"Could not update face templates: {str(e)}")
         else:
             if name:
                 new_id = f"P{len(db)+1:03d}"
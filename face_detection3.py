@@ -1,32 +1,24 @@
 import streamlit as st
-import face_recognition
-import numpy as np
 import os
 import json
 import base64
 from datetime import datetime
 from PIL import Image
 import io
-import random
 import context2  # Import our separate context file
+from embedding_index import make_index, MATCH_THRESHOLD
+from face_pipeline import read_upload, embedding_from_bytes
+import chatbot
+from response_templates import CONTEXT2_TEMPLATES
+import metrics
+from atomic_file import write_json_atomic, locked
 
 # Create storage directory if it doesn't exist
 STORAGE_DIR = "user_storage_2"
 os.makedirs(STORAGE_DIR, exist_ok=True)
 
-# Helper function to convert image to base64
-def image_to_base64(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
-
-# Helper function to save base64 as image
-def base64_to_image(base64_str, output_path):
-    # Ensure the directory exists
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    with open(output_path, "wb") as image_file:
-        image_file.write(base64.b64decode(base64_str))
-
 # Load all user data from storage
+@metrics.timed("load_all_users")
 def load_all_users():
     users = {}
     if os.path.exists(STORAGE_DIR):
@@ -41,7 +33,8 @@ def load_all_users():
     return users
 
 # Save user data to storage
-def save_user(user_id, name, embedding, image_path=None):
+@metrics.timed("save_user")
+def save_user(user_id, name, embedding, image_bytes=None):
     # Convert embedding to list for JSON serialization
     embedding_list = embedding.tolist() if hasattr(embedding, 'tolist') else embedding
     
@@ -53,20 +46,22 @@ def save_user(user_id, name, embedding, image_path=None):
         'conversations': []
     }
     
-    # If image path is provided, convert image to base64 and store it
-    if image_path and os.path.exists(image_path):
-        user_data['image_base64'] = image_to_base64(image_path)
+    # If image bytes are provided, store them as base64
+    if image_bytes:
+        user_data['image_base64'] = base64.b64encode(image_bytes).decode('utf-8')
     
-    # Save user data to JSON file
-    with open(os.path.join(STORAGE_DIR, f'{user_id}.json'), 'w') as f:
-        json.dump(user_data, f, indent=4)
+    # Save user data to JSON file (temp file + fsync + rename: never left half-written)
+    write_json_atomic(os.path.join(STORAGE_DIR, f'{user_id}.json'), user_data)
     
     return user_data
 
 # Add conversation to user's history
 def add_conversation(user_id, messages):
     user_file = os.path.join(STORAGE_DIR, f'{user_id}.json')
-    if os.path.exists(user_file):
+    if not os.path.exists(user_file):
+        return False
+    # Hold the file's write lock so concurrent sessions can't lose each other's conversations
+    with locked(user_file):
         with open(user_file, 'r') as f:
             user_data = json.load(f)
         
@@ -79,100 +74,61 @@ def add_conversation(user_id, messages):
             'messages': messages
         })
         
-        with open(user_file, 'w') as f:
-            json.dump(user_data, f, indent=4)
-        return True
-    return False
+        write_json_atomic(user_file, user_data)
+    return True
 
 # Extract face embedding from uploaded image
+@metrics.timed("get_embedding")
 def get_embedding(uploaded_image):
-    # Save the uploaded image temporarily
-    temp_path = os.path.join(STORAGE_DIR, 'temp_image.jpg')
+    # Decode straight from the upload buffer; the bytes are returned for registration
+    image_bytes = read_upload(uploaded_image)
     try:
-        with open(temp_path, "wb") as f:
-            f.write(uploaded_image.getbuffer())
-        
-        image = face_recognition.load_image_file(temp_path)
-        encodings = face_recognition.face_encodings(image)
-        
-        if encodings:
-            return encodings[0], temp_path
-        else:
-            return None, temp_path
+        return embedding_from_bytes(image_bytes), image_bytes
             
     except Exception as e:
         st.error(f"Error processing image: {str(e)}")
-        return None, temp_path
+        return None, image_bytes
 
-# Compare embeddings for face recognition
-def recognize_user(embedding, users_db):
-    known_embeddings = []
-    user_ids = []
-    
+# Build the in-memory embedding index (exact or approximate, see embedding_index.INDEX_BACKEND)
+def build_embedding_index(users_db):
+    index = make_index()
     for user_id, user_data in users_db.items():
         if 'embedding' in user_data:
             try:
-                known_embeddings.append(np.array(user_data['embedding']))
-                user_ids.append(user_id)
-            except Exception as e:
+                index.add(user_id, user_data['embedding'])
+            except (TypeError, ValueError) as e:
                 st.error(f"Error loading embedding for user {user_id}: {e}")
-                continue
+    return index
+
+# Compare embeddings for face recognition
+@metrics.timed("recognize_user")
+def recognize_user(embedding, users_db, index=None):
+    if index is None:
+        index = build_embedding_index(users_db)
 
-    if not known_embeddings:
+    if len(index) == 0:
         return None
 
     try:
-        # Compare the face embedding with all known embeddings
-        matches = face_recognition.compare_faces(known_embeddings, embedding)
-        face_distances = face_recognition.face_distance(known_embeddings, embedding)
-        
-        # Find the best match (lowest distance)
-        if True in matches:
-            best_match_index = np.argmin(face_distances)
-            if face_distances[best_match_index] < 0.6:  # Threshold for face recognition
-                return user_ids[best_match_index]
-        
-        return None
+        # Vectorized search over the index (exhaustive or IVF-probed);
+        # returns None when the best match is not under the threshold
+        user_id, _ = index.search(embedding, threshold=MATCH_THRESHOLD)
+        return user_id
         
     except Exception as e:
         st.error(f"Error in face recognition: {str(e)}")
         return None
 
 # Generate bot response based on context
+@metrics.timed("generate_bot_response")
 def generate_bot_response(user_input, user_name):
-    user_input_lower = user_input.lower()
-    
-    # Check for greetings
-    if any(word in user_input_lower for word in ["hello", "hi", "hey", "hola"]):
-        return random.choice(context2.RESPONSE_TEMPLATES["greeting"]).format(name=user_name)
-    
-    # Check for symptoms
-    elif any(word in user_input_lower for word in ["symptom", "pain", "hurt", "headache", "fever", 
-                                                 "nausea", "dizzy", "cough", "cold", "ache"]):
-        return random.choice(context2.RESPONSE_TEMPLATES["symptoms"])
-    
-    # Check for appointments
-    elif any(word in user_input_lower for word in ["appointment", "schedule", "doctor", "see a", "meeting"]):
-        return random.choice(context2.RESPONSE_TEMPLATES["appointment"])
-    
-    # Check for prescriptions
-    elif any(word in user_input_lower for word in ["prescription", "medication", "refill", "pill", "medicine", "drug"]):
-        return random.choice(context2.RESPONSE_TEMPLATES["prescription"])
-    
-    # Check for thanks
-    elif any(word in user_input_lower for word in ["thank", "thanks", "thank you", "appreciate"]):
-        return random.choice(context2.RESPONSE_TEMPLATES["thanks"]).format(name=user_name)
-    
-    # Check for goodbye
-    elif any(word in user_input_lower for word in ["bye", "goodbye", "end", "quit", "exit", "see you"]):
-        return random.choice(context2.RESPONSE_TEMPLATES["goodbye"]).format(name=user_name)
-    
-    # Fallback response
-    else:
-        return context2.RESPONSE_TEMPLATES["fallback"]
+    return chatbot.generate_bot_response(user_input, user_name, CONTEXT2_TEMPLATES)
 
 # ------------------- Streamlit App -------------------
 
+# Export the timing histograms if configured (FACE_METRICS_PORT / FACE_METRICS_FILE, see metrics.py)
+metrics.start_exporters()
+
 st.set_page_config(page_title="Medical Chatbot", page_icon="🩺", layout="wide")
 
 st.title("🩺 Medical Chatbot with Face Recognition")
@@ -188,6 +144,8 @@ if 'user_recognized' not in st.session_state:
     st.session_state.user_recognized = False
 if 'users_db' not in st.session_state:
     st.session_state.users_db = load_all_users()
+if 'embedding_index' not in st.session_state:
+    st.session_state.embedding_index = build_embedding_index(st.session_state.users_db)
 
 # Use the session state version of the DB
 users_db = st.session_state.users_db
@@ -209,12 +167,12 @@ with col1:
     
     if process_image and uploaded_image:
         with st.spinner("Processing image and recognizing face..."):
-            embedding, temp_image_path = get_embedding(uploaded_image)
+            embedding, image_bytes = get_embedding(uploaded_image)
             
             if embedding is None:
                 st.error("❌ No face detected in the image. Please try another image.")
             else:
-                user_id = recognize_user(embedding, users_db)
+                user_id = recognize_user(embedding, users_db, st.session_state.embedding_index)
                 
                 if user_id:
                     st.session_state.current_user = user_id
@@ -232,13 +190,14 @@ with col1:
                             st.warning("Could not load profile image.")
                     
                     # Start fresh conversation
-                    welcome_msg = random.choice(context2.RESPONSE_TEMPLATES["greeting"]).format(name=user_data['name'])
+                    welcome_msg = CONTEXT2_TEMPLATES.choose("greeting", user_data['name'])
                     st.session_state.chat_messages = [("Bot", welcome_msg)]
                     
                 else:
                     if name:
                         new_id = f"user_{len(users_db) + 1}_{datetime.now().strftime('%H%M%S')}"
-                        save_user(new_id, name, embedding, temp_image_path)
+                        save_user(new_id, name, embedding, image_bytes)
+                        st.session_state.embedding_index.add(new_id, embedding)
                         st.success(f"🎉 New user registered: {name}")
                         
                         # Reload the database
@@ -253,10 +212,6 @@ with col1:
                         
                     else:
                         st.warning("⚠️ Unknown user. Please enter your name to register.")
-        
-        # Clean up temporary file
-        if 'temp_image_path' in locals() and os.path.exists(temp_image_path):
-            os.remove(temp_image_path)
 
 with col2:
     st.header("Chat with MediBot")
@@ -298,7 +253,7 @@ with col2:
         
         with col_btn2:
             if st.button("🔄 New Conversation", help="Start a fresh conversation"):
-                welcome_msg = random.choice(context2.RESPONSE_TEMPLATES["greeting"]).format(name=user_data['name'])
+                welcome_msg = CONTEXT2_TEMPLATES.choose("greeting", user_data['name'])
                 st.session_state.chat_messages = [("Bot", welcome_msg)]
                 st.rerun()
     
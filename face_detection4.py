@@ -1,198 +1,178 @@
 import streamlit as st
-import face_recognition
-import numpy as np
 import os
-import json
-import base64
 from datetime import datetime
 from PIL import Image
 import io
-import random
 import context  # Import our separate context file
+from chat_backend import ChatBackend
+from face_pipeline import read_upload
+from encoding_service import EncodingService, ServiceBusy, EncodingTimeout
+from response_templates import CONTEXT_TEMPLATES
+import metrics
 
 # Create storage directory if it doesn't exist
 STORAGE_DIR = "user_storage_5"
 os.makedirs(STORAGE_DIR, exist_ok=True)
 
-# Helper function to convert image to base64
-def image_to_base64(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+# Past conversations listed per page of the sidebar history
+HISTORY_PAGE_SIZE = 10
+# Newest chat messages drawn inline; earlier ones are drawn only on request
+CHAT_WINDOW = 30
 
-# Helper function to save base64 as image
-def base64_to_image(base64_str, output_path):
-    # Ensure the directory exists
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    with open(output_path, "wb") as image_file:
-        image_file.write(base64.b64decode(base64_str))
+# The login / registration / chat rules (chat_backend.py, shared with chat_server.py) over a
+# process-wide repository: cached user metadata plus the embedding index, shared by every
+# browser session and patched in place on writes instead of being reloaded. FACE_STORAGE_BACKEND
+# picks the JSON directory or the SQLite database (see storage_backends.py).
+# Session state only keeps the current user's id and chat.
+@st.cache_resource
+def get_chat_backend():
+    return ChatBackend(
+        STORAGE_DIR,
+        on_error=lambda filename, e: st.error(f"Error decoding {filename}. Skipping.")
+    )
 
-# Load all user data from storage
+def get_user_storage():
+    return get_chat_backend().storage
+
+def get_user_repository():
+    return get_chat_backend().repository
+
+# All user metadata (images and conversations are read lazily). Served from the repository
+# cache; only users added or removed by another process are read from disk.
+@metrics.timed("load_all_users")
 def load_all_users():
-    users = {}
-    if os.path.exists(STORAGE_DIR):
-        for filename in os.listdir(STORAGE_DIR):
-            if filename.endswith('.json'):
-                user_id = filename[:-5]  # Remove .json extension
-                try:
-                    with open(os.path.join(STORAGE_DIR, filename), 'r') as f:
-                        users[user_id] = json.load(f)
-                except json.JSONDecodeError:
-                    st.error(f"Error decoding {filename}. Skipping.")
-    return users
-
-# Save user data to storage
-def save_user(user_id, name, embedding, image_path=None):
-    # Convert embedding to list for JSON serialization
-    embedding_list = embedding.tolist() if hasattr(embedding, 'tolist') else embedding
-    
-    user_data = {
-        'user_id': user_id,
-        'name': name,
-        'embedding': embedding_list,
-        'created_at': datetime.now().isoformat(),
-        'conversations': []
-    }
-    
-    # If image path is provided, convert image to base64 and store it
-    if image_path and os.path.exists(image_path):
-        user_data['image_base64'] = image_to_base64(image_path)
-    
-    # Save user data to JSON file
-    with open(os.path.join(STORAGE_DIR, f'{user_id}.json'), 'w') as f:
-        json.dump(user_data, f, indent=4)
-    
-    return user_data
+    return get_user_repository().all()
+
+# Read the user's profile image on demand
+def load_user_image(user_id):
+    return get_chat_backend().profile_image(user_id)
+
+# One page of the user's saved conversations, newest first, and whether older ones exist
+def load_history_page(user_id, page, page_size=HISTORY_PAGE_SIZE):
+    return get_user_storage().load_conversation_page(user_id, page, page_size)
 
 # Add conversation to user's history
 def add_conversation(user_id, messages):
-    user_file = os.path.join(STORAGE_DIR, f'{user_id}.json')
-    if os.path.exists(user_file):
-        with open(user_file, 'r') as f:
-            user_data = json.load(f)
-        
-        # Ensure conversations key exists
-        if 'conversations' not in user_data:
-            user_data['conversations'] = []
-        
-        user_data['conversations'].append({
-            'timestamp': datetime.now().isoformat(),
-            'messages': messages
-        })
-        
-        with open(user_file, 'w') as f:
-            json.dump(user_data, f, indent=4)
-        return True
-    return False
+    return get_chat_backend().save_conversation(user_id, messages)
+
+# Process-wide pool of encoding workers shared by all sessions
+@st.cache_resource
+def get_encoding_service():
+    return EncodingService()
 
 # Extract face embedding from uploaded image
+@metrics.timed("get_embedding")
 def get_embedding(uploaded_image):
-    # Save the uploaded image temporarily
-    temp_path = os.path.join(STORAGE_DIR, 'temp_image.jpg')
+    # Decode straight from the upload buffer; the bytes are returned for registration
+    image_bytes = read_upload(uploaded_image)
     try:
-        with open(temp_path, "wb") as f:
-            f.write(uploaded_image.getbuffer())
-        
-        image = face_recognition.load_image_file(temp_path)
-        encodings = face_recognition.face_encodings(image)
-        
-        if encodings:
-            return encodings[0], temp_path
-        else:
-            return None, temp_path
-            
+        # Encoded in a worker process; this session just waits for the result
+        return get_encoding_service().encode(image_bytes), image_bytes
+    except (ServiceBusy, EncodingTimeout):
+        st.session_state.validation_error = "⏳ The server is busy processing other images. Please try again in a moment."
     except Exception as e:
         st.error(f"Error processing image: {str(e)}")
-        return None, temp_path
+        return None, image_bytes
+    st.rerun()
 
-# Compare embeddings for face recognition
-def recognize_user(embedding, users_db):
-    known_embeddings = []
-    user_ids = []
-    
-    for user_id, user_data in users_db.items():
-        if 'embedding' in user_data:
-            try:
-                known_embeddings.append(np.array(user_data['embedding']))
-                user_ids.append(user_id)
-            except Exception as e:
-                st.error(f"Error loading embedding for user {user_id}: {e}")
-                continue
-
-    if not known_embeddings:
-        return None
-
-    try:
-        # Compare the face embedding with all known embeddings
-        matches = face_recognition.compare_faces(known_embeddings, embedding)
-        face_distances = face_recognition.face_distance(known_embeddings, embedding)
-        
-        # Find the best match (lowest distance)
-        if True in matches:
-            best_match_index = np.argmin(face_distances)
-            if face_distances[best_match_index] < 0.6:  # Threshold for face recognition
-                return user_ids[best_match_index]
-        
-        return None
-        
-    except Exception as e:
-        st.error(f"Error in face recognition: {str(e)}")
-        return None
+# Log in with a face, or register it when it is new (see ChatBackend.recognize / register)
+def login_or_register(embedding, name, image_bytes):
+    backend = get_chat_backend()
+    result = backend.recognize(embedding, name)
+    if result['status'] == 'unknown':
+        result = backend.register(embedding, name, image_bytes)
+    return result
 
-# Generate bot response based on context
-def generate_bot_response(user_input, user_name):
-    user_input_lower = user_input.lower()
-    
-    # Check for greetings
-    if any(word in user_input_lower for word in ["hello", "hi", "hey", "hola"]):
-        return random.choice(context.RESPONSE_TEMPLATES["greeting"]).format(name=user_name)
-    
-    # Check for symptoms
-    elif any(word in user_input_lower for word in ["symptom", "pain", "hurt", "headache", "fever", 
-                                                 "nausea", "dizzy", "cough", "cold", "ache"]):
-        return random.choice(context.RESPONSE_TEMPLATES["symptoms"])
-    
-    # Check for appointments
-    elif any(word in user_input_lower for word in ["appointment", "schedule", "doctor", "see a", "meeting"]):
-        return random.choice(context.RESPONSE_TEMPLATES["appointment"])
-    
-    # Check for prescriptions
-    elif any(word in user_input_lower for word in ["prescription", "medication", "refill", "pill", "medicine", "drug"]):
-        return random.choice(context.RESPONSE_TEMPLATES["prescription"])
-    
-    # Check for thanks
-    elif any(word in user_input_lower for word in ["thank", "thanks", "thank you", "appreciate"]):
-        return random.choice(context.RESPONSE_TEMPLATES["thanks"]).format(name=user_name)
-    
-    # Check for goodbye
-    elif any(word in user_input_lower for word in ["bye", "goodbye", "end", "quit", "exit", "see you"]):
-        return random.choice(context.RESPONSE_TEMPLATES["goodbye"]).format(name=user_name)
-    
-    # Fallback response
+def render_message(sender, message):
+    if sender == "Bot":
+        st.chat_message("assistant").markdown(f"**{context.BOT_NAME}:** {message}")
     else:
-        return context.RESPONSE_TEMPLATES["fallback"]
+        st.chat_message("user").markdown(f"**You:** {message}")
+
+# Chat panel. As a fragment, sending a message reruns only this function instead of the whole
+# page, and only the newest CHAT_WINDOW messages are drawn, so a chat turn costs the same however
+# long the transcript or the saved history grows.
+@st.fragment
+def chat_panel(user_id, user_name):
+    messages = st.session_state.chat_messages
+    transcript = st.container()
+    user_input = st.chat_input("Type your message here...")
+    if user_input:
+        messages.append(("You", user_input))
+        messages.append(("Bot", get_chat_backend().chat_turn(user_id, user_input)))
+
+    with transcript:
+        earlier = len(messages) - CHAT_WINDOW
+        if earlier > 0 and st.toggle(f"Show {earlier} earlier messages", key="show_earlier"):
+            for sender, message in messages[:earlier]:
+                render_message(sender, message)
+        for sender, message in messages[max(earlier, 0):]:
+            render_message(sender, message)
+
+    # Conversation management buttons
+    col_btn1, col_btn2 = st.columns(2)
+    with col_btn1:
+        if st.button("💾 Save Conversation", help="Save this conversation to your history"):
+            if add_conversation(user_id, messages):
+                st.toast("Conversation saved successfully!")
+                # The history panel lists the new conversation on the next full run
+                st.session_state.history_page = 0
+                st.rerun()
+            else:
+                st.error("Could not save conversation.")
+
+    with col_btn2:
+        if st.button("🔄 New Conversation", help="Start a fresh conversation"):
+            st.session_state.chat_messages = [("Bot", CONTEXT_TEMPLATES.choose("greeting", user_name))]
+            st.rerun(scope="fragment")
+
+# Saved conversations, one page at a time, as a fragment of its own: paging reruns only this panel
+@st.fragment
+def history_panel(user_id):
+    page = st.session_state.history_page
+    conversations, has_older = load_history_page(user_id, page)
+    if not conversations:
+        st.write("No previous conversations yet.")
+        return
+
+    labels = [datetime.fromisoformat(conv['timestamp']).strftime("%b %d, %Y %H:%M") for conv in conversations]
+    choice = st.radio("Saved conversations", range(len(conversations)), format_func=lambda i: f"🗨️ {labels[i]}",
+                      key=f"hist_choice_{page}", label_visibility="collapsed")
+    col_newer, col_open, col_older = st.columns(3)
+    if col_newer.button("◀ Newer", disabled=page == 0, key="hist_newer"):
+        st.session_state.history_page -= 1
+        st.rerun(scope="fragment")
+    if col_older.button("Older ▶", disabled=not has_older, key="hist_older"):
+        st.session_state.history_page += 1
+        st.rerun(scope="fragment")
+    if col_open.button("Open", key="hist_open"):
+        st.session_state.chat_messages = conversations[choice]['messages']
+        # The chat panel is a separate fragment, so redraw the page
+        st.rerun()
 
 # ------------------- Streamlit App -------------------
 
+# Export the timing histograms if configured (FACE_METRICS_PORT / FACE_METRICS_FILE, see metrics.py)
+metrics.start_exporters()
+
 st.set_page_config(page_title="Medical Chatbot", page_icon="🩺", layout="wide")
 
 st.title("🩺 Medical Chatbot with Face Recognition")
 
 # Initialize session state
-if 'chat_active' not in st.session_state:
-    st.session_state.chat_active = False
 if 'chat_messages' not in st.session_state:
     st.session_state.chat_messages = []
 if 'current_user' not in st.session_state:
     st.session_state.current_user = None
 if 'user_recognized' not in st.session_state:
     st.session_state.user_recognized = False
-if 'users_db' not in st.session_state:
-    st.session_state.users_db = load_all_users()
 if 'validation_error' not in st.session_state:
     st.session_state.validation_error = ""
+if 'history_page' not in st.session_state:
+    st.session_state.history_page = 0
 
-# Use the session state version of the DB
-users_db = st.session_state.users_db
+# Cached users from the repository (one stat() per rerun to pick up external changes)
+users_db = load_all_users()
 
 # Sidebar for user management
 with st.sidebar:
@@ -223,70 +203,48 @@ with col1:
             st.rerun()
         
         with st.spinner("Processing image and recognizing face..."):
-            embedding, temp_image_path = get_embedding(uploaded_image)
+            embedding, image_bytes = get_embedding(uploaded_image)
             
             if embedding is None:
                 st.session_state.validation_error = "❌ No face detected in the image. Please try another image."
                 st.rerun()
+            result = login_or_register(embedding, name, image_bytes)
+            status = result['status']
+
+            # SECURITY CHECK: If name field is filled but doesn't match the name registered for this face
+            if status == 'name_mismatch':
+                st.session_state.validation_error = f"❌ Security alert! The name '{name}' doesn't match our records for this face. Please use your registered name or leave the name field empty."
+                st.rerun()
+            if status == 'name_required':
+                st.session_state.validation_error = "⚠️ Unknown user detected. Please enter your name to register."
+                st.rerun()
+            # The name exists but the face doesn't match (potential impersonation)
+            if status == 'name_taken':
+                st.session_state.validation_error = "❌ Security alert! This name is already registered to a different person. Please use your own name or contact support."
+                st.rerun()
+            # Someone registered this face between the two checks
+            if status == 'already_registered':
+                st.session_state.validation_error = "❌ This face is already registered. Please leave the name field empty to log in."
+                st.rerun()
+
+            st.session_state.current_user = result['user_id']
+            st.session_state.user_recognized = True
+            st.session_state.chat_messages = [("Bot", result['greeting'])]
+            st.session_state.history_page = 0
+
+            if status == 'recognized':
+                st.success(f"✅ Welcome back {result['name']}!")
+
+                # Display user profile
+                image_data = load_user_image(result['user_id'])
+                if image_data:
+                    try:
+                        image = Image.open(io.BytesIO(image_data))
+                        st.image(image, caption="Your Profile Image", use_column_width=True)
+                    except:
+                        st.warning("Could not load profile image.")
             else:
-                user_id = recognize_user(embedding, users_db)
-                
-                if user_id:
-                    # Existing user detected
-                    user_data = users_db[user_id]
-                    
-                    # SECURITY CHECK: If name field is filled but doesn't match registered name
-                    if name and name.strip() and name.lower() != user_data['name'].lower():
-                        st.session_state.validation_error = f"❌ Security alert! The name '{name}' doesn't match our records for this face. Please use your registered name or leave the name field empty."
-                        st.rerun()
-                    
-                    st.session_state.current_user = user_id
-                    st.session_state.user_recognized = True
-                    st.success(f"✅ Welcome back {user_data['name']}!")
-                    
-                    # Display user profile
-                    if 'image_base64' in user_data:
-                        try:
-                            image_data = base64.b64decode(user_data['image_base64'])
-                            image = Image.open(io.BytesIO(image_data))
-                            st.image(image, caption="Your Profile Image", use_column_width=True)
-                        except:
-                            st.warning("Could not load profile image.")
-                    
-                    # Start fresh conversation
-                    welcome_msg = random.choice(context.RESPONSE_TEMPLATES["greeting"]).format(name=user_data['name'])
-                    st.session_state.chat_messages = [("Bot", welcome_msg)]
-                    
-                else:
-                    # New user detected
-                    if not name or not name.strip():
-                        st.session_state.validation_error = "⚠️ Unknown user detected. Please enter your name to register."
-                        st.rerun()
-                    
-                    # Check if name already exists but face doesn't match (potential impersonation)
-                    existing_names = [user_data['name'].lower() for user_data in users_db.values()]
-                    if name.lower() in existing_names:
-                        st.session_state.validation_error = "❌ Security alert! This name is already registered to a different person. Please use your own name or contact support."
-                        st.rerun()
-                    
-                    # Register new user
-                    new_id = f"user_{len(users_db) + 1}_{datetime.now().strftime('%H%M%S')}"
-                    save_user(new_id, name, embedding, temp_image_path)
-                    st.success(f"🎉 New user registered: {name}")
-                    
-                    # Reload the database
-                    st.session_state.users_db = load_all_users()
-                    users_db = st.session_state.users_db
-                    st.session_state.current_user = new_id
-                    st.session_state.user_recognized = True
-                    
-                    # Start welcome conversation
-                    welcome_msg = f"Hello {name}! I'm {context.BOT_NAME}, your medical assistant. How can I help you today?"
-                    st.session_state.chat_messages = [("Bot", welcome_msg)]
-        
-        # Clean up temporary file
-        if 'temp_image_path' in locals() and os.path.exists(temp_image_path):
-            os.remove(temp_image_path)
+                st.success(f"🎉 New user registered: {result['name']}")
 
 with col2:
     st.header("Chat with MediBot")
@@ -294,60 +252,14 @@ with col2:
     if st.session_state.user_recognized and st.session_state.current_user:
         user_data = users_db[st.session_state.current_user]
         
-        # Display chat messages
-        chat_container = st.container()
-        with chat_container:
-            for sender, message in st.session_state.chat_messages:
-                if sender == "Bot":
-                    st.chat_message("assistant").markdown(f"**{context.BOT_NAME}:** {message}")
-                else:
-                    st.chat_message("user").markdown(f"**You:** {message}")
-        
-        # Chat input
-        user_input = st.chat_input("Type your message here...")
-        
-        if user_input:
-            # Add user message to chat
-            st.session_state.chat_messages.append(("You", user_input))
-            
-            # Generate and add bot response
-            bot_response = generate_bot_response(user_input, user_data['name'])
-            st.session_state.chat_messages.append(("Bot", bot_response))
-            
-            st.rerun()
-        
-        # Conversation management buttons
-        col_btn1, col_btn2 = st.columns(2)
-        with col_btn1:
-            if st.button("💾 Save Conversation", help="Save this conversation to your history"):
-                if add_conversation(st.session_state.current_user, st.session_state.chat_messages):
-                    st.success("Conversation saved successfully!")
-                    st.session_state.users_db = load_all_users()
-                else:
-                    st.error("Could not save conversation.")
-        
-        with col_btn2:
-            if st.button("🔄 New Conversation", help="Start a fresh conversation"):
-                welcome_msg = random.choice(context.RESPONSE_TEMPLATES["greeting"]).format(name=user_data['name'])
-                st.session_state.chat_messages = [("Bot", welcome_msg)]
-                st.rerun()
+        chat_panel(st.session_state.current_user, user_data['name'])
     
     else:
         st.info("👆 Please upload your face image and authenticate to start chatting with MediBot.")
 
 # Display conversation history in sidebar
 if st.session_state.user_recognized and st.session_state.current_user:
-    user_data = users_db[st.session_state.current_user]
-    
     with st.sidebar:
         st.divider()
         st.subheader("Conversation History")
-        
-        if 'conversations' in user_data and user_data['conversations']:
-            for i, conv in enumerate(reversed(user_data['conversations'])):
-                date_str = datetime.fromisoformat(conv['timestamp']).strftime("%b %d, %Y %H:%M")
-                if st.button(f"🗨️ {date_str}", key=f"hist_{i}"):
-                    st.session_state.chat_messages = conv['messages']
-                    st.rerun()
-        else:
-            st.write("No previous conversations yet.")
\ No newline at end of file
+        history_panel(st.session_state.current_user)
@@ -0,0 +1,207 @@
+import streamlit as st
+import os
+import io
+import json
+from datetime import datetime
+from urllib import request as urlrequest
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode, quote
+from PIL import Image
+import context  # Import our separate context file
+from response_templates import CONTEXT_TEMPLATES
+
+# Thin Streamlit client for chat_server.py: recognition, registration, chat and history all
+# happen in the backend; this page only keeps the current user and transcript in session state.
+#
+#   python chat_server.py &
+#   streamlit run face_detection5.py
+
+BACKEND_URL = os.environ.get("CHAT_BACKEND_URL", "http://127.0.0.1:8080")
+# Seconds to wait for the backend (face encoding can take a few seconds)
+BACKEND_TIMEOUT = 60
+
+# Messages shown for login/registration outcomes reported by the backend ({name}: the name entered)
+STATUS_ERRORS = {
+    'no_face': "❌ No face detected in the image. Please try another image.",
+    'name_mismatch': "❌ Security alert! The name '{name}' doesn't match our records for this face. Please use your registered name or leave the name field empty.",
+    'name_taken': "❌ Security alert! This name is already registered to a different person. Please use your own name or contact support.",
+    'name_required': "⚠️ Unknown user detected. Please enter your name to register.",
+    'already_registered': "❌ This face is already registered. Please leave the name field empty to log in.",
+}
+
+
+class BackendError(Exception):
+    pass
+
+
+# Call the chat backend; returns the parsed JSON (or raw bytes when raw=True).
+# Per-user endpoints need the session token returned by login/registration.
+def call_backend(method, path, params=None, json_body=None, data=None, raw=False, token=None):
+    url = BACKEND_URL + path + ("?" + urlencode(params) if params else "")
+    headers = {}
+    if token:
+        headers['Authorization'] = f"Bearer {token}"
+    if json_body is not None:
+        data = json.dumps(json_body).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+    elif data is not None:
+        headers['Content-Type'] = 'application/octet-stream'
+    req = urlrequest.Request(url, data=data, headers=headers, method=method)
+    try:
+        with urlrequest.urlopen(req, timeout=BACKEND_TIMEOUT) as response:
+            body = response.read()
+    except HTTPError as e:
+        if e.code == 404 and raw:
+            return None
+        raise BackendError(e.read().decode('utf-8', 'replace') or e.reason)
+    except URLError as e:
+        raise BackendError(f"Chat backend unreachable at {BACKEND_URL}: {e.reason}")
+    return body if raw else json.loads(body)
+
+
+def login_or_register(image_bytes, name):
+    params = {'name': name} if name and name.strip() else None
+    result = call_backend('POST', '/recognize', params=params, data=image_bytes)
+    if result['status'] == 'unknown':
+        # The face is new: register it (the backend reuses the encoding it just computed)
+        result = call_backend('POST', '/register', params={'name': name or ''}, data=image_bytes)
+    return result
+
+
+def load_profile_image(user_id, token):
+    return call_backend('GET', f"/users/{quote(user_id)}/image", raw=True, token=token)
+
+
+def load_recent_conversations(user_id, token):
+    return call_backend('GET', f"/history/{quote(user_id)}", token=token)['conversations']
+
+# ------------------- Streamlit App -------------------
+
+st.set_page_config(page_title="Medical Chatbot", page_icon="🩺", layout="wide")
+
+st.title("🩺 Medical Chatbot with Face Recognition")
+
+# Initialize session state
+if 'chat_messages' not in st.session_state:
+    st.session_state.chat_messages = []
+if 'current_user' not in st.session_state:
+    st.session_state.current_user = None
+if 'current_name' not in st.session_state:
+    st.session_state.current_name = None
+if 'session_token' not in st.session_state:
+    st.session_state.session_token = None
+if 'validation_error' not in st.session_state:
+    st.session_state.validation_error = ""
+
+# Sidebar for user management
+with st.sidebar:
+    st.header("User Authentication")
+
+    uploaded_image = st.file_uploader("Upload your face image", type=["jpg", "jpeg", "png"], key="image_uploader")
+    name = st.text_input("Enter your name (if new user)", key="name_input")
+
+    process_image = st.button("Process Image & Login/Register", type="primary")
+
+    # Display validation errors
+    if st.session_state.validation_error:
+        st.error(st.session_state.validation_error)
+
+# Main content area
+col1, col2 = st.columns([1, 2])
+
+with col1:
+    st.header("Face Recognition")
+
+    if process_image:
+        st.session_state.validation_error = ""
+        if not uploaded_image:
+            st.session_state.validation_error = "❌ Please upload your face image to continue."
+            st.rerun()
+
+        with st.spinner("Processing image and recognizing face..."):
+            try:
+                result = login_or_register(uploaded_image.getvalue(), name)
+            except BackendError as e:
+                st.session_state.validation_error = f"❌ {e}"
+                st.rerun()
+
+        if result['status'] in STATUS_ERRORS:
+            st.session_state.validation_error = STATUS_ERRORS[result['status']].format(name=name)
+            st.rerun()
+
+        st.session_state.current_user = result['user_id']
+        st.session_state.current_name = result['name']
+        st.session_state.session_token = result['token']
+        st.session_state.chat_messages = [("Bot", result['greeting'])]
+        if result['status'] == 'registered':
+            st.success(f"🎉 New user registered: {result['name']}")
+        else:
+            st.success(f"✅ Welcome back {result['name']}!")
+            image_data = load_profile_image(result['user_id'], result['token'])
+            if image_data:
+                try:
+                    st.image(Image.open(io.BytesIO(image_data)), caption="Your Profile Image", use_column_width=True)
+                except Exception:
+                    st.warning("Could not load profile image.")
+
+with col2:
+    st.header("Chat with MediBot")
+
+    if st.session_state.current_user:
+        for sender, message in st.session_state.chat_messages:
+            if sender == "Bot":
+                st.chat_message("assistant").markdown(f"**{context.BOT_NAME}:** {message}")
+            else:
+                st.chat_message("user").markdown(f"**You:** {message}")
+
+        user_input = st.chat_input("Type your message here...")
+
+        if user_input:
+            st.session_state.chat_messages.append(("You", user_input))
+            try:
+                reply = call_backend('POST', '/chat', json_body={
+                    'user_id': st.session_state.current_user, 'message': user_input
+                }, token=st.session_state.session_token)['reply']
+            except BackendError as e:
+                reply = f"(MediBot is unavailable right now: {e})"
+            st.session_state.chat_messages.append(("Bot", reply))
+            st.rerun()
+
+        col_btn1, col_btn2 = st.columns(2)
+        with col_btn1:
+            if st.button("💾 Save Conversation", help="Save this conversation to your history"):
+                try:
+                    call_backend('POST', '/conversations', json_body={
+                        'user_id': st.session_state.current_user, 'messages': st.session_state.chat_messages
+                    }, token=st.session_state.session_token)
+                    st.success("Conversation saved successfully!")
+                except BackendError:
+                    st.error("Could not save conversation.")
+
+        with col_btn2:
+            if st.button("🔄 New Conversation", help="Start a fresh conversation"):
+                st.session_state.chat_messages = [("Bot", CONTEXT_TEMPLATES.choose("greeting", st.session_state.current_name))]
+                st.rerun()
+
+    else:
+        st.info("👆 Please upload your face image and authenticate to start chatting with MediBot.")
+
+# Display conversation history in sidebar
+if st.session_state.current_user:
+    with st.sidebar:
+        st.divider()
+        st.subheader("Conversation History")
+        try:
+            conversations = load_recent_conversations(st.session_state.current_user, st.session_state.session_token)
+        except BackendError as e:
+            conversations = []
+            st.warning(f"History unavailable: {e}")
+
+        if conversations:
+            for i, conv in enumerate(reversed(conversations)):
+                date_str = datetime.fromisoformat(conv['timestamp']).strftime("%b %d, %Y %H:%M")
+                if st.button(f"🗨️ {date_str}", key=f"hist_{i}"):
+                    st.session_state.chat_messages = conv['messages']
+                    st.rerun()
+        else:
+            st.write("No previous conversations yet.")
@@ -0,0 +1,264 @@
+# face_pipeline.py
+# Face decoding and encoding, done entirely in memory.
+#
+# HOG detection cost grows with pixel count, so faces are located on a downscaled copy of the
+# upload and the boxes mapped back; the encoding is then computed on a crop of the full-resolution
+# image around the face, which keeps enough detail for the 150x150 aligned chip dlib encodes.
+#
+#   python face_pipeline.py IMAGE [IMAGE ...]                 fast path vs full resolution, per image
+#   python face_pipeline.py --labelled faces_eval/ --out eval.json
+#
+# Before changing DETECTION_MAX_SIDE, ENCODING_MAX_SIDE or CROP_MARGIN, run the labelled
+# evaluation (<dir>/<person>/<image>, real photos) and keep its output with the change: the fast
+# path must not miss more faces or make more false accepts / rejects than the full-resolution one.
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import numpy as np
+from PIL import Image
+import face_recognition
+import metrics
+from embedding_index import MATCH_THRESHOLD
+
+# Longest side of the image used for face detection (0 disables downscaling)
+DETECTION_MAX_SIDE = int(os.environ.get("FACE_DETECTION_MAX_SIDE", "640"))
+# Longest side of the face crop passed to the encoder
+ENCODING_MAX_SIDE = int(os.environ.get("FACE_ENCODING_MAX_SIDE", "400"))
+# Extra context around the detected box, as a fraction of the box size, so landmarks aren't clipped
+CROP_MARGIN = 0.5
+# Largest acceptable distance between the fast-path and full-resolution encodings of the same image
+BASELINE_TOLERANCE = 0.06
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+# Raw bytes of an upload (Streamlit UploadedFile, any file-like object, or bytes)
+def read_upload(uploaded_image):
+    if isinstance(uploaded_image, (bytes, bytearray, memoryview)):
+        return bytes(uploaded_image)
+    if hasattr(uploaded_image, 'getvalue'):
+        return uploaded_image.getvalue()
+    return uploaded_image.read()
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+# Decode image bytes into an RGB PIL image without touching the filesystem.
+# Anything that isn't a readable image (unknown format, truncated, decompression bomb) raises InvalidImage.
+def decode_pil(image_bytes):
+    try:
+        return Image.open(io.BytesIO(image_bytes)).convert('RGB')
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise InvalidImage(f"Could not read the image: {e}")
+
+
+# Decode image bytes into an RGB NumPy array without touching the filesystem
+def decode_image(image_bytes):
+    return np.asarray(decode_pil(image_bytes))
+
+
+# Encoding of the first face found in the image, or None (full-resolution reference path)
+def encode_first_face(image):
+    encodings = face_recognition.face_encodings(image)
+    return encodings[0] if encodings else None
+
+
+# Face boxes (top, right, bottom, left) in full-resolution coordinates, detected on a copy
+# whose longest side is at most max_side
+def detect_faces(image, max_side=DETECTION_MAX_SIDE):
+    width, height = image.size
+    scale = 1.0
+    if max_side and max(width, height) > max_side:
+        scale = max_side / max(width, height)
+        image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.BILINEAR)
+    locations = face_recognition.face_locations(np.asarray(image))
+    return [
+        (int(top / scale), int(right / scale), int(bottom / scale), int(left / scale))
+        for top, right, bottom, left in locations
+    ]
+
+
+# Encode one face from a margin-padded crop around its box, resized to at most max_side
+def encode_face_region(image, location, max_side=ENCODING_MAX_SIDE, margin=CROP_MARGIN):
+    top, right, bottom, left = location
+    pad_y, pad_x = int((bottom - top) * margin), int((right - left) * margin)
+    crop_left, crop_top = max(0, left - pad_x), max(0, top - pad_y)
+    crop_right, crop_bottom = min(image.width, right + pad_x), min(image.height, bottom + pad_y)
+    crop = image.crop((crop_left, crop_top, crop_right, crop_bottom))
+
+    scale = 1.0
+    if max_side and max(crop.size) > max_side:
+        scale = max_side / max(crop.size)
+        crop = crop.resize((max(1, round(crop.width * scale)), max(1, round(crop.height * scale))), Image.BILINEAR)
+    box = (
+        int((top - crop_top) * scale),
+        int((right - crop_left) * scale),
+        int((bottom - crop_top) * scale),
+        int((left - crop_left) * scale),
+    )
+    return face_recognition.face_encodings(np.asarray(crop), known_face_locations=[box])[0]
+
+
+# Bytes in, 128-d face embedding (or None) out. If `timings` is a dict, the seconds spent
+# in each stage (decode, detect, encode, total) are recorded in it.
+def embedding_from_bytes(image_bytes, timings=None, detection_max_side=DETECTION_MAX_SIDE,
+                         encoding_max_side=ENCODING_MAX_SIDE):
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+
+    image = decode_pil(image_bytes)
+    decoded = time.perf_counter()
+    timings['decode'] = decoded - start
+
+    locations = detect_faces(image, detection_max_side)
+    # Small faces can vanish when downscaling; retry at full resolution before giving up
+    if not locations and detection_max_side and max(image.size) > detection_max_side:
+        locations = detect_faces(image, 0)
+    detected = time.perf_counter()
+    timings['detect'] = detected - decoded
+
+    embedding = encode_face_region(image, locations[0], encoding_max_side) if locations else None
+    finished = time.perf_counter()
+    timings['encode'] = finished - detected
+    timings['total'] = finished - start
+    record_stage_timings(timings)
+    return embedding
+
+
+# Feed per-stage timings into the get_embedding.<stage> histograms (see metrics.py)
+def record_stage_timings(timings):
+    if metrics.ENABLED:
+        for stage, seconds in timings.items():
+            metrics.observe(f"get_embedding.{stage}", seconds)
+
+
+# Run both the fast path and the full-resolution reference on the same image and report
+# the distance between their encodings plus the timings of each
+def compare_with_baseline(image_bytes):
+    fast_timings = {}
+    fast = embedding_from_bytes(image_bytes, timings=fast_timings)
+    start = time.perf_counter()
+    baseline = encode_first_face(decode_image(image_bytes))
+    baseline_seconds = time.perf_counter() - start
+    distance = None
+    if fast is not None and baseline is not None:
+        distance = float(np.linalg.norm(fast - baseline))
+    return {
+        'fast': fast,
+        'baseline': baseline,
+        'fast_timings': fast_timings,
+        'baseline_seconds': baseline_seconds,
+        'distance': distance,
+        'within_tolerance': distance is not None and distance <= BASELINE_TOLERANCE,
+    }
+
+
+# [(person, path), ...] of a labelled set laid out as <directory>/<person>/<image>
+def load_labelled_set(directory):
+    images = []
+    for person in sorted(os.listdir(directory)):
+        person_dir = os.path.join(directory, person)
+        if not os.path.isdir(person_dir):
+            continue
+        for filename in sorted(os.listdir(person_dir)):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                images.append((person, os.path.join(person_dir, filename)))
+    return images
+
+
+# Verification errors of one pipeline over every pair of images: a pair is accepted as the same
+# person when its embeddings are under `threshold` apart. Images without a face count as misses.
+def pair_errors(labels, embeddings, threshold=MATCH_THRESHOLD):
+    result = {'no_face': sum(embedding is None for embedding in embeddings),
+              'genuine_pairs': 0, 'false_rejects': 0, 'impostor_pairs': 0, 'false_accepts': 0}
+    found = [(label, embedding) for label, embedding in zip(labels, embeddings) if embedding is not None]
+    for (label_a, a), (label_b, b) in itertools.combinations(found, 2):
+        accepted = float(np.linalg.norm(np.asarray(a) - np.asarray(b))) < threshold
+        if label_a == label_b:
+            result['genuine_pairs'] += 1
+            result['false_rejects'] += not accepted
+        else:
+            result['impostor_pairs'] += 1
+            result['false_accepts'] += accepted
+    return result
+
+
+# Run compare_with_baseline over a labelled set and compare the two pipelines' recognition errors
+def evaluate_labelled(directory):
+    images = load_labelled_set(directory)
+    labels, fast, baseline, distances, fast_seconds, baseline_seconds = [], [], [], [], 0.0, 0.0
+    for person, path in images:
+        with open(path, 'rb') as f:
+            result = compare_with_baseline(f.read())
+        labels.append(person)
+        fast.append(result['fast'])
+        baseline.append(result['baseline'])
+        fast_seconds += result['fast_timings']['total']
+        baseline_seconds += result['baseline_seconds']
+        if result['distance'] is not None:
+            distances.append(result['distance'])
+    return {
+        'images': len(images),
+        'people': len(set(labels)),
+        'settings': {'detection_max_side': DETECTION_MAX_SIDE, 'encoding_max_side': ENCODING_MAX_SIDE,
+                     'crop_margin': CROP_MARGIN, 'threshold': MATCH_THRESHOLD},
+        'fast': dict(pair_errors(labels, fast), seconds=fast_seconds),
+        'baseline': dict(pair_errors(labels, baseline), seconds=baseline_seconds),
+        'max_distance': max(distances, default=None),
+        'within_tolerance': sum(distance <= BASELINE_TOLERANCE for distance in distances),
+    }
+
+
+def errors(result):
+    return result['no_face'] + result['false_rejects'] + result['false_accepts']
+
+
+# Prints per-stage timings and the fast-vs-full-resolution encoding distance for each image
+def compare_images(paths):
+    failures = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            result = compare_with_baseline(f.read())
+        stages = ", ".join(f"{stage} {seconds * 1000:.0f}ms" for stage, seconds in result['fast_timings'].items())
+        distance = "no face" if result['distance'] is None else f"{result['distance']:.4f}"
+        print(f"{path}: {stages} | full-res {result['baseline_seconds'] * 1000:.0f}ms | distance {distance}")
+        if not result['within_tolerance']:
+            failures += 1
+    print(f"{len(paths) - failures}/{len(paths)} images within tolerance {BASELINE_TOLERANCE}")
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the fast face pipeline with full-resolution encoding")
+    parser.add_argument('images', nargs='*', help="images to compare one by one")
+    parser.add_argument('--labelled', help="labelled set, <dir>/<person>/<image>: compare recognition errors")
+    parser.add_argument('--out', help="save the labelled evaluation as JSON")
+    args = parser.parse_args(argv)
+    if not args.labelled:
+        if not args.images:
+            parser.error("give images or --labelled DIR")
+        return compare_images(args.images)
+
+    report = evaluate_labelled(args.labelled)
+    print(f"{report['images']} images of {report['people']} people, settings {report['settings']}")
+    for name in ('fast', 'baseline'):
+        result = report[name]
+        print(f"  {name:<8} no face {result['no_face']:>4} | false rejects {result['false_rejects']}/{result['genuine_pairs']}"
+              f" | false accepts {result['false_accepts']}/{result['impostor_pairs']} | {result['seconds']:.1f}s")
+    print(f"  {report['within_tolerance']} encodings within {BASELINE_TOLERANCE} of full resolution"
+          f" (max distance {report['max_distance']})")
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    # Fail when the fast path recognises worse than full resolution
+    return 1 if errors(report['fast']) > errors(report['baseline']) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+# intent_classifier.py
+# Small local intent classifier: hashed word/character n-grams and a linear softmax model in NumPy
+#
+#   python intent_classifier.py train              fit on intent_examples.csv, write intent_model.npz
+#   python intent_classifier.py "message" [...]    print per-intent confidences
+#
+# Runs on CPU with no network. The model is a (features x intents) weight matrix, so a batch of
+# messages is classified with one matrix multiply; loading it is a single np.load.
+
+import os
+import csv
+import sys
+import zlib
+import threading
+import numpy as np
+from intents import WORD_PATTERN
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES_PATH = os.path.join(BASE_DIR, "intent_examples.csv")
+MODEL_PATH = os.path.join(BASE_DIR, "intent_model.npz")
+
+# Width of the hashed feature space
+N_FEATURES = 4096
+# Below this confidence the prediction shouldn't be trusted (callers fall back to keywords / the fallback reply)
+INTENT_CONFIDENCE_THRESHOLD = float(os.environ.get("INTENT_CONFIDENCE_THRESHOLD", "0.5"))
+
+_classifier = None
+_classifier_lock = threading.Lock()
+
+
+# Word unigrams and bigrams plus character trigrams (the latter cope with typos and inflections)
+def text_features(text):
+    words = WORD_PATTERN.findall(text.lower())
+    features = ['w:' + word for word in words]
+    features += ['b:' + first + ' ' + second for first, second in zip(words, words[1:])]
+    for word in words:
+        padded = f" {word} "
+        features += ['c:' + padded[i:i + 3] for i in range(len(padded) - 2)]
+    return features
+
+
+# crc32 rather than hash(): Python's string hash is salted per process, the model must not be
+def feature_index(feature, n_features=N_FEATURES):
+    return zlib.crc32(feature.encode('utf-8')) % n_features
+
+
+# (len(texts), n_features) float32 matrix of L2-normalised hashed feature counts
+def vectorize(texts, n_features=N_FEATURES):
+    rows, cols = [], []
+    for row, text in enumerate(texts):
+        indices = [feature_index(feature, n_features) for feature in text_features(text)]
+        rows.extend([row] * len(indices))
+        cols.extend(indices)
+    matrix = np.zeros((len(texts), n_features), dtype=np.float32)
+    np.add.at(matrix, (np.asarray(rows, dtype=np.intp), np.asarray(cols, dtype=np.intp)), 1.0)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def load_examples(path=EXAMPLES_PATH):
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    return [row['text'] for row in rows], [row['intent'] for row in rows]
+
+
+class IntentClassifier:
+    def __init__(self, weights, bias, labels):
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.bias = np.asarray(bias, dtype=np.float32)
+        self.labels = list(labels)
+        self.n_features = self.weights.shape[0]
+
+    # Multinomial logistic regression fitted by full-batch gradient descent with L2 regularisation
+    @classmethod
+    def train(cls, texts, labels, n_features=N_FEATURES, epochs=1000, learning_rate=4.0, l2=1e-3):
+        classes = sorted(set(labels))
+        features = vectorize(texts, n_features)
+        targets = np.zeros((len(texts), len(classes)), dtype=np.float32)
+        targets[np.arange(len(texts)), [classes.index(label) for label in labels]] = 1.0
+        weights = np.zeros((n_features, len(classes)), dtype=np.float32)
+        bias = np.zeros(len(classes), dtype=np.float32)
+        for _ in range(epochs):
+            error = (softmax(features @ weights + bias) - targets) / len(texts)
+            weights -= learning_rate * (features.T @ error + l2 * weights)
+            bias -= learning_rate * error.sum(axis=0)
+        return cls(weights, bias, classes)
+
+    @classmethod
+    def load(cls, path=MODEL_PATH):
+        with np.load(path) as model:
+            return cls(model['weights'], model['bias'], model['labels'].tolist())
+
+    def save(self, path=MODEL_PATH):
+        np.savez_compressed(path, weights=self.weights, bias=self.bias, labels=np.array(self.labels))
+
+    # (len(texts), n_intents) matrix of confidences; columns follow self.labels
+    def predict_proba(self, texts):
+        return softmax(vectorize(texts, self.n_features) @ self.weights + self.bias)
+
+    # [(intent, confidence), ...] for a batch of messages
+    def classify_batch(self, texts):
+        if not texts:
+            return []
+        probabilities = self.predict_proba(texts)
+        best = probabilities.argmax(axis=1)
+        return [(self.labels[column], float(probabilities[row, column])) for row, column in enumerate(best)]
+
+    def classify(self, text):
+        return self.classify_batch([text])[0]
+
+
+# Process-wide classifier: the bundled model, or one trained from the bundled examples if the
+# model file is missing
+def get_classifier():
+    global _classifier
+    with _classifier_lock:
+        if _classifier is None:
+            if os.path.exists(MODEL_PATH):
+                _classifier = IntentClassifier.load(MODEL_PATH)
+            else:
+                _classifier = IntentClassifier.train(*load_examples())
+        return _classifier
+
+
+# (intent, confidence) for one message
+def classify_intent(text):
+    return get_classifier().classify(text)
+
+
+def main(argv):
+    if argv[:1] == ['train']:
+        texts, labels = load_examples()
+        classifier = IntentClassifier.train(texts, labels)
+        classifier.save(MODEL_PATH)
+        accuracy = np.mean([intent == label for (intent, _), label in zip(classifier.classify_batch(texts), labels)])
+        print(f"Trained on {len(texts)} examples ({len(classifier.labels)} intents), "
+              f"training accuracy {accuracy:.1%}; saved {MODEL_PATH}")
+        return 0
+    classifier = get_classifier()
+    for text, probabilities in zip(argv, classifier.predict_proba(argv)):
+        ranked = sorted(zip(classifier.labels, probabilities), key=lambda item: -item[1])
+        print(f"{text!r}: " + ", ".join(f"{label} {p:.2f}" for label, p in ranked[:3]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
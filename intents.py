@@ -0,0 +1,114 @@
+# intents.py
+# Keyword intent matching for the chatbot, compiled once from context.INTENT_KEYWORDS
+#
+#   python intents.py    micro-benchmark against the old substring cascade
+
+import re
+import sys
+import time
+import context
+
+WORD_PATTERN = re.compile(r"[a-z0-9']+")
+# Endings stripped from a word that doesn't match as written ("pills" -> "pill", "hurting" -> "hurt")
+SUFFIXES = ('s', 'es', 'ing', 'ed')
+# Shortest stem an inflected word may be reduced to. Short keywords only match as written,
+# otherwise "his" would read as the greeting "hi" and "as" as the "a" of "see a".
+MIN_STEM_LENGTH = 4
+
+BENCHMARK_MESSAGES = [
+    "Hi, this is my first visit",
+    "I have had a headache and a fever since yesterday",
+    "Can I see a doctor on Monday morning?",
+    "I need a refill of my blood pressure pills",
+    "Thanks a lot for your help",
+    "That's all for now, goodbye",
+    "Is it normal to feel tired after lunch?",
+]
+
+
+# Keyword phrases from every intent go into one table keyed by their word tuples, each mapped to
+# the priority of the first intent that lists it. A message is tokenised once and every word
+# n-gram (up to the longest phrase) is looked up in the table, so classifying costs O(message
+# length) dictionary lookups no matter how many keywords are configured. Matching whole words
+# means "hi" no longer fires inside "this" and "end" no longer fires inside "weekend".
+class IntentMatcher:
+    def __init__(self, intent_keywords):
+        self.intents = list(intent_keywords)
+        self._phrases = {}
+        for priority, keywords in enumerate(intent_keywords.values()):
+            for keyword in keywords:
+                words = tuple(WORD_PATTERN.findall(keyword.lower()))
+                if not words:
+                    raise ValueError(f"Keyword {keyword!r} contains no words")
+                self._phrases.setdefault(words, priority)
+        self.max_words = max((len(words) for words in self._phrases), default=1)
+
+    def _lookup(self, words):
+        priority = self._phrases.get(words)
+        if priority is not None:
+            return priority
+        last = words[-1]
+        for suffix in SUFFIXES:
+            if last.endswith(suffix) and len(last) - len(suffix) >= MIN_STEM_LENGTH:
+                priority = self._phrases.get(words[:-1] + (last[:-len(suffix)],))
+                if priority is not None:
+                    return priority
+        return None
+
+    # Highest-priority intent mentioned in the text, or None
+    def match(self, text):
+        words = WORD_PATTERN.findall(text.lower())
+        best = len(self.intents)
+        for start in range(len(words)):
+            for end in range(start + 1, min(start + self.max_words, len(words)) + 1):
+                priority = self._lookup(tuple(words[start:end]))
+                if priority is not None and priority < best:
+                    best = priority
+                    if best == 0:
+                        return self.intents[0]
+        return self.intents[best] if best < len(self.intents) else None
+
+
+DEFAULT_MATCHER = IntentMatcher(context.INTENT_KEYWORDS)
+
+
+def match_intent(text):
+    return DEFAULT_MATCHER.match(text)
+
+
+# The original per-keyword substring cascade, kept for the benchmark
+def cascade_match(text, intent_keywords):
+    text = text.lower()
+    for intent, keywords in intent_keywords.items():
+        if any(word in text for word in keywords):
+            return intent
+    return None
+
+
+def timed(function, messages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for message in messages:
+            function(message)
+    return (time.perf_counter() - start) / (repeat * len(messages))
+
+
+# Per-message cost of both approaches as the keyword lists grow with synthetic (never matching) words
+def main(repeat=200):
+    print(f"{'keywords':>9} {'cascade':>12} {'matcher':>12}")
+    for extra in (0, 100, 1000, 10000):
+        keywords = {
+            intent: list(words) + [f"{intent}{i}x" for i in range(extra // len(context.INTENT_KEYWORDS))]
+            for intent, words in context.INTENT_KEYWORDS.items()
+        }
+        matcher = IntentMatcher(keywords)
+        total = sum(len(words) for words in keywords.values())
+        runs = max(1, repeat // (1 + extra // 100))
+        cascade = timed(lambda message: cascade_match(message, keywords), BENCHMARK_MESSAGES, runs)
+        compiled = timed(matcher.match, BENCHMARK_MESSAGES, repeat)
+        print(f"{total:>9} {cascade * 1e6:>10.1f}us {compiled * 1e6:>10.1f}us")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
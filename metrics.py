@@ -0,0 +1,183 @@
+# metrics.py
+# Timing spans around the hot paths, aggregated into histograms and exported in Prometheus text format
+#
+#   FACE_METRICS=1                 record spans (implied by either exporter below)
+#   FACE_METRICS_PORT=9108         serve http://127.0.0.1:9108/metrics for Prometheus to scrape
+#   FACE_METRICS_HOST=0.0.0.0      address the endpoint binds to (default: loopback only)
+#   FACE_METRICS_FILE=path.prom    rewrite this file every FACE_METRICS_FILE_INTERVAL seconds
+#                                  (e.g. for node_exporter's textfile collector on a kiosk)
+#
+# Disabled (the default), @timed returns the function itself and span() a shared no-op context,
+# so instrumented code runs exactly as before.
+
+import os
+import time
+import bisect
+import warnings
+import threading
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.environ.get("FACE_METRICS_PORT", "0"))
+METRICS_HOST = os.environ.get("FACE_METRICS_HOST", "127.0.0.1")
+METRICS_FILE = os.environ.get("FACE_METRICS_FILE", "")
+METRICS_FILE_INTERVAL = float(os.environ.get("FACE_METRICS_FILE_INTERVAL", "15"))
+ENABLED = os.environ.get("FACE_METRICS", "") not in ("", "0") or bool(METRICS_PORT or METRICS_FILE)
+
+METRIC_NAME = "medibot_span_duration_seconds"
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_NO_SPAN = nullcontext()
+_histograms = {}
+_histograms_lock = threading.Lock()
+_exporters_started = False
+_exporters_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot: above the largest bound
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        slot = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[slot] += 1
+            self.count += 1
+            self.sum += seconds
+
+    # (cumulative bucket counts, count, sum), consistent with each other
+    def snapshot(self):
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        cumulative, running = [], 0
+        for bucket_count in counts:
+            running += bucket_count
+            cumulative.append(running)
+        return cumulative, count, total
+
+
+def histogram(name):
+    hist = _histograms.get(name)
+    if hist is None:
+        with _histograms_lock:
+            hist = _histograms.setdefault(name, Histogram())
+    return hist
+
+
+# Record one duration for a span name (no-op when disabled)
+def observe(name, seconds):
+    if ENABLED:
+        histogram(name).observe(seconds)
+
+
+@contextmanager
+def _span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram(name).observe(time.perf_counter() - start)
+
+
+# with metrics.span("recognize_user"): ...
+def span(name):
+    return _span(name) if ENABLED else _NO_SPAN
+
+
+# @metrics.timed("load_db") -- records every call, including ones that raise
+def timed(name):
+    def decorate(function):
+        if not ENABLED:
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram(name).observe(time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float('inf') else repr(bound)
+
+
+def render_prometheus():
+    with _histograms_lock:
+        items = sorted(_histograms.items())
+    lines = [
+        f"# HELP {METRIC_NAME} Time spent in instrumented MediBot operations.",
+        f"# TYPE {METRIC_NAME} histogram",
+    ]
+    for name, hist in items:
+        cumulative, count, total = hist.snapshot()
+        for bound, bucket_count in zip(hist.buckets + (float('inf'),), cumulative):
+            lines.append(f'{METRIC_NAME}_bucket{{span="{name}",le="{_format_bound(bound)}"}} {bucket_count}')
+        lines.append(f'{METRIC_NAME}_count{{span="{name}"}} {count}')
+        lines.append(f'{METRIC_NAME}_sum{{span="{name}"}} {total!r}')
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _histograms_lock:
+        _histograms.clear()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_file(path):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(render_prometheus())
+    os.replace(temp_path, path)
+
+
+def _file_exporter(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_file(path)
+        except OSError:
+            pass
+
+
+# Start the configured exporters once per process (safe to call on every Streamlit rerun)
+def start_exporters(port=METRICS_PORT, path=METRICS_FILE, interval=METRICS_FILE_INTERVAL, host=METRICS_HOST):
+    global _exporters_started
+    with _exporters_lock:
+        if _exporters_started or not ENABLED:
+            return
+        _exporters_started = True
+        if port:
+            try:
+                server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            except OSError as e:
+                # e.g. another app on this kiosk already serves the port; keep recording anyway
+                warnings.warn(f"metrics: cannot serve {host}:{port}: {e}", RuntimeWarning)
+            else:
+                threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        if path:
+            threading.Thread(target=_file_exporter, args=(path, interval), name="metrics-file", daemon=True).start()
@@ -0,0 +1,234 @@
+# mongo_storage.py
+# MongoDB patient storage: one pooled client per process and an incrementally refreshed patient cache
+
+import os
+import sys
+import pickle
+import argparse
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+from bson import Binary
+from pymongo import MongoClient, ASCENDING, UpdateOne
+from embedding_index import make_index, EMBEDDING_DIM, MATCH_THRESHOLD
+
+DATABASE_NAME = 'medical_chatbot_db'
+PATIENTS_COLLECTION = 'patients'
+
+# Fields needed for recognition; everything else stays on the server
+PATIENT_PROJECTION = {'_id': 0, 'patient_id': 1, 'name': 1, 'embeddings': 1, 'created_at': 1, 'updated_at': 1}
+LOAD_BATCH_SIZE = 1000
+
+# Embedding encodings. Version 1 is the raw little-endian float32 vector, tagged with a
+# user-defined BSON binary subtype so it can be told apart from legacy pickled lists (subtype 0).
+EMBEDDING_SUBTYPE_F32_V1 = 0x80
+EMBEDDING_BYTES = EMBEDDING_DIM * 4
+MIGRATION_BATCH_SIZE = 500
+# updated_at is set by the server ($currentDate); a refresh also re-reads this much before the
+# watermark, for writes whose timestamp was assigned before, but committed after, the last read
+WATERMARK_OVERLAP = timedelta(seconds=5)
+# Watermark after a full load in which no document had updated_at yet (legacy collections):
+# every later write sets updated_at, so nothing older needs to be fetched again
+EPOCH = datetime(1970, 1, 1)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+# Process-wide MongoClient per connection string. MongoClient is thread-safe and pools its own
+# connections, so it is created (and pinged) once instead of on every call.
+# `client_factory` lets tests pass mongomock.MongoClient.
+def get_client(connection_string, client_factory=MongoClient, **client_options):
+    with _clients_lock:
+        client = _clients.get(connection_string)
+        if client is None:
+            client = client_factory(connection_string, **client_options)
+            client.admin.command('ping')
+            _clients[connection_string] = client
+        return client
+
+
+def get_database(connection_string, client_factory=MongoClient):
+    return get_client(connection_string, client_factory)[DATABASE_NAME]
+
+
+def close_clients():
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+def encode_embedding(embedding):
+    vector = np.asarray(embedding, dtype='<f4').reshape(-1)
+    return Binary(vector.tobytes(), EMBEDDING_SUBTYPE_F32_V1)
+
+
+def is_legacy_embedding(data):
+    return getattr(data, 'subtype', 0) != EMBEDDING_SUBTYPE_F32_V1
+
+
+# Decode one stored embedding; pickled lists from before the float32 format are still readable
+def decode_embedding(data):
+    if not is_legacy_embedding(data):
+        return np.frombuffer(data, dtype='<f4', count=EMBEDDING_DIM)
+    return np.asarray(pickle.loads(data), dtype=np.float32)
+
+
+# Decode stored embeddings straight into the rows of a preallocated (N, 128) float32 matrix
+def decode_embeddings(blobs):
+    matrix = np.empty((len(blobs), EMBEDDING_DIM), dtype=np.float32)
+    for row, data in enumerate(blobs):
+        if not is_legacy_embedding(data):
+            matrix[row] = np.frombuffer(data, dtype='<f4', count=EMBEDDING_DIM)
+        else:
+            matrix[row] = pickle.loads(data)
+    return matrix
+
+
+# Save patient to MongoDB (new patient, or one more embedding for an existing one)
+def save_patient(collection, patient_id, name, embedding):
+    collection.update_one(
+        {'patient_id': patient_id},
+        {
+            '$push': {'embeddings': encode_embedding(embedding)},
+            # Server clock, so the refresh watermark doesn't depend on the clients' clocks
+            '$currentDate': {'updated_at': True},
+            # patient_id comes from the filter on insert
+            '$setOnInsert': {'name': name, 'created_at': datetime.now()},
+        },
+        upsert=True,
+    )
+
+
+# Local copy of the patients collection plus an embedding index over it.
+# The first refresh streams the whole collection in batches; later refreshes only fetch documents
+# whose updated_at is at or past the watermark, so a rerun costs one indexed query instead of a full scan.
+class PatientCache:
+    def __init__(self, collection, batch_size=LOAD_BATCH_SIZE, index_factory=make_index):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.patients = {}
+        self.index = index_factory()
+        self.watermark = None
+        self._lock = threading.Lock()
+        collection.create_index([('patient_id', ASCENDING)])
+        collection.create_index([('updated_at', ASCENDING)])
+
+    def __len__(self):
+        return len(self.index)
+
+    # Pull new and changed patients; returns the ids that changed
+    def refresh(self):
+        with self._lock:
+            # Overlap with the previous read so late-committing writes aren't missed;
+            # re-applying an unchanged document is a no-op
+            if self.watermark is None:
+                query = {}
+            else:
+                query = {'updated_at': {'$gte': max(self.watermark - WATERMARK_OVERLAP, EPOCH)}}
+            cursor = self.collection.find(query, PATIENT_PROJECTION).batch_size(self.batch_size)
+            changed = []
+            watermark = self.watermark or EPOCH
+            for doc in cursor:
+                if self._apply(doc):
+                    changed.append(doc['patient_id'])
+                updated_at = doc.get('updated_at')
+                if updated_at and updated_at > watermark:
+                    watermark = updated_at
+            self.watermark = watermark
+            return changed
+
+    def _apply(self, doc):
+        patient_id = doc['patient_id']
+        stored = doc.get('embeddings', [])
+        cached = self.patients.get(patient_id)
+        known = len(cached['embeddings']) if cached else 0
+        if cached and known == len(stored):
+            return False
+        # Embeddings are only ever $push-ed, so just decode and index the new tail
+        new_embeddings = decode_embeddings(stored[known:])
+        for emb in new_embeddings:
+            self.index.add(patient_id, emb)
+        self.patients[patient_id] = {
+            "name": doc['name'],
+            "embeddings": (cached['embeddings'] if cached else []) + list(new_embeddings),
+            "created_at": doc.get('created_at', datetime.now())
+        }
+        return True
+
+    # One patient's record (None if unknown), read under the same lock as search()
+    def get(self, patient_id):
+        with self._lock:
+            return self.patients.get(patient_id)
+
+    # Consistent copy of the patient dictionary for the caller to iterate over
+    def snapshot(self):
+        with self._lock:
+            return dict(self.patients)
+
+    # Index search guarded against a concurrent refresh from another session
+    def search(self, embedding, threshold=MATCH_THRESHOLD):
+        with self._lock:
+            return self.index.search(embedding, threshold=threshold)
+
+    # Keep a recognised face as another embedding of the patient when the index wants it
+    # (confidently the same person, but different enough from the samples already kept)
+    def record_visit(self, patient_id, embedding):
+        with self._lock:
+            wants_sample = getattr(self.index, 'wants_sample', None)
+            if wants_sample is None or not wants_sample(patient_id, embedding):
+                return False
+            name = self.patients[patient_id]['name']
+        save_patient(self.collection, patient_id, name, embedding)
+        self.refresh()
+        return True
+
+
+# Rewrite every pickled embedding in the collection as float32 v1, in bulk.
+# Each update only applies if the document's embeddings are unchanged since they were read,
+# so a concurrent $push is never lost; such documents are reported and can be migrated on a rerun.
+def migrate_embeddings(collection, batch_size=MIGRATION_BATCH_SIZE):
+    migrated, skipped, pending = 0, 0, []
+
+    def flush():
+        nonlocal migrated, skipped
+        if pending:
+            result = collection.bulk_write(pending, ordered=False)
+            migrated += result.modified_count
+            skipped += len(pending) - result.modified_count
+            pending.clear()
+
+    cursor = collection.find({}, {'_id': 1, 'embeddings': 1}).batch_size(batch_size)
+    for doc in cursor:
+        stored = doc.get('embeddings', [])
+        if not any(is_legacy_embedding(emb) for emb in stored):
+            continue
+        converted = [encode_embedding(decode_embedding(emb)) for emb in stored]
+        # Bump updated_at too, so running PatientCaches re-read the document (and legacy ones get the field)
+        update = {'$set': {'embeddings': converted}, '$currentDate': {'updated_at': True}}
+        pending.append(UpdateOne({'_id': doc['_id'], 'embeddings': stored}, update))
+        if len(pending) >= batch_size:
+            flush()
+    flush()
+    return migrated, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MongoDB patient storage maintenance")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('migrate-embeddings', help="convert pickled embeddings to the float32 format")
+    args = parser.parse_args(argv)
+
+    connection_string = os.environ.get("connection_string")
+    if not connection_string:
+        sys.exit("MongoDB connection string not found in environment variables")
+
+    if args.command == 'migrate-embeddings':
+        collection = get_database(connection_string)[PATIENTS_COLLECTION]
+        migrated, skipped = migrate_embeddings(collection)
+        print(f"Migrated {migrated} patient(s); {skipped} changed during migration, rerun to convert them")
+
+
+if __name__ == "__main__":
+    main()
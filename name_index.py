@@ -0,0 +1,90 @@
+# name_index.py
+# Case- and Unicode-insensitive index of registered names, for the impersonation check and staff lookup
+
+import heapq
+import bisect
+import unicodedata
+
+# Up to this many new keys are inserted into the sorted list one by one, more are merged in bulk
+MERGE_INSORT_MAX = 16
+
+
+# Comparison key for a name: NFKC-normalised, case-folded, whitespace collapsed, so
+# "ＡＮＮ", "Ann", "ann " and "ANN" (or "Straße" and "STRASSE") are the same registered name
+def normalize_name(name):
+    folded = unicodedata.normalize('NFKC', unicodedata.normalize('NFKC', name).casefold())
+    return ' '.join(folded.split())
+
+
+def names_match(name, other):
+    return normalize_name(name) == normalize_name(other)
+
+
+# {normalised name: user ids} plus a sorted key list for prefix search. Adding a name is a
+# dict insert; new keys are merged into the sorted list lazily, on the next prefix search.
+# A key whose last user is removed leaves the sorted (or pending) list right away.
+class NameIndex:
+    def __init__(self):
+        self._ids = {}
+        self._sorted = []
+        self._pending = []
+
+    @classmethod
+    def from_users(cls, users_db):
+        index = cls()
+        for user_id, user_data in users_db.items():
+            index.add(user_id, user_data['name'])
+        return index
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, name):
+        return normalize_name(name) in self._ids
+
+    # Ids of the users registered under this name (empty if none)
+    def user_ids(self, name):
+        return set(self._ids.get(normalize_name(name), ()))
+
+    def add(self, user_id, name):
+        key = normalize_name(name)
+        user_ids = self._ids.get(key)
+        if user_ids is None:
+            user_ids = self._ids[key] = set()
+            self._pending.append(key)
+        user_ids.add(user_id)
+
+    def remove(self, user_id, name):
+        key = normalize_name(name)
+        user_ids = self._ids.get(key)
+        if user_ids is None:
+            return
+        user_ids.discard(user_id)
+        if not user_ids:
+            del self._ids[key]
+            position = bisect.bisect_left(self._sorted, key)
+            if position < len(self._sorted) and self._sorted[position] == key:
+                del self._sorted[position]
+            else:
+                self._pending.remove(key)
+
+    # Merge the new keys into the sorted list without re-sorting it: a handful are inserted in
+    # place, a larger batch (e.g. a refresh after a bulk import) is merged in one linear pass
+    def _merge_pending(self):
+        if len(self._pending) <= MERGE_INSORT_MAX:
+            for key in self._pending:
+                bisect.insort(self._sorted, key)
+        else:
+            self._sorted = list(heapq.merge(self._sorted, sorted(self._pending)))
+        self._pending = []
+
+    # Ids of users whose name starts with `prefix`, in name order (at most `limit`)
+    def search_prefix(self, prefix, limit=20):
+        self._merge_pending()
+        prefix = normalize_name(prefix)
+        found = []
+        for key in self._sorted[bisect.bisect_left(self._sorted, prefix):]:
+            if not key.startswith(prefix) or len(found) >= limit:
+                break
+            found.extend(sorted(self._ids[key]))
+        return found[:limit]
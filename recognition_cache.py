@@ -0,0 +1,113 @@
+# recognition_cache.py
+# LRU + TTL cache of face recognition results, keyed by the content hash of the uploaded image
+
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Images remembered (least recently used are evicted first)
+RECOGNITION_CACHE_SIZE = int(os.environ.get("FACE_RECOGNITION_CACHE_SIZE", "256"))
+# Seconds an entry stays valid
+RECOGNITION_CACHE_TTL = float(os.environ.get("FACE_RECOGNITION_CACHE_TTL", "600"))
+
+
+def image_key(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+# Streamlit reruns the script on every interaction while the uploader still holds the file, and
+# the same photo is often uploaded again later. Each entry keeps the image's encoding (None when
+# no face was found) and its match against the gallery. The encoding depends only on the bytes;
+# the match also depends on the gallery, so it is tagged with the generation it was computed in
+# and invalidate() (called whenever the gallery changes) makes every cached match stale at once.
+class RecognitionCache:
+    def __init__(self, max_entries=RECOGNITION_CACHE_SIZE, ttl=RECOGNITION_CACHE_TTL, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Live entry for a key (refreshing its LRU position), or None if missing or expired
+    def _entry(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry['expires'] <= self.clock():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    # (True, embedding) if the image's encoding is cached, else (False, None)
+    def embedding(self, key):
+        with self._lock:
+            entry = self._entry(key)
+            return (True, entry['embedding']) if entry else (False, None)
+
+    # (True, user_id) if the image's match against gallery `generation` (default: the current one)
+    # is cached, else (False, None)
+    def match(self, key, generation=None):
+        with self._lock:
+            entry = self._entry(key)
+            if generation is None:
+                generation = self.generation
+            if entry and entry['generation'] == generation == self.generation:
+                return True, entry['match']
+            return False, None
+
+    def put_embedding(self, key, embedding):
+        with self._lock:
+            self._entries[key] = {
+                'embedding': embedding,
+                'match': None,
+                'generation': None,
+                'expires': self.clock() + self.ttl,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    # Record a match computed against gallery `generation`; it is dropped if the gallery
+    # changed while the match was being computed
+    def put_match(self, key, user_id, generation):
+        with self._lock:
+            entry = self._entry(key)
+            if entry and generation == self.generation:
+                entry['match'] = user_id
+                entry['generation'] = generation
+
+    # The gallery changed: every cached match is stale (cached encodings stay valid)
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # (embedding, user_id) for an image, running encode(image_bytes) and match(embedding) only for
+    # whatever isn't cached. Both are (None, None) when no face is found; exceptions aren't cached.
+    # `generation` is the gallery version `match` searches (the one current when its index was
+    # built); a caller holding an older index neither reads nor stores matches of a newer one.
+    def recognize(self, image_bytes, encode, match, generation=None):
+        key = image_key(image_bytes)
+        found, embedding = self.embedding(key)
+        if not found:
+            embedding = encode(image_bytes)
+            self.put_embedding(key, embedding)
+        if embedding is None:
+            return None, None
+        if generation is None:
+            generation = self.generation
+        found, user_id = self.match(key, generation)
+        if not found:
+            user_id = match(embedding)
+            self.put_match(key, user_id, generation)
+        return embedding, user_id
@@ -0,0 +1,105 @@
+# response_templates.py
+# Validated, precompiled response templates from context.py and context2.py
+#
+# Every template is parsed once when this module is imported, so a malformed placeholder
+# (unbalanced braces, a bad conversion, an unknown field) stops the app at startup instead of
+# surfacing mid-conversation. Rendering joins precompiled segments, and each user's renderings
+# of a category are cached, so picking a reply is a cached lookup plus random.choice.
+
+import random
+import string
+import threading
+from collections import OrderedDict
+import context
+import context2
+
+# Placeholders a template may use
+TEMPLATE_FIELDS = ('name',)
+# Users whose renderings are kept per registry
+RENDER_CACHE_SIZE = 1024
+
+CONVERSIONS = {'s': str, 'r': repr, 'a': ascii}
+
+
+class TemplateError(ValueError):
+    pass
+
+
+# Split a template into (literal, field, conversion, format_spec) segments, rejecting anything
+# str.format would choke on or that refers to a field we never supply
+def compile_template(template, where, fields=TEMPLATE_FIELDS):
+    try:
+        parsed = list(string.Formatter().parse(template))
+    except ValueError as e:
+        raise TemplateError(f"{where}: malformed template {template!r}: {e}") from None
+    segments = []
+    for literal, field, format_spec, conversion in parsed:
+        if field is not None and field not in fields:
+            raise TemplateError(f"{where}: unknown placeholder {{{field}}} in {template!r} (allowed: {', '.join(fields)})")
+        if conversion is not None and conversion not in CONVERSIONS:
+            raise TemplateError(f"{where}: unknown conversion !{conversion} in {template!r}")
+        if format_spec and any(parsed_field for _, parsed_field, _, _ in string.Formatter().parse(format_spec)):
+            raise TemplateError(f"{where}: nested placeholders are not supported in {template!r}")
+        segments.append((literal, field, CONVERSIONS.get(conversion), format_spec or ''))
+    return tuple(segments)
+
+
+def render_segments(segments, values):
+    parts = []
+    for literal, field, conversion, format_spec in segments:
+        parts.append(literal)
+        if field is not None:
+            value = values[field]
+            if conversion is not None:
+                value = conversion(value)
+            parts.append(format(value, format_spec))
+    return ''.join(parts)
+
+
+# Response templates of one context module, by category. A category is a list of alternatives
+# or a single string (e.g. "fallback").
+class TemplateRegistry:
+    def __init__(self, response_templates, source, cache_size=RENDER_CACHE_SIZE):
+        self.source = source
+        self.cache_size = cache_size
+        self._compiled = {}
+        for category, templates in response_templates.items():
+            if isinstance(templates, str):
+                templates = [templates]
+            if not templates:
+                raise TemplateError(f"{source}.RESPONSE_TEMPLATES[{category!r}] is empty")
+            self._compiled[category] = tuple(
+                compile_template(template, f"{source}.RESPONSE_TEMPLATES[{category!r}][{i}]")
+                for i, template in enumerate(templates)
+            )
+        self._rendered = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, category):
+        return category in self._compiled
+
+    def categories(self):
+        return list(self._compiled)
+
+    # Every alternative of a category rendered for one user (cached per user, LRU-bounded)
+    def renderings(self, category, name=''):
+        key = (category, name)
+        with self._lock:
+            rendered = self._rendered.get(key)
+            if rendered is not None:
+                self._rendered.move_to_end(key)
+                return rendered
+        rendered = tuple(render_segments(segments, {'name': name}) for segments in self._compiled[category])
+        with self._lock:
+            self._rendered[key] = rendered
+            while len(self._rendered) > self.cache_size:
+                self._rendered.popitem(last=False)
+        return rendered
+
+    # A random alternative of the category, rendered for the user
+    def choose(self, category, name=''):
+        return random.choice(self.renderings(category, name))
+
+
+CONTEXT_TEMPLATES = TemplateRegistry(context.RESPONSE_TEMPLATES, 'context')
+CONTEXT2_TEMPLATES = TemplateRegistry(context2.RESPONSE_TEMPLATES, 'context2')
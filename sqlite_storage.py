@@ -0,0 +1,426 @@
+# sqlite_storage.py
+# Embedded SQLite user storage (one WAL-mode database file), interchangeable with JsonUserStorage
+#
+#   <storage_dir>/medibot.db
+#     users          metadata record per user; indexed by id, normalised name and change sequence
+#     embeddings     float32 BLOB rows, in insertion order (several per user with the template gallery)
+#     images         profile image bytes keyed by SHA-256
+#     conversations  one row per saved conversation, indexed by (user_id, timestamp)
+#
+# One-shot import of the JSON directories:
+#
+#   python sqlite_storage.py user_storage user_storage_2 user_storage_5 --into user_storage_5
+
+import os
+import sys
+import json
+import base64
+import sqlite3
+import hashlib
+import argparse
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+from embedding_index import EMBEDDING_DIM
+from embedding_store import read_committed
+from conversation_log import read_journal
+from name_index import normalize_name
+from user_storage import UserExists
+
+DATABASE_FILE = "medibot.db"
+# Seconds a writer waits for another process's transaction before giving up
+BUSY_TIMEOUT = 30
+# FULL: every commit is fsynced, as durable as the JSON directory's fsynced writes
+SYNCHRONOUS = "FULL"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id    TEXT PRIMARY KEY,
+    name       TEXT NOT NULL,
+    name_key   TEXT NOT NULL,
+    created_at TEXT,
+    image_hash TEXT,
+    record     TEXT NOT NULL,
+    seq        INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_name_key ON users (name_key);
+CREATE INDEX IF NOT EXISTS users_seq ON users (seq);
+CREATE TABLE IF NOT EXISTS embeddings (
+    row_id  INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    vector  BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (
+    image_hash TEXT PRIMARY KEY,
+    data       BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    conversation_id INTEGER PRIMARY KEY,
+    user_id         TEXT NOT NULL,
+    timestamp       TEXT NOT NULL,
+    messages        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS conversations_user_time ON conversations (user_id, timestamp);
+"""
+
+
+def _conversation(timestamp, messages):
+    return {'timestamp': timestamp, 'messages': json.loads(messages)}
+
+
+# Embedding rows of the database with the EmbeddingStore interface (ids, matrix, refresh, append, extend).
+# The matrix lives in a growable float32 buffer that refresh() extends with rows committed since the
+# last read, by this or another process; rows are never rewritten, so earlier views stay valid.
+class SqliteEmbeddingStore:
+    def __init__(self, storage, dim=EMBEDDING_DIM):
+        self.storage = storage
+        self.dim = dim
+        self._ids = []
+        self._id_set = set()
+        self._buffer = np.empty((0, dim), dtype='<f4')
+        self._last_row = 0
+        self.refresh()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, user_id):
+        return user_id in self._id_set
+
+    @property
+    def matrix(self):
+        return self._buffer[:len(self._ids)]
+
+    @property
+    def ids(self):
+        return self._ids
+
+    def _grow(self, n_rows):
+        needed = len(self._ids) + n_rows
+        if needed > len(self._buffer):
+            buffer = np.empty((max(needed, 2 * len(self._buffer), 1024), self.dim), dtype='<f4')
+            buffer[:len(self._ids)] = self._buffer[:len(self._ids)]
+            self._buffer = buffer
+
+    def refresh(self):
+        with self.storage._lock:
+            rows = self.storage._conn.execute(
+                "SELECT row_id, user_id, vector FROM embeddings WHERE row_id > ? ORDER BY row_id", (self._last_row,)
+            ).fetchall()
+            if not rows:
+                return
+            self._grow(len(rows))
+            start = len(self._ids)
+            self._buffer[start:start + len(rows)] = np.frombuffer(
+                b''.join(row[2] for row in rows), dtype='<f4'
+            ).reshape(len(rows), self.dim)
+            for _, user_id, _ in rows:
+                self._ids.append(user_id)
+                self._id_set.add(user_id)
+            self._last_row = rows[-1][0]
+
+    def _rows(self, user_ids, embeddings):
+        matrix = np.asarray(embeddings, dtype='<f4').reshape(len(user_ids), -1)
+        if matrix.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-d embeddings, got {matrix.shape[1]}")
+        return [(user_id, row.tobytes()) for user_id, row in zip(user_ids, matrix)]
+
+    def append(self, user_id, embedding):
+        self.extend([user_id], [embedding])
+
+    # Insert many embeddings in one transaction
+    def extend(self, user_ids, embeddings):
+        if not user_ids:
+            return
+        rows = self._rows(user_ids, embeddings)
+        with self.storage._transaction() as conn:
+            conn.executemany("INSERT INTO embeddings (user_id, vector) VALUES (?, ?)", rows)
+        self.refresh()
+
+
+class SqliteUserStorage:
+    def __init__(self, storage_dir):
+        self.storage_dir = storage_dir
+        os.makedirs(storage_dir, exist_ok=True)
+        self.path = os.path.join(storage_dir, DATABASE_FILE)
+        # One connection per storage, shared by the Streamlit sessions of this process
+        self._conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self._lock = threading.RLock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(f"PRAGMA synchronous={SYNCHRONOUS}")
+            self._conn.executescript(SCHEMA)
+        self._seen_seq = 0
+        self.embeddings = SqliteEmbeddingStore(self)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # Write transaction; BEGIN IMMEDIATE takes the database write lock up front, so concurrent
+    # writers queue (up to BUSY_TIMEOUT) instead of failing halfway
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _put_user(self, conn, user_data):
+        conn.execute(
+            "INSERT OR REPLACE INTO users (user_id, name, name_key, created_at, image_hash, record, seq) "
+            "VALUES (?, ?, ?, ?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM users))",
+            (user_data['user_id'], user_data['name'], normalize_name(user_data['name']), user_data.get('created_at'),
+             user_data.get('image_hash'), json.dumps(user_data, ensure_ascii=False))
+        )
+
+    def _put_image(self, conn, image_bytes):
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
+        conn.execute("INSERT OR IGNORE INTO images (image_hash, data) VALUES (?, ?)", (image_hash, image_bytes))
+        return image_hash
+
+    def write_user(self, user_data):
+        self.write_users([user_data])
+
+    def write_users(self, records):
+        with self._transaction() as conn:
+            for user_data in records:
+                self._put_user(conn, user_data)
+
+    # Load one user's metadata record (None if missing)
+    def load_user(self, user_id, on_error=None):
+        rows = self._query("SELECT record FROM users WHERE user_id = ?", (user_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    # Lookup by normalised name (see name_index.normalize_name); None if nobody has it
+    def find_user_by_name(self, name):
+        rows = self._query("SELECT record FROM users WHERE name_key = ? LIMIT 1", (normalize_name(name),))
+        return json.loads(rows[0][0]) if rows else None
+
+    # Load the metadata record of every user (no images, no conversations)
+    def load_all_users(self, on_error=None):
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, record, seq FROM users").fetchall()
+            self._seen_seq = max((row[2] for row in rows), default=0)
+        return {user_id: json.loads(record) for user_id, record, _ in rows}
+
+    # Users written by any process since the last call: {user_id: record}; one indexed range query
+    def changed_users(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, record, seq FROM users WHERE seq > ? ORDER BY seq", (self._seen_seq,)
+            ).fetchall()
+            if rows:
+                self._seen_seq = rows[-1][2]
+        return {user_id: json.loads(record) for user_id, record, _ in rows}
+
+    # Nothing is cached outside the database, so there is nothing to re-read
+    def rescan(self, on_error=None):
+        pass
+
+    # Save a new user (embedding, image and metadata) in a single transaction; UserExists if the id is taken
+    def save_user(self, user_id, name, embedding, image_bytes=None):
+        user_data = {
+            'user_id': user_id,
+            'name': name,
+            'created_at': datetime.now().isoformat(),
+        }
+        rows = self.embeddings._rows([user_id], [embedding])
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone():
+                raise UserExists(f"User id {user_id} is already registered")
+            conn.executemany("INSERT INTO embeddings (user_id, vector) VALUES (?, ?)", rows)
+            if image_bytes:
+                user_data['image_hash'] = self._put_image(conn, image_bytes)
+            self._put_user(conn, user_data)
+        self.embeddings.refresh()
+        return user_data
+
+    def save_image(self, image_bytes):
+        with self._transaction() as conn:
+            return self._put_image(conn, image_bytes)
+
+    def load_image(self, user_data):
+        image_hash = user_data.get('image_hash')
+        if not image_hash:
+            return None
+        rows = self._query("SELECT data FROM images WHERE image_hash = ?", (image_hash,))
+        return rows[0][0] if rows else None
+
+    # Every conversation of a user, oldest first
+    def load_conversations(self, user_id):
+        rows = self._query(
+            "SELECT timestamp, messages FROM conversations WHERE user_id = ? ORDER BY timestamp, conversation_id",
+            (user_id,)
+        )
+        return [_conversation(*row) for row in rows]
+
+    # The user's newest `limit` conversations, oldest first
+    def load_recent_conversations(self, user_id, limit):
+        if limit <= 0:
+            return []
+        rows = self._query(
+            "SELECT timestamp, messages FROM conversations WHERE user_id = ? "
+            "ORDER BY timestamp DESC, conversation_id DESC LIMIT ?", (user_id, limit)
+        )
+        return [_conversation(*row) for row in reversed(rows)]
+
+    # One page of the user's conversations, newest first, and whether older ones exist
+    def load_conversation_page(self, user_id, page, page_size):
+        rows = self._query(
+            "SELECT timestamp, messages FROM conversations WHERE user_id = ? "
+            "ORDER BY timestamp DESC, conversation_id DESC LIMIT ? OFFSET ?", (user_id, page_size + 1, page * page_size)
+        )
+        return [_conversation(*row) for row in rows[:page_size]], len(rows) > page_size
+
+    def add_conversation(self, user_id, messages):
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is None:
+                return False
+            conn.execute(
+                "INSERT INTO conversations (user_id, timestamp, messages) VALUES (?, ?, ?)",
+                (user_id, datetime.now().isoformat(), json.dumps(messages, ensure_ascii=False))
+            )
+        return True
+
+    # Seed a user's history from existing records, unless they already have one (imports)
+    def import_conversations(self, user_id, records):
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM conversations WHERE user_id = ? LIMIT 1", (user_id,)).fetchone():
+                return
+            conn.executemany(
+                "INSERT INTO conversations (user_id, timestamp, messages) VALUES (?, ?, ?)",
+                [(user_id, record['timestamp'], json.dumps(record['messages'], ensure_ascii=False)) for record in records]
+            )
+
+    # Records in the database never carry the old inline fields
+    def migrate_legacy_users(self, users_db):
+        return []
+
+    # Add fully formed users in one transaction: (user_data, embeddings, image_bytes, conversations)
+    # per user. Users whose id is already present are skipped. Returns the imported ids.
+    def import_users(self, users):
+        imported = []
+        with self._transaction() as conn:
+            for user_data, embeddings, image_bytes, conversations in users:
+                user_id = user_data['user_id']
+                if conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone():
+                    continue
+                if embeddings:
+                    conn.executemany("INSERT INTO embeddings (user_id, vector) VALUES (?, ?)",
+                                     self.embeddings._rows([user_id] * len(embeddings), embeddings))
+                if image_bytes:
+                    user_data['image_hash'] = self._put_image(conn, image_bytes)
+                conn.executemany(
+                    "INSERT INTO conversations (user_id, timestamp, messages) VALUES (?, ?, ?)",
+                    [(user_id, record['timestamp'], json.dumps(record['messages'], ensure_ascii=False))
+                     for record in conversations]
+                )
+                self._put_user(conn, user_data)
+                imported.append(user_id)
+        self.embeddings.refresh()
+        return imported
+
+
+# Read a JSON storage directory. Handles both the single-document
+# layout (inline embedding, base64 image and conversations, as in user_storage/ and
+# user_storage_2/) and the split layout of user_storage.JsonUserStorage (user_storage_5/).
+# The directory is only read: torn tails are skipped, not repaired, and nothing is migrated.
+# Yields (user_data, embeddings, image_bytes, conversations) per user.
+def read_json_directory(directory, on_error=None):
+    embeddings_dir = os.path.join(directory, "embeddings")
+    stored_embeddings = {}
+    for user_id, row in zip(*read_committed(embeddings_dir)):
+        stored_embeddings.setdefault(user_id, []).append(row)
+    conversations_dir = os.path.join(directory, "conversations")
+
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, filename), 'r') as f:
+                user_data = json.load(f)
+        except json.JSONDecodeError as e:
+            if on_error:
+                on_error(os.path.join(directory, filename), e)
+            continue
+        user_id = user_data.setdefault('user_id', filename[:-5])
+
+        embeddings = list(stored_embeddings.get(user_id, []))
+        embedding = user_data.pop('embedding', None)
+        if embedding is not None and not embeddings:
+            embeddings.append(embedding)
+
+        image_bytes = None
+        image_base64 = user_data.pop('image_base64', None)
+        if image_base64:
+            image_bytes = base64.b64decode(image_base64)
+        elif user_data.get('image_hash'):
+            image_path = os.path.join(directory, "images", user_data['image_hash'])
+            if os.path.exists(image_path):
+                with open(image_path, 'rb') as f:
+                    image_bytes = f.read()
+
+        conversations = user_data.pop('conversations', None) or []
+        conversations = conversations + read_journal(os.path.join(conversations_dir, f"{user_id}.jsonl"))
+
+        yield user_data, embeddings, image_bytes, conversations
+
+
+# One-shot import of JSON storage directories. Each person is imported once: a user whose id
+# is already in `storage` is skipped, and one whose (normalised) name is already registered
+# under another id - by an earlier directory, an earlier run or a duplicate in the same
+# directory - is not imported but reported as a conflict for someone to resolve by hand.
+# Returns {directory: (imported, skipped, conflicts)}, conflicts as (user_id, name, existing_id).
+def import_json_directories(storage, directories, on_error=None):
+    existing = storage.load_all_users()
+    owners = {normalize_name(user_data['name']): user_id for user_id, user_data in existing.items()}
+    counts = {}
+    for directory in directories:
+        users, skipped, conflicts = [], 0, []
+        for user in read_json_directory(directory, on_error=on_error):
+            user_data = user[0]
+            user_id, name = user_data['user_id'], user_data.get('name', '')
+            if user_id in existing:
+                skipped += 1
+            elif normalize_name(name) in owners:
+                conflicts.append((user_id, name, owners[normalize_name(name)]))
+            else:
+                existing[user_id] = user_data
+                owners[normalize_name(name)] = user_id
+                users.append(user)
+        imported = storage.import_users(users)
+        counts[directory] = (len(imported), skipped + len(users) - len(imported), conflicts)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import JSON user storage directories into SQLite storage")
+    parser.add_argument('directories', nargs='+', help="JSON storage directories (user_storage, user_storage_2, ...)")
+    parser.add_argument('--into', required=True, help=f"storage directory that holds (or will hold) {DATABASE_FILE}")
+    args = parser.parse_args(argv)
+
+    storage = SqliteUserStorage(args.into)
+    counts = import_json_directories(
+        storage, args.directories,
+        on_error=lambda path, e: print(f"Error decoding {path}. Skipping.", file=sys.stderr)
+    )
+    for directory, (imported, skipped, conflicts) in counts.items():
+        print(f"{directory}: {imported} user(s) imported, {skipped} already present, {len(conflicts)} name conflict(s)")
+        for user_id, name, existing_id in conflicts:
+            print(f"{directory}: {user_id} not imported, the name {name!r} is already registered to {existing_id}",
+                  file=sys.stderr)
+    storage.close()
+
+
+if __name__ == "__main__":
+    main()
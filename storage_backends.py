@@ -0,0 +1,31 @@
+# storage_backends.py
+# Choice of user storage engine ("json" = JsonUserStorage directory, "sqlite" = SqliteUserStorage)
+#
+# Both are opened from a storage directory and offer the interface UserRepository, ChatBackend
+# and the apps rely on:
+#
+#   load_all_users(on_error) -> {user_id: metadata}     changed_users() -> {user_id: metadata or None}
+#   load_user(user_id)       find_user_by_name(name)    rescan(on_error)
+#   save_user(user_id, name, embedding, image_bytes)    write_user(user_data)    write_users(records)
+#     (save_user raises user_storage.UserExists for an id that is already registered)
+#   save_image(image_bytes) -> image_hash               load_image(user_data) -> bytes or None
+#   add_conversation(user_id, messages)                 import_conversations(user_id, records)
+#   load_conversations(user_id)                         load_recent_conversations(user_id, limit)
+#   load_conversation_page(user_id, page, page_size) -> (newest-first conversations, has_older)
+#   migrate_legacy_users(users_db)
+#   embeddings    ids, matrix, refresh(), append(user_id, embedding), extend(user_ids, embeddings)
+
+import os
+from user_storage import JsonUserStorage
+from sqlite_storage import SqliteUserStorage
+
+STORAGE_BACKEND = os.environ.get("FACE_STORAGE_BACKEND", "json")
+
+STORAGE_BACKENDS = {
+    "json": JsonUserStorage,
+    "sqlite": SqliteUserStorage,
+}
+
+
+def open_storage(storage_dir, backend=None):
+    return STORAGE_BACKENDS[backend or STORAGE_BACKEND](storage_dir)
@@ -0,0 +1,13 @@
+# Tests import the top-level modules of the repository directly
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# Synthetic 128-d face encoding: the same seed is the same photo, different seeds are
+# different people (about 1.0 apart, well past MATCH_THRESHOLD). A plain function rather
+# than a fixture so helpers that run in child processes can use it too.
+def face(seed):
+    return np.random.default_rng(seed).normal(0, 0.09, 128).astype(np.float32)
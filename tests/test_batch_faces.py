@@ -0,0 +1,31 @@
+import pytest
+
+pytest.importorskip("face_recognition")
+import batch_faces
+from user_storage import JsonUserStorage
+from user_repository import UserRepository
+from conftest import face
+
+
+# Stands in for the process pool: photo N of a test is face N
+def fake_encode_files(paths, workers=None):
+    for seed, path in enumerate(paths, 1):
+        yield path, face(seed), None
+
+
+def test_enroll_refuses_names_that_are_already_taken(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_faces, 'encode_files', fake_encode_files)
+    photos = tmp_path / 'photos'
+    photos.mkdir()
+    paths = []
+    for filename in ('ann.jpg', 'bob.jpg', 'bob-2.jpg', 'carl.jpg'):
+        (photos / filename).write_bytes(b"jpeg")
+        paths.append(str(photos / filename))
+    repository = UserRepository(JsonUserStorage(str(tmp_path / 'storage')))
+    repository.insert('user_ann', "ANN", face(5))
+
+    rows = batch_faces.enroll(repository, paths, names={'bob-2.jpg': "bob", 'carl.jpg': " ann "})
+
+    assert [row['status'] for row in rows] == ['name_taken', 'enrolled', 'name_taken', 'name_taken']
+    assert rows[2]['name'] == "bob"
+    assert sorted(user['name'] for user in repository.all().values()) == ["ANN", "Bob"]
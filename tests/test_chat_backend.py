@@ -0,0 +1,35 @@
+import pytest
+from chat_backend import ChatBackend
+from conftest import face
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return ChatBackend(str(tmp_path))
+
+
+def test_register_then_recognize(backend):
+    registered = backend.register(face(1), "Ann")
+    assert registered['status'] == 'registered'
+    recognized = backend.recognize(face(1))
+    assert recognized['status'] == 'recognized'
+    assert recognized['user_id'] == registered['user_id']
+
+
+def test_login_rules(backend):
+    backend.register(face(1), "Ann")
+    assert backend.recognize(face(2))['status'] == 'unknown'
+    assert backend.recognize(face(1), "Bob")['status'] == 'name_mismatch'
+    # Same name, written differently
+    assert backend.recognize(face(1), " ANN ")['status'] == 'recognized'
+    assert backend.register(face(2), "")['status'] == 'name_required'
+    assert backend.register(face(2), "ann")['status'] == 'name_taken'
+    assert backend.register(face(1), "Carol")['status'] == 'already_registered'
+
+
+def test_chat_turn_and_history(backend):
+    user_id = backend.register(face(1), "Ann")['user_id']
+    assert backend.chat_turn(user_id, "hello")
+    assert backend.chat_turn("nobody", "hello") is None
+    assert backend.save_conversation(user_id, [("You", "hello"), ("Bot", "hi")])
+    assert [conv['messages'] for conv in backend.history(user_id)] == [[["You", "hello"], ["Bot", "hi"]]]
@@ -0,0 +1,128 @@
+import asyncio
+from concurrent.futures import Future
+import pytest
+
+pytest.importorskip("aiohttp")
+pytest.importorskip("face_recognition")
+from aiohttp.test_utils import TestClient, TestServer
+import chat_server
+from face_pipeline import InvalidImage
+from conftest import face
+
+
+# Stands in for the worker pool: b"face-N" is a distinct face, b"broken" an undecodable upload
+class FakeEncoder:
+    timeout = 5
+
+    def submit(self, image_bytes):
+        future = Future()
+        if image_bytes == b"broken":
+            future.set_exception(InvalidImage("Could not read the image"))
+        else:
+            seed = int(image_bytes.split(b"-")[1])
+            future.set_result(face(seed))
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+def run(tmp_path, scenario):
+    async def main():
+        app = chat_server.create_app(str(tmp_path), encoder=FakeEncoder())
+        async with TestClient(TestServer(app)) as client:
+            await scenario(client)
+    asyncio.run(main())
+
+
+async def login(client, seed, name):
+    response = await client.post("/register", params={'name': name}, data=f"face-{seed}".encode())
+    return await response.json()
+
+
+def bearer(token):
+    return {'Authorization': f"Bearer {token}"}
+
+
+def test_per_user_endpoints_require_the_users_own_token(tmp_path):
+    async def scenario(client):
+        ann = await login(client, 1, "Ann")
+        bob = await login(client, 2, "Bob")
+        assert ann['status'] == bob['status'] == 'registered'
+
+        history = f"/history/{ann['user_id']}"
+        assert (await client.get(history)).status == 401
+        assert (await client.get(history, headers=bearer("made-up"))).status == 401
+        assert (await client.get(history, headers=bearer(bob['token']))).status == 403
+        assert (await client.get(history, headers=bearer(ann['token']))).status == 200
+
+        image = f"/users/{ann['user_id']}/image"
+        assert (await client.get(image, headers=bearer(bob['token']))).status == 403
+
+        turn = {'user_id': ann['user_id'], 'message': "hello"}
+        assert (await client.post("/chat", json=turn)).status == 401
+        assert (await client.post("/chat", json=turn, headers=bearer(bob['token']))).status == 403
+        assert (await client.post("/chat", json=turn, headers=bearer(ann['token']))).status == 200
+
+        saved = {'user_id': ann['user_id'], 'messages': [["You", "hello"]]}
+        assert (await client.post("/conversations", json=saved, headers=bearer(bob['token']))).status == 403
+        assert (await client.post("/conversations", json=saved, headers=bearer(ann['token']))).status == 201
+
+        recognized = await (await client.post("/recognize", data=b"face-1")).json()
+        assert recognized['status'] == 'recognized' and recognized['token'] != ann['token']
+    run(tmp_path, scenario)
+
+
+def test_websocket_requires_token(tmp_path):
+    async def scenario(client):
+        ann = await login(client, 1, "Ann")
+        response = await client.get("/ws/chat", params={'user_id': ann['user_id']})
+        assert response.status == 401
+        socket = await client.ws_connect("/ws/chat", params={'user_id': ann['user_id'], 'token': ann['token']})
+        await socket.send_str("hello")
+        assert 'reply' in await socket.receive_json()
+        await socket.close()
+    run(tmp_path, scenario)
+
+
+def test_undecodable_image_is_a_bad_request(tmp_path):
+    async def scenario(client):
+        assert (await client.post("/recognize", data=b"broken")).status == 400
+        assert (await client.post("/register", params={'name': "Ann"}, data=b"broken")).status == 400
+    run(tmp_path, scenario)
+
+
+def test_malformed_bodies_are_bad_requests(tmp_path):
+    async def scenario(client):
+        ann = await login(client, 1, "Ann")
+        headers = bearer(ann['token'])
+        for body in ([ann['user_id'], "hello"], "hello", 42, None):
+            assert (await client.post("/chat", json=body, headers=headers)).status == 400
+        for message in (42, None, ["hello"], {'text': "hello"}):
+            turn = {'user_id': ann['user_id'], 'message': message}
+            assert (await client.post("/chat", json=turn, headers=headers)).status == 400
+        for messages in ("hello", [["You"]], [["You", 42]], [{'You': "hello"}], [["You", "hi", "extra"]]):
+            saved = {'user_id': ann['user_id'], 'messages': messages}
+            assert (await client.post("/conversations", json=saved, headers=headers)).status == 400
+        history = await (await client.get(f"/history/{ann['user_id']}", headers=headers)).json()
+        assert history['conversations'] == []
+    run(tmp_path, scenario)
+
+
+def test_expired_sessions_are_rejected():
+    now = [0.0]
+    sessions = chat_server.SessionStore(ttl=10, clock=lambda: now[0])
+    token = sessions.create("user_1")
+    assert sessions.user_id(token) == "user_1"
+    now[0] = 11
+    assert sessions.user_id(token) is None
+
+
+def test_unmatched_paths_share_one_metrics_label(tmp_path):
+    async def scenario(client):
+        for path in ("/nope", "/wp-admin", "/random/123"):
+            assert (await client.get(path)).status == 404
+        summary = await (await client.get("/metrics")).json()
+        assert summary[chat_server.UNMATCHED_ENDPOINT]['count'] == 3
+        assert not any('/nope' in endpoint or '/wp-admin' in endpoint for endpoint in summary)
+    run(tmp_path, scenario)
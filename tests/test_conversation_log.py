@@ -0,0 +1,59 @@
+import threading
+import conversation_log
+from conversation_log import ConversationLog
+
+
+def test_compact_drops_torn_tail(tmp_path):
+    log = ConversationLog(str(tmp_path))
+    log.append('u1', {'n': 1})
+    log.append('u1', {'n': 2})
+    with open(log.path('u1'), 'ab') as f:
+        f.write(b'{"n": 3, "mess')  # crash mid-append
+    assert log.compact('u1') == 1
+    assert log.read_all('u1') == [{'n': 1}, {'n': 2}]
+    assert log.compact('u1') == 0
+
+
+def test_compact_leaves_clean_journals_alone(tmp_path):
+    log = ConversationLog(str(tmp_path))
+    log.append('u1', {'n': 1})
+    inode = (tmp_path / 'u1.jsonl').stat().st_ino
+    assert log.compact_all() == {}
+    assert (tmp_path / 'u1.jsonl').stat().st_ino == inode
+
+
+def test_cli_compacts_directories(tmp_path, capsys):
+    (tmp_path / 'u1.jsonl').write_bytes(b'{"n": 1}\nnot json\n')
+    conversation_log.main(['compact', str(tmp_path)])
+    assert "1 journal(s) compacted, 1 line(s) dropped" in capsys.readouterr().out
+    assert ConversationLog(str(tmp_path)).read_all('u1') == [{'n': 1}]
+
+
+def test_import_waits_for_concurrent_appends(tmp_path):
+    log = ConversationLog(str(tmp_path))
+    history = [{'n': i} for i in range(100)]
+    threads = [threading.Thread(target=log.import_records, args=('u1', history))]
+    threads += [threading.Thread(target=log.append, args=('u1', {'new': i})) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    records = log.read_all('u1')
+    # Every append survives; the import either seeded the journal first or saw it non-empty
+    assert sum('new' in record for record in records) == 20
+    assert len(records) in (20, 120)
+
+
+def test_appends_during_compaction_survive(tmp_path):
+    log = ConversationLog(str(tmp_path))
+    with open(log.path('u1'), 'wb') as f:
+        f.write(b'{"old": 0}\nnot json\n')
+    threads = [threading.Thread(target=log.compact, args=('u1',)) for _ in range(5)]
+    threads += [threading.Thread(target=log.append, args=('u1', {'new': i})) for i in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    records = log.read_all('u1')
+    assert sum('new' in record for record in records) == 50
+    assert {'old': 0} in records
@@ -0,0 +1,80 @@
+import numpy as np
+from embedding_index import EmbeddingIndex, IVFIndex, TemplateGallery, MATCH_THRESHOLD
+
+DIM = 128
+
+
+# Users with 1-5 photos each (~0.3 apart), plus one query per user near a random one of them
+def gallery(n_users, seed=0):
+    rng = np.random.default_rng(seed)
+    people = rng.normal(0, 0.09, (n_users, DIM)).astype(np.float32)
+    user_ids, embeddings, queries = [], [], []
+    for i, person in enumerate(people):
+        photos = person + rng.normal(0, 0.027, (rng.integers(1, 6), DIM)).astype(np.float32)
+        user_ids += [f"user_{i}"] * len(photos)
+        embeddings.extend(photos)
+        queries.append(photos[rng.integers(len(photos))] + rng.normal(0, 0.02, DIM).astype(np.float32))
+    strangers = rng.normal(0, 0.09, (100, DIM)).astype(np.float32)
+    return user_ids, np.array(embeddings), np.array(queries), strangers
+
+
+def agreement(index, reference, queries):
+    found = [user_id for user_id, _ in index.search_batch(queries)]
+    expected = [user_id for user_id, _ in reference.search_batch(queries)]
+    return np.mean([a == b for a, b in zip(found, expected)])
+
+
+def test_template_gallery_matches_flat_search():
+    user_ids, embeddings, queries, strangers = gallery(1000)
+    flat = EmbeddingIndex.from_arrays(user_ids, embeddings)
+    templates = TemplateGallery.from_arrays(user_ids, embeddings)
+    assert agreement(templates, flat, queries) >= 0.99
+    assert all(user_id is None for user_id, _ in templates.search_batch(strangers))
+    # One query at a time takes the same path as the batch
+    assert [templates.search(query)[0] for query in queries[:50]] == [r[0] for r in templates.search_batch(queries[:50])]
+
+
+def test_template_gallery_recheck_finds_non_medoid_samples():
+    rng = np.random.default_rng(1)
+    person = rng.normal(0, 0.09, DIM).astype(np.float32)
+    # An outlying photo close to the query, whose summaries (centroid, medoid) are past the threshold
+    outlier = person + 0.5 * rng.standard_normal(DIM).astype(np.float32) / np.sqrt(DIM)
+    photos = [person, person + rng.normal(0, 0.01, DIM).astype(np.float32), outlier]
+    templates = TemplateGallery.from_arrays(["ann"] * 3, photos)
+    query = outlier + 0.3 * (outlier - person) / np.linalg.norm(outlier - person)
+    summary_distance = templates.summaries.distances(query).min()
+    assert MATCH_THRESHOLD < summary_distance < MATCH_THRESHOLD + templates.recheck_margin
+    assert EmbeddingIndex.from_arrays(["ann"] * 3, photos).search(query)[0] == "ann"
+    assert templates.search(query)[0] == "ann"
+
+
+def test_ivf_recall_against_flat_search():
+    user_ids, embeddings, queries, strangers = gallery(3000, seed=2)
+    flat = EmbeddingIndex.from_arrays(user_ids, embeddings)
+    ivf = IVFIndex.from_arrays(user_ids, embeddings, n_lists=64, n_probe=8, min_train_size=0,
+                               exhaustive_on_miss=False)
+    assert ivf.is_trained
+    assert agreement(ivf, flat, queries) >= 0.95
+    # With the exhaustive fallback (the default) a miss is always confirmed by a full scan
+    confirmed = IVFIndex.from_arrays(user_ids, embeddings, n_lists=64, n_probe=8, min_train_size=0)
+    assert agreement(confirmed, flat, np.vstack([queries, strangers])) == 1.0
+
+
+def test_template_gallery_over_ivf_summaries():
+    user_ids, embeddings, queries, strangers = gallery(3000, seed=3)
+    flat = EmbeddingIndex.from_arrays(user_ids, embeddings)
+    templates = TemplateGallery.from_arrays(user_ids, embeddings, summary_backend='ivf',
+                                            n_lists=64, n_probe=8, min_train_size=0)
+    assert isinstance(templates.summaries, IVFIndex)
+    assert agreement(templates, flat, queries) >= 0.95
+    assert all(user_id is None for user_id, _ in templates.search_batch(strangers))
+
+
+def test_ivf_set_row_moves_the_row_to_its_new_partition():
+    user_ids, embeddings, _, _ = gallery(500, seed=4)
+    ivf = IVFIndex.from_arrays(user_ids, embeddings, n_lists=16, n_probe=1, min_train_size=0,
+                               exhaustive_on_miss=False)
+    moved = embeddings[-1] + 0.5
+    ivf.set_row(0, moved)
+    assert ivf.search(moved)[0] == user_ids[0]
+    assert sum(len(rows) for rows in ivf._lists) == len(ivf)
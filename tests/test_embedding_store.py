@@ -0,0 +1,41 @@
+import os
+import numpy as np
+import pytest
+from embedding_store import EmbeddingStore, EMBEDDINGS_FILE, IDS_FILE
+from conftest import face
+
+
+def test_reopen_trims_rows_without_a_committed_id(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    store.extend(['u1', 'u2'], [face(1), face(2)])
+    # Crash after the row was written but before its id was
+    with open(tmp_path / EMBEDDINGS_FILE, 'ab') as f:
+        f.write(face(3).tobytes())
+
+    reopened = EmbeddingStore(str(tmp_path))
+    assert reopened.ids == ['u1', 'u2']
+    assert os.path.getsize(tmp_path / EMBEDDINGS_FILE) == 2 * 128 * 4
+    np.testing.assert_array_equal(reopened.matrix[1], face(2))
+
+
+def test_reopen_trims_a_partial_id_line(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    store.append('u1', face(1))
+    with open(tmp_path / EMBEDDINGS_FILE, 'ab') as f:
+        f.write(face(2).tobytes()[:100])  # torn row
+    with open(tmp_path / IDS_FILE, 'ab') as f:
+        f.write(b'u2')  # torn id line
+
+    reopened = EmbeddingStore(str(tmp_path))
+    assert reopened.ids == ['u1']
+    reopened.append('u3', face(3))
+    assert EmbeddingStore(str(tmp_path)).ids == ['u1', 'u3']
+    np.testing.assert_array_equal(EmbeddingStore(str(tmp_path)).matrix[1], face(3))
+
+
+def test_missing_rows_for_committed_ids_are_an_error(tmp_path):
+    EmbeddingStore(str(tmp_path)).extend(['u1', 'u2'], [face(1), face(2)])
+    with open(tmp_path / EMBEDDINGS_FILE, 'rb+') as f:
+        f.truncate(128 * 4)
+    with pytest.raises(ValueError):
+        EmbeddingStore(str(tmp_path))
@@ -0,0 +1,68 @@
+import multiprocessing
+from concurrent.futures import Future
+import numpy as np
+import pytest
+
+pytest.importorskip("face_recognition")
+import encoding_service
+from encoding_service import EncodingService, EncodingTimeout, ServiceBusy
+from face_pipeline import InvalidImage
+
+
+# Stands in for the process pool: work starts at once and runs until the test finishes it
+class ManualExecutor:
+    def __init__(self):
+        self.work = []
+
+    def submit(self, fn, *args):
+        work = Future()
+        work.set_running_or_notify_cancel()
+        self.work.append(work)
+        return work
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+def manual_service(**params):
+    service = EncodingService(workers=1, **params)
+    service._executor.shutdown()
+    service._executor = ManualExecutor()
+    return service
+
+
+def test_submit_fails_fast_once_max_pending_are_in_flight():
+    service = manual_service(max_pending=2)
+    first = service.submit(b"one")
+    service.submit(b"two")
+    with pytest.raises(ServiceBusy):
+        service.submit(b"three")
+
+    embedding = np.zeros(128, dtype=np.float32)
+    service._executor.work[0].set_result((embedding, {}))
+    assert first.result(timeout=0) is embedding
+    service.submit(b"three")
+
+
+def test_encode_times_out_but_keeps_the_slot_until_the_worker_finishes():
+    service = manual_service(max_pending=1, timeout=0.05)
+    with pytest.raises(EncodingTimeout):
+        service.encode(b"slow")
+    # The worker is still busy with the abandoned image
+    with pytest.raises(ServiceBusy):
+        service.submit(b"next")
+    service._executor.work[0].set_result((None, {}))
+    service.submit(b"next")
+
+
+def test_workers_start_without_fork():
+    assert encoding_service.ENCODING_START_METHOD != 'fork'
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        assert encoding_service.ENCODING_START_METHOD == 'forkserver'
+    service = EncodingService(workers=1, timeout=60)
+    try:
+        # The worker decodes the upload itself and its error comes back to the caller
+        with pytest.raises(InvalidImage):
+            service.encode(b"not an image")
+    finally:
+        service.shutdown()
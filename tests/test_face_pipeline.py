@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("face_recognition")
+from face_pipeline import load_labelled_set, pair_errors
+
+
+def test_load_labelled_set(tmp_path):
+    for path in ("ann/1.jpg", "ann/2.png", "bob/1.jpeg", "bob/notes.txt"):
+        (tmp_path / path).parent.mkdir(exist_ok=True)
+        (tmp_path / path).write_bytes(b"")
+    (tmp_path / "README").write_text("")
+    assert [person for person, _ in load_labelled_set(str(tmp_path))] == ["ann", "ann", "bob"]
+
+
+def test_pair_errors():
+    ann, bob = np.zeros(128), np.full(128, 0.1)
+    labels = ["ann", "ann", "bob", "bob"]
+    embeddings = [ann, ann + 0.001, bob, None]
+    assert pair_errors(labels, embeddings, threshold=0.6) == {
+        'no_face': 1, 'genuine_pairs': 1, 'false_rejects': 0, 'impostor_pairs': 2, 'false_accepts': 0,
+    }
+    # Everyone looks the same at a huge threshold
+    assert pair_errors(labels, embeddings, threshold=10)['false_accepts'] == 2
@@ -0,0 +1,38 @@
+import pytest
+from intents import IntentMatcher, match_intent
+
+
+@pytest.mark.parametrize("message", [
+    "His fever is high",
+    "Can you check his prescription",
+    "I need to see a doctor about his meds",
+])
+def test_pronoun_his_is_not_a_greeting(message):
+    assert match_intent(message) != "greeting"
+
+
+@pytest.mark.parametrize("message, intent", [
+    ("His fever is high", "symptoms"),
+    ("Can you check his prescription", "prescription"),
+    ("I need to see a doctor about his meds", "appointment"),
+    ("Hi there", "greeting"),
+    ("this weekend", None),
+])
+def test_whole_word_matching(message, intent):
+    assert match_intent(message) == intent
+
+
+@pytest.mark.parametrize("message, intent", [
+    ("I ran out of my pills", "prescription"),
+    ("My back is hurting", "symptoms"),
+    ("I get headaches every morning", "symptoms"),
+])
+def test_inflected_keywords(message, intent):
+    assert match_intent(message) == intent
+
+
+def test_short_keywords_match_only_as_written():
+    matcher = IntentMatcher({"greeting": ["hi"], "appointment": ["see a"]})
+    assert matcher.match("hi") == "greeting"
+    assert matcher.match("his") is None
+    assert matcher.match("see as well") is None
@@ -0,0 +1,79 @@
+import pickle
+import pytest
+from bson import Binary
+import mongo_storage
+from conftest import face
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient().db.patients
+
+
+def record_queries(collection):
+    queries = []
+    find = collection.find
+
+    def recording_find(query, *args, **kwargs):
+        queries.append(query)
+        return find(query, *args, **kwargs)
+
+    collection.find = recording_find
+    return queries
+
+
+def test_save_patient_uses_server_timestamp(collection):
+    mongo_storage.save_patient(collection, 'p1', "Ann", face(1))
+    assert collection.find_one({'patient_id': 'p1'})['updated_at'] is not None
+
+
+def test_legacy_documents_are_not_rescanned(collection):
+    # Written before updated_at existed
+    collection.insert_one({'patient_id': 'old', 'name': "Old", 'embeddings': [mongo_storage.encode_embedding(face(1))]})
+    cache = mongo_storage.PatientCache(collection)
+    assert cache.refresh() == ['old']
+
+    queries = record_queries(collection)
+    assert cache.refresh() == []
+    assert 'updated_at' in queries[-1]
+
+    mongo_storage.save_patient(collection, 'new', "New", face(2))
+    assert cache.refresh() == ['new']
+    assert 'updated_at' in queries[-1]
+    assert set(cache.patients) == {'old', 'new'}
+
+
+def test_refresh_picks_up_new_samples_of_known_patients(collection):
+    mongo_storage.save_patient(collection, 'p1', "Ann", face(1))
+    cache = mongo_storage.PatientCache(collection)
+    cache.refresh()
+    mongo_storage.save_patient(collection, 'p1', "Ann", face(2))
+    assert cache.refresh() == ['p1']
+    assert len(cache.get('p1')['embeddings']) == 2
+    assert cache.refresh() == []
+
+
+# mongomock's bulk_write doesn't accept the UpdateOne of recent pymongo versions
+def apply_one_by_one(collection):
+    class Result:
+        modified_count = 0
+
+    def bulk_write(requests, ordered=True):
+        result = Result()
+        for request in requests:
+            result.modified_count += collection.update_one(request._filter, request._doc).modified_count
+        return result
+
+    collection.bulk_write = bulk_write
+
+
+def test_migrate_embeddings_backfills_updated_at(collection):
+    apply_one_by_one(collection)
+    legacy = Binary(pickle.dumps(face(1).tolist()))
+    collection.insert_one({'patient_id': 'old', 'name': "Old", 'embeddings': [legacy]})
+    assert mongo_storage.migrate_embeddings(collection) == (1, 0)
+    doc = collection.find_one({'patient_id': 'old'})
+    assert not mongo_storage.is_legacy_embedding(doc['embeddings'][0])
+    assert doc['updated_at'] is not None
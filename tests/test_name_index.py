@@ -0,0 +1,61 @@
+from name_index import NameIndex, names_match
+
+
+def test_names_match_across_case_width_and_spacing():
+    assert names_match("Ann  Lee", " ann lee ")
+    assert names_match("ＡＮＮ", "ann")
+    assert names_match("Straße", "STRASSE")
+    assert not names_match("Ann", "Anne")
+
+
+def test_search_prefix_in_name_order():
+    index = NameIndex.from_users({
+        'u1': {'name': "Carla"}, 'u2': {'name': "Bob"}, 'u3': {'name': "carl"}, 'u4': {'name': "Ann"},
+    })
+    assert index.search_prefix("CAR") == ['u3', 'u1']
+    assert index.search_prefix("") == ['u4', 'u2', 'u3', 'u1']
+    assert index.search_prefix("", limit=2) == ['u4', 'u2']
+    assert index.search_prefix("zed") == []
+
+
+def test_names_added_after_a_search_are_merged_in():
+    index = NameIndex()
+    index.add('u1', "Bob")
+    assert index.search_prefix("") == ['u1']
+    index.add('u2', "Ann")
+    index.add('u3', "Cid")
+    index.add('u4', "Ann")  # same name, second user
+    assert index.search_prefix("") == ['u2', 'u4', 'u1', 'u3']
+    assert "ANN" in index and len(index) == 3
+
+
+def test_removed_names_disappear():
+    index = NameIndex()
+    index.add('u1', "Ann")
+    index.add('u2', "Ann")
+    index.add('u3', "Bob")
+    assert index.search_prefix("") == ['u1', 'u2', 'u3']
+    index.remove('u1', "ann")
+    assert index.user_ids("Ann") == {'u2'}
+    index.remove('u2', "Ann")
+    assert "Ann" not in index
+    assert index.search_prefix("") == ['u3']
+    # Removing a name that was never merged, and re-adding a removed one
+    index.add('u4', "Dee")
+    index.remove('u4', "Dee")
+    index.add('u1', "Ann")
+    assert index.search_prefix("") == ['u1', 'u3']
+    index.remove('u9', "Nobody")
+
+
+def test_bulk_additions_merge_into_the_sorted_keys():
+    index = NameIndex()
+    names = [f"patient {i:03d}" for i in range(200)]
+    for i, name in enumerate(names[::2]):
+        index.add(f"even_{i}", name)
+    index.search_prefix("")
+    for i, name in enumerate(names[1::2]):
+        index.add(f"odd_{i}", name)
+    index.remove('even_0', names[0])
+    assert len(index.search_prefix("", limit=1000)) == 199
+    assert index._sorted == names[1:]
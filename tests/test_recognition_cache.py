@@ -0,0 +1,56 @@
+from recognition_cache import RecognitionCache, image_key
+
+
+class Calls:
+    def __init__(self, result):
+        self.result = result
+        self.count = 0
+
+    def __call__(self, arg):
+        self.count += 1
+        return self.result
+
+
+def test_entries_expire_after_the_ttl():
+    now = [0.0]
+    cache = RecognitionCache(ttl=10, clock=lambda: now[0])
+    encode, match = Calls("embedding"), Calls('user_1')
+    assert cache.recognize(b"photo", encode, match) == ("embedding", 'user_1')
+    now[0] = 9
+    assert cache.recognize(b"photo", encode, match) == ("embedding", 'user_1')
+    assert (encode.count, match.count) == (1, 1)
+    now[0] = 19
+    cache.recognize(b"photo", encode, match)
+    assert (encode.count, match.count) == (2, 2)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = RecognitionCache(max_entries=2)
+    for photo in (b"a", b"b"):
+        cache.put_embedding(image_key(photo), photo)
+    assert cache.embedding(image_key(b"a")) == (True, b"a")  # "a" is now the most recent
+    cache.put_embedding(image_key(b"c"), b"c")
+    assert len(cache) == 2
+    assert cache.embedding(image_key(b"b")) == (False, None)
+    assert cache.embedding(image_key(b"a")) == (True, b"a")
+
+
+def test_gallery_changes_invalidate_matches_but_not_encodings():
+    cache = RecognitionCache()
+    encode, match = Calls("embedding"), Calls(None)
+    assert cache.recognize(b"photo", encode, match) == ("embedding", None)
+    cache.invalidate()  # someone registered
+    match.result = 'user_1'
+    assert cache.recognize(b"photo", encode, match) == ("embedding", 'user_1')
+    assert (encode.count, match.count) == (1, 2)
+
+
+def test_match_from_an_older_gallery_is_not_stored():
+    cache = RecognitionCache()
+    key = image_key(b"photo")
+    cache.put_embedding(key, "embedding")
+    generation = cache.generation
+    cache.invalidate()  # the gallery changed while the match was computed
+    cache.put_match(key, 'user_1', generation)
+    assert cache.match(key) == (False, None)
+    assert cache.match(key, generation) == (False, None)
@@ -0,0 +1,31 @@
+import pytest
+from response_templates import CONTEXT_TEMPLATES, CONTEXT2_TEMPLATES, TemplateError, TemplateRegistry
+
+
+@pytest.mark.parametrize('template', [
+    "Hello {name",
+    "Hello name}!",
+    "Hello {user}!",
+    "Hello {0}!",
+    "Hello {name!x}!",
+    "Hello {name:{width}}!",
+])
+def test_bad_placeholders_fail_when_the_registry_is_built(template):
+    with pytest.raises(TemplateError, match=r"test\.RESPONSE_TEMPLATES\['greeting'\]\[1\]"):
+        TemplateRegistry({'greeting': ["Hi {name}!", template]}, 'test')
+
+
+def test_empty_category_is_rejected():
+    with pytest.raises(TemplateError):
+        TemplateRegistry({'greeting': []}, 'test')
+
+
+def test_rendering_matches_str_format():
+    registry = TemplateRegistry({'greeting': ["Hi {name}, {{literal}} {name!r:>8}"], 'fallback': "Sorry {name}."}, 'test')
+    assert registry.renderings('greeting', "Ann") == ("Hi {name}, {{literal}} {name!r:>8}".format(name="Ann"),)
+    assert registry.choose('fallback', "Ann") == "Sorry Ann."
+
+
+def test_shipped_templates_compile():
+    assert "greeting" in CONTEXT_TEMPLATES
+    assert CONTEXT2_TEMPLATES.categories()
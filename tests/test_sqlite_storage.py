@@ -0,0 +1,109 @@
+import os
+import base64
+import json
+import sqlite_storage
+from sqlite_storage import SqliteUserStorage, import_json_directories
+from user_repository import UserRepository
+from user_storage import JsonUserStorage
+from conftest import face
+
+
+# user_storage_5-style directory: split records, image store, journals, binary embeddings
+def split_directory(path):
+    storage = JsonUserStorage(str(path))
+    storage.save_user('user_1', "Ann", face(1), b"ann-photo")
+    storage.save_user('user_2', "Bob", face(2))
+    storage.embeddings.append('user_1', face(11))
+    storage.add_conversation('user_1', [["You", "hi"], ["Bot", "hello"]])
+    return str(path)
+
+
+# user_storage/-style directory: one document per user with everything inline
+def legacy_directory(path):
+    path.mkdir()
+    (path / 'user_9.json').write_text(json.dumps({
+        'name': "Zoe",
+        'embedding': face(9).tolist(),
+        'image_base64': base64.b64encode(b"zoe-photo").decode('ascii'),
+        'conversations': [{'timestamp': "2024-01-01T10:00:00", 'messages': [["You", "hey"]]}],
+    }))
+    return str(path)
+
+
+def table_sizes(storage):
+    return {table: storage._query(f"SELECT COUNT(*) FROM {table}")[0][0]
+            for table in ('users', 'embeddings', 'images', 'conversations')}
+
+
+def test_import_is_idempotent(tmp_path):
+    directories = [split_directory(tmp_path / 'split'), legacy_directory(tmp_path / 'legacy')]
+    storage = SqliteUserStorage(str(tmp_path / 'db'))
+
+    assert import_json_directories(storage, directories) == {directories[0]: (2, 0, []), directories[1]: (1, 0, [])}
+    sizes = table_sizes(storage)
+    assert sizes == {'users': 3, 'embeddings': 4, 'images': 2, 'conversations': 2}
+
+    assert import_json_directories(storage, directories) == {directories[0]: (0, 2, []), directories[1]: (0, 1, [])}
+    assert table_sizes(storage) == sizes
+
+
+def test_imported_users_are_complete(tmp_path):
+    directories = [split_directory(tmp_path / 'split'), legacy_directory(tmp_path / 'legacy')]
+    storage = SqliteUserStorage(str(tmp_path / 'db'))
+    import_json_directories(storage, directories)
+
+    repository = UserRepository(storage)
+    assert repository.search(face(11))[0] == 'user_1'
+    assert repository.search(face(9))[0] == 'user_9'
+    assert repository.load_image('user_1') == b"ann-photo"
+    assert repository.load_image('user_9') == b"zoe-photo"
+    assert [conv['messages'] for conv in storage.load_conversations('user_9')] == [[["You", "hey"]]]
+    assert storage.find_user_by_name("ZOE")['user_id'] == 'user_9'
+
+
+def test_cli_reruns_skip_existing_users(tmp_path, capsys):
+    directory = split_directory(tmp_path / 'split')
+    sqlite_storage.main([directory, '--into', str(tmp_path / 'db')])
+    sqlite_storage.main([directory, '--into', str(tmp_path / 'db')])
+    assert capsys.readouterr().out.splitlines() == [
+        f"{directory}: 2 user(s) imported, 0 already present, 0 name conflict(s)",
+        f"{directory}: 0 user(s) imported, 2 already present, 0 name conflict(s)",
+    ]
+
+
+def test_same_person_in_several_directories_is_imported_once(tmp_path):
+    first = split_directory(tmp_path / 'first')
+    # The same people registered again, under the ids the older apps generated
+    second = tmp_path / 'second'
+    second.mkdir()
+    for user_id, name, seed in (('user_1_161127', "ann ", 1), ('user_3', "Cid", 3)):
+        (second / f'{user_id}.json').write_text(json.dumps({'name': name, 'embedding': face(seed).tolist()}))
+    storage = SqliteUserStorage(str(tmp_path / 'db'))
+
+    counts = import_json_directories(storage, [first, str(second)])
+
+    assert counts[str(second)] == (1, 0, [('user_1_161127', "ann ", 'user_1')])
+    assert sorted(storage.load_all_users()) == ['user_1', 'user_2', 'user_3']
+
+
+def snapshot(directory):
+    files = {}
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            with open(os.path.join(root, filename), 'rb') as f:
+                files[os.path.relpath(os.path.join(root, filename), directory)] = f.read()
+    return files
+
+
+def test_import_leaves_source_directories_untouched(tmp_path):
+    directory = split_directory(tmp_path / 'split')
+    # A crash left a torn embedding row and a torn journal line behind
+    with open(os.path.join(directory, 'embeddings', 'embeddings.f32'), 'ab') as f:
+        f.write(face(5).tobytes())
+    with open(os.path.join(directory, 'conversations', 'user_1.jsonl'), 'ab') as f:
+        f.write(b'{"timestamp": "2024')
+    before = snapshot(directory)
+
+    import_json_directories(SqliteUserStorage(str(tmp_path / 'db')), [directory])
+
+    assert snapshot(directory) == before
@@ -0,0 +1,92 @@
+import json
+import os
+import stat
+from atomic_file import write_atomic
+from user_manifest import MANIFEST_FILE
+from user_storage import JsonUserStorage
+
+
+def record(user_id, name):
+    return {'user_id': user_id, 'name': name, 'created_at': "2024-01-01T00:00:00"}
+
+
+def manifest_path(directory):
+    return os.path.join(directory, MANIFEST_FILE)
+
+
+def test_replay_after_torn_manifest_write(tmp_path):
+    storage = JsonUserStorage(str(tmp_path))
+    storage.write_users([record('user_1', "Ann"), record('user_2', "Bob")])
+    committed = open(manifest_path(tmp_path), 'rb').read()
+    # A crash halfway through appending the next entry
+    with open(manifest_path(tmp_path), 'ab') as f:
+        f.write(b'{"generation": 3, "user_id": "user_3", "vers')
+
+    reopened = JsonUserStorage(str(tmp_path))
+    assert sorted(reopened.load_all_users()) == ['user_1', 'user_2']
+    assert open(manifest_path(tmp_path), 'rb').read() == committed
+
+    reopened.write_user(record('user_3', "Carol"))
+    assert sorted(JsonUserStorage(str(tmp_path)).load_all_users()) == ['user_1', 'user_2', 'user_3']
+
+
+def test_committed_entry_is_materialized_after_crash(tmp_path):
+    storage = JsonUserStorage(str(tmp_path))
+    storage.write_user(record('user_1', "Ann"))
+    # Committed to the manifest, but the process died before replacing user_1.json
+    entry = {'generation': 2, 'user_id': 'user_1', 'version': 2, 'user': record('user_1', "Ann Smith")}
+    with open(manifest_path(tmp_path), 'ab') as f:
+        f.write((json.dumps(entry) + '\n').encode('utf-8'))
+
+    reopened = JsonUserStorage(str(tmp_path))
+    assert reopened.load_all_users()['user_1']['name'] == "Ann Smith"
+    assert reopened.load_user('user_1')['name'] == "Ann Smith"
+
+
+def test_startup_builds_manifest_from_existing_user_files(tmp_path):
+    for user_id, name in (('user_1', "Ann"), ('user_2', "Bob")):
+        (tmp_path / f'{user_id}.json').write_text(json.dumps(record(user_id, name)))
+    (tmp_path / 'user_3.json').write_text('{"user_id": "user_3", "na')
+    errors = []
+    users = JsonUserStorage(str(tmp_path)).load_all_users(on_error=lambda filename, e: errors.append(filename))
+    assert sorted(users) == ['user_1', 'user_2']
+    assert errors == ['user_3.json']
+    assert os.path.exists(manifest_path(tmp_path))
+
+
+def test_other_instances_see_committed_writes(tmp_path):
+    writer = JsonUserStorage(str(tmp_path))
+    reader = JsonUserStorage(str(tmp_path))
+    assert reader.load_all_users() == {}
+    writer.write_user(record('user_1', "Ann"))
+    assert reader.changed_users() == {'user_1': record('user_1', "Ann")}
+    assert reader.changed_users() == {}
+
+
+def test_compaction_keeps_latest_versions(tmp_path):
+    storage = JsonUserStorage(str(tmp_path))
+    for i in range(200):
+        storage.write_user(record('user_1', f"Ann {i}"))
+    storage.write_user(record('user_2', "Bob"))
+    with open(manifest_path(tmp_path), 'rb') as f:
+        assert len(f.readlines()) < 100
+    users = JsonUserStorage(str(tmp_path)).load_all_users()
+    assert users['user_1']['name'] == "Ann 199"
+    assert users['user_2']['name'] == "Bob"
+
+
+def test_write_atomic_keeps_permissions(tmp_path):
+    path = str(tmp_path / 'shared.json')
+    previous = os.umask(0o027)
+    try:
+        write_atomic(path, b'{}')
+    finally:
+        os.umask(previous)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+    os.chmod(path, 0o644)
+    write_atomic(path, b'{"a": 0}')
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+    os.chmod(path, 0o640)
+    write_atomic(path, b'{"a": 1}')
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+    assert sorted(os.listdir(tmp_path)) == ['shared.json']
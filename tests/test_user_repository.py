@@ -0,0 +1,136 @@
+import multiprocessing
+import numpy as np
+import pytest
+import embedding_index
+from user_storage import JsonUserStorage, UserExists
+from sqlite_storage import SqliteUserStorage
+from user_repository import UserRepository
+from conftest import face
+
+BACKENDS = {'json': JsonUserStorage, 'sqlite': SqliteUserStorage}
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def open_storage(request, tmp_path):
+    return lambda: BACKENDS[request.param](str(tmp_path))
+
+
+class Crash(Exception):
+    pass
+
+
+def crash(*args, **kwargs):
+    raise Crash()
+
+
+def test_crash_during_save_user_leaves_no_searchable_id(open_storage, monkeypatch):
+    repository = UserRepository(open_storage())
+    repository.insert('user_1', "Ann", face(1))
+
+    # The metadata write fails after (JSON) or inside the same transaction as (SQLite) the embedding
+    storage = repository.storage
+    monkeypatch.setattr(storage, 'write_user', crash)
+    monkeypatch.setattr(storage, '_put_user', crash, raising=False)
+    with pytest.raises(Crash):
+        repository.insert('user_2', "Bob", face(2))
+    monkeypatch.undo()
+
+    assert repository.search(face(2))[0] is None
+    assert 'user_2' not in repository
+
+    restarted = UserRepository(open_storage())
+    assert restarted.search(face(2))[0] is None
+    assert restarted.search(face(1))[0] == 'user_1'
+    assert len(restarted) == 1
+
+
+def test_embedding_becomes_searchable_once_its_record_is_committed(tmp_path):
+    writer = JsonUserStorage(str(tmp_path))
+    reader = UserRepository(JsonUserStorage(str(tmp_path)))
+
+    # A reader that catches save_user between its two steps
+    writer.embeddings.append('user_1', face(1))
+    assert reader.search(face(1))[0] is None
+
+    writer.write_user({'user_id': 'user_1', 'name': "Ann", 'created_at': "2024-01-01T00:00:00"})
+    assert reader.search(face(1))[0] == 'user_1'
+    assert reader.get('user_1')['name'] == "Ann"
+
+
+# Run in a separate process, like a second Streamlit server on the same storage
+def register_in_other_process(backend, directory, user_id, name, seed):
+    UserRepository(BACKENDS[backend](directory)).insert(user_id, name, face(seed))
+
+
+def visit_in_other_process(backend, directory, user_id, embedding):
+    assert UserRepository(BACKENDS[backend](directory)).record_visit(user_id, embedding)
+
+
+def run_in_other_process(target, *args):
+    process = multiprocessing.get_context('spawn').Process(target=target, args=args)
+    process.start()
+    process.join(60)
+    assert process.exitcode == 0
+
+
+@pytest.mark.parametrize('backend', sorted(BACKENDS))
+def test_refresh_picks_up_registrations_from_other_processes(backend, tmp_path):
+    repository = UserRepository(BACKENDS[backend](str(tmp_path)))
+    repository.insert('user_1', "Ann", face(1))
+
+    run_in_other_process(register_in_other_process, backend, str(tmp_path), 'user_2', "Bob", 2)
+
+    assert repository.search(face(2))[0] == 'user_2'
+    assert repository.name_taken("bob")
+    assert repository.get('user_2')['name'] == "Bob"
+
+
+@pytest.mark.parametrize('backend', sorted(BACKENDS))
+def test_refresh_picks_up_template_samples_from_other_processes(backend, tmp_path):
+    repository = UserRepository(BACKENDS[backend](str(tmp_path)))
+    repository.insert('user_1', "Ann", face(1))
+    # Another photo of Ann, 0.4 from the registered one; a query beyond it is too far from the original
+    direction = np.random.default_rng(7).standard_normal(128).astype(np.float32)
+    direction /= np.linalg.norm(direction)
+    new_photo = face(1) + 0.4 * direction
+    query = face(1) + 0.65 * direction
+    assert repository.search(query)[0] is None
+
+    run_in_other_process(visit_in_other_process, backend, str(tmp_path), 'user_1', new_photo)
+
+    assert repository.search(query)[0] == 'user_1'
+    assert len(repository.index.samples('user_1')) == 2
+
+
+def test_next_user_id_is_unique(open_storage):
+    repository = UserRepository(open_storage())
+    assert len({repository.next_user_id() for _ in range(1000)}) == 1000
+
+
+def test_save_user_refuses_an_existing_id(open_storage):
+    repository = UserRepository(open_storage())
+    repository.insert('user_1', "Ann", face(1))
+
+    with pytest.raises(UserExists):
+        repository.storage.save_user('user_1', "Bob", face(2))
+
+    restarted = UserRepository(open_storage())
+    assert restarted.get('user_1')['name'] == "Ann"
+    assert restarted.search(face(1))[0] == 'user_1'
+    assert restarted.search(face(2))[0] is None
+    assert len(restarted) == 1
+
+
+def test_load_does_not_copy_the_embedding_matrix(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_index, 'INDEX_BACKEND', 'flat')
+    storage = JsonUserStorage(str(tmp_path))
+    for i in range(3):
+        storage.save_user(f'user_{i}', f"Patient {i}", face(i))
+    repository = UserRepository(JsonUserStorage(str(tmp_path)))
+    assert np.shares_memory(repository.index.matrix, repository.storage.embeddings.matrix)
+
+    # With an orphan row (crashed registration) only the committed rows are indexed
+    storage.embeddings.append('user_x', face(9))
+    repository = UserRepository(JsonUserStorage(str(tmp_path)))
+    assert len(repository.index) == 3
+    assert repository.search(face(9))[0] is None
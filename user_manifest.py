@@ -0,0 +1,205 @@
+# user_manifest.py
+# Write-ahead manifest of the user metadata records in a JsonUserStorage directory
+
+import os
+import json
+import threading
+from atomic_file import write_atomic, locked
+
+MANIFEST_FILE = "manifest.jsonl"
+# Rewrite the manifest once it holds this many entries per live user (plus some slack)
+COMPACT_RATIO = 4
+COMPACT_SLACK = 64
+
+
+def _encode(entries):
+    return b''.join((json.dumps(entry, ensure_ascii=False) + '\n').encode('utf-8') for entry in entries)
+
+
+# manifest.jsonl is an append-only log with one JSON entry per committed write:
+#   {"generation": 17, "user_id": "user_3_101502", "version": 2, "user": {...metadata record...}}
+# `generation` counts writes across the whole directory, `version` writes of one user.
+# A write is committed once its line is complete and fsynced; only then is <user_id>.json
+# replaced (atomically) from it. Startup replays the manifest instead of listing and parsing
+# every user file. Writers hold an exclusive lock and re-materialise the previous last entry
+# before appending, so a crash between the two steps is repaired by the next writer or open.
+class UserManifest:
+    def __init__(self, directory, materialize):
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST_FILE)
+        # Called with a committed record to bring its user file up to date
+        self.materialize = materialize
+        self.generation = 0
+        self.opened = False
+        self._entries = {}       # user_id -> latest entry
+        self._n_entries = 0      # lines in the file, for compaction
+        self._last = None
+        self._offset = 0
+        self._inode = None
+        self._changed = set()
+        self._state = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user_id):
+        return user_id in self._entries
+
+    # Latest committed metadata record of a user (None if unknown)
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        return entry['user'] if entry else None
+
+    def version(self, user_id):
+        entry = self._entries.get(user_id)
+        return entry['version'] if entry else 0
+
+    # Open the manifest, creating it from `scan()` ({user_id: record}, the existing user files)
+    # the first time a directory is used. Safe to call repeatedly.
+    def open(self, scan):
+        if self.opened:
+            return
+        with locked(self.path), self._state:
+            if not os.path.exists(self.path):
+                users = scan()
+                entries = [
+                    {'generation': i + 1, 'user_id': user_id, 'version': 1, 'user': user_data}
+                    for i, (user_id, user_data) in enumerate(users.items())
+                ]
+                write_atomic(self.path, _encode(entries))
+            self._trim_torn_tail()
+            self._reload()
+            self._materialize_last()
+            self.opened = True
+
+    # Drop a partial last line left by a crash mid-append
+    def _trim_torn_tail(self):
+        with open(self.path, 'rb+') as f:
+            size = f.seek(0, os.SEEK_END)
+            if not size:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return
+            f.seek(0)
+            data = f.read()
+            f.truncate(data.rfind(b'\n') + 1)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _materialize_last(self):
+        if self._last is not None:
+            self.materialize(self._last['user'])
+
+    # Apply entries appended since the last read; start over if the file was replaced (compaction)
+    def _reload(self):
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self._inode or stat.st_size < self._offset:
+                self._changed.update(self._entries)
+                self._entries = {}
+                self._n_entries = self._offset = self.generation = 0
+                self._last = None
+                self._inode = stat.st_ino
+            if stat.st_size == self._offset:
+                return
+            f.seek(self._offset)
+            data = f.read()
+        committed = data.rfind(b'\n') + 1
+        for line in data[:committed].splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            self._entries[entry['user_id']] = entry
+            self._changed.add(entry['user_id'])
+            self._last = entry
+            self._n_entries += 1
+            self.generation = max(self.generation, entry['generation'])
+        self._offset += committed
+
+    # Pick up writes committed by other processes: one stat() when nothing changed
+    def refresh(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        with self._state:
+            if stat.st_ino == self._inode and stat.st_size == self._offset:
+                return False
+            self._reload()
+            return True
+
+    # {user_id: copy of the record} of every user
+    def snapshot(self):
+        with self._state:
+            self._changed.clear()
+            return {user_id: dict(entry['user']) for user_id, entry in self._entries.items()}
+
+    # Ids written (by anyone) since the last snapshot() / take_changes()
+    def take_changes(self):
+        with self._state:
+            changed, self._changed = self._changed, set()
+        return changed
+
+    # Durably commit new versions of some user records and update their files.
+    # Returns the generation of the last one.
+    def commit(self, records):
+        with locked(self.path), self._state:
+            self._trim_torn_tail()
+            self._reload()
+            self._materialize_last()
+            entries = []
+            versions = {}
+            for i, user_data in enumerate(records):
+                user_id = user_data['user_id']
+                versions[user_id] = versions.get(user_id, self.version(user_id)) + 1
+                entries.append({
+                    'generation': self.generation + i + 1,
+                    'user_id': user_id,
+                    'version': versions[user_id],
+                    'user': user_data,
+                })
+            if not entries:
+                return self.generation
+            with open(self.path, 'ab') as f:
+                f.write(_encode(entries))
+                f.flush()
+                os.fsync(f.fileno())
+            self._reload()
+            for user_data in records:
+                self.materialize(user_data)
+            if self._n_entries > COMPACT_RATIO * len(self._entries) + COMPACT_SLACK:
+                self._rewrite(sorted(self._entries.values(), key=lambda entry: entry['generation']))
+            return self.generation
+
+    # Replace the log by one entry per user (latest versions only)
+    def compact(self):
+        with locked(self.path), self._state:
+            self._reload()
+            self._rewrite(sorted(self._entries.values(), key=lambda entry: entry['generation']))
+
+    # Re-create the manifest from `scan()` after the user files were edited offline.
+    # Every user gets a new version and generation so other processes notice the change.
+    def rebuild(self, scan):
+        with locked(self.path), self._state:
+            self._reload()
+            entries = []
+            for i, (user_id, user_data) in enumerate(scan().items()):
+                entries.append({
+                    'generation': self.generation + i + 1,
+                    'user_id': user_id,
+                    'version': self.version(user_id) + 1,
+                    'user': user_data,
+                })
+            self._rewrite(entries)
+            self.opened = True
+
+    def _rewrite(self, entries):
+        write_atomic(self.path, _encode(entries))
+        self._inode = None  # force a full re-read of the new file
+        self._reload()
@@ -0,0 +1,175 @@
+# user_repository.py
+# Write-through, incrementally updated in-memory view of the user storage
+
+import uuid
+import threading
+from types import MappingProxyType
+from embedding_index import build_index, MATCH_THRESHOLD
+from name_index import NameIndex
+
+
+# Keeps every user's metadata and an embedding index in memory on top of a storage backend
+# (see storage_backends.py). Writes go to storage first and then patch the cache in place, so one
+# registration costs O(1) instead of reloading every user. Changes made by other processes are
+# noticed through the storage's changed_users() (manifest tail, or change sequence in SQLite)
+# and merged incrementally.
+class UserRepository:
+    def __init__(self, storage, on_error=None):
+        self.storage = storage
+        self.on_error = on_error
+        self._lock = threading.RLock()
+        self._users = {}
+        self.index = None
+        self.names = None
+        self._rows_seen = 0
+        # Embedding rows whose user has no committed metadata yet: {user_id: [row, ...]}
+        self._orphan_rows = {}
+        self._load()
+
+    def _load(self):
+        with self._lock:
+            self._users = self.storage.load_all_users(on_error=self.on_error)
+            self.storage.migrate_legacy_users(self._users)
+            self.names = NameIndex.from_users(self._users)
+            store = self.storage.embeddings
+            store.refresh()
+            self._orphan_rows = {}
+            keep = []
+            for row, user_id in enumerate(store.ids):
+                if user_id in self._users:
+                    keep.append(row)
+                else:
+                    self._orphan_rows.setdefault(user_id, []).append(row)
+            if len(keep) == len(store):
+                # The usual case: hand the store's matrix (a memory map) over without copying it
+                self.index = build_index(store.ids, store.matrix)
+            else:
+                self.index = build_index([store.ids[row] for row in keep], store.matrix[keep])
+            self._rows_seen = len(store)
+
+    # Replace (or with None, drop) a user's cached record, keeping the name index in step
+    def _put(self, user_id, user_data):
+        old = self._users.get(user_id)
+        if old is not None and (user_data is None or old['name'] != user_data['name']):
+            self.names.remove(user_id, old['name'])
+        if user_data is None:
+            self._users.pop(user_id, None)
+            return
+        if old is None or old['name'] != user_data['name']:
+            self.names.add(user_id, user_data['name'])
+        self._users[user_id] = user_data
+        # Rows written before the record was committed (by another process) become searchable now
+        for row in self._orphan_rows.pop(user_id, ()):
+            self.index.add(user_id, self.storage.embeddings.matrix[row])
+
+    # Index any embedding rows appended since the last sync. Rows are only searchable once their
+    # user's metadata is committed: save_user writes the embedding first, so a crash in between
+    # (or a reader catching the write halfway) must not let search() return an unknown id.
+    def _sync_index(self):
+        store = self.storage.embeddings
+        store.refresh()
+        for row in range(self._rows_seen, len(store)):
+            user_id = store.ids[row]
+            if user_id in self._users:
+                self.index.add(user_id, store.matrix[row])
+            else:
+                self._orphan_rows.setdefault(user_id, []).append(row)
+        self._rows_seen = len(store)
+
+    # Cheap external-change check: a stat() of the JSON manifest and embedding ids (or one indexed
+    # query each in SQLite). Only the users and embedding rows written since the last check are
+    # read; rows appended on their own (template samples from record_visit) count as changes too.
+    def refresh(self):
+        with self._lock:
+            changed = self.storage.changed_users()
+            store = self.storage.embeddings
+            store.refresh()
+            if not changed and len(store) == self._rows_seen:
+                return False
+            for user_id, user_data in changed.items():
+                self._put(user_id, user_data)
+            self._sync_index()
+            return True
+
+    # Drop everything and reload from storage (e.g. after offline maintenance of the directory)
+    def reload(self):
+        with self._lock:
+            self.storage.rescan(on_error=self.on_error)
+            self._load()
+
+    # Read-only live view of the users ({user_id: metadata}). The repository may be shared
+    # between sessions, so callers get lookups only; iteration goes through methods that hold the lock.
+    def all(self):
+        self.refresh()
+        return MappingProxyType(self._users)
+
+    def get(self, user_id):
+        return self.all().get(user_id)
+
+    def __contains__(self, user_id):
+        return user_id in self._users
+
+    def __len__(self):
+        return len(self._users)
+
+    # Whether a name is already registered, ignoring case, Unicode form and extra spaces
+    # (one lookup in the name index)
+    def name_taken(self, name):
+        with self._lock:
+            self.refresh()
+            return name in self.names
+
+    # Users whose name starts with `prefix` (staff lookup), in name order
+    def search_names(self, prefix, limit=20):
+        with self._lock:
+            self.refresh()
+            return [self._users[user_id] for user_id in self.names.search_prefix(prefix, limit)]
+
+    # Id for the next registration. Random, so processes sharing the storage never hand out the
+    # same id (user_<n>_<HHMMSS> collided when two of them registered in the same second).
+    def next_user_id(self):
+        return f"user_{uuid.uuid4().hex}"
+
+    # Register a new user: write to storage, then update the cache and index in place
+    def insert(self, user_id, name, embedding, image_bytes=None):
+        with self._lock:
+            self.refresh()
+            user_data = self.storage.save_user(user_id, name, embedding, image_bytes)
+            self._put(user_id, user_data)
+            self._sync_index()
+            return user_data
+
+    # Update some metadata fields of an existing user (write-through)
+    def update(self, user_id, **fields):
+        with self._lock:
+            user_data = dict(self._users[user_id], **fields)
+            self.storage.write_user(user_data)
+            self._put(user_id, user_data)
+            return user_data
+
+    # Best match for a face embedding: (user_id, distance), user_id None when nobody is close enough
+    def search(self, embedding, threshold=MATCH_THRESHOLD):
+        with self._lock:
+            self.refresh()
+            return self.index.search(embedding, threshold=threshold)
+
+    # Keep a recognised face as another template sample for the user when the index wants it
+    # (confidently the same person, but different enough from the samples already kept)
+    def record_visit(self, user_id, embedding):
+        with self._lock:
+            self.refresh()
+            wants_sample = getattr(self.index, 'wants_sample', None)
+            if wants_sample is None or not wants_sample(user_id, embedding):
+                return False
+            self.storage.embeddings.append(user_id, embedding)
+            self._sync_index()
+            return True
+
+    def load_image(self, user_id):
+        return self.storage.load_image(self._users[user_id])
+
+    def add_conversation(self, user_id, messages):
+        return self.storage.add_conversation(user_id, messages)
+
+    def load_recent_conversations(self, user_id, limit):
+        return self.storage.load_recent_conversations(user_id, limit)
@@ -0,0 +1,207 @@
+# user_storage.py
+# JSON-directory user storage, split into small metadata records, a content-addressed
+# image store, per-user conversation files and the binary embedding store.
+#
+#   <storage_dir>/manifest.jsonl                 write-ahead log of the metadata records (see user_manifest.py)
+#   <storage_dir>/<user_id>.json                 name, created_at, image_hash
+#   <storage_dir>/images/<sha256>                raw profile image bytes
+#   <storage_dir>/conversations/<user_id>.jsonl  append-only conversation journal
+#   <storage_dir>/embeddings/                    see embedding_store.py
+#
+# Metadata and images are replaced atomically (temp file + fsync + rename), so a crash
+# never leaves a truncated file behind.
+
+import os
+import json
+import base64
+import hashlib
+from datetime import datetime
+from embedding_store import EmbeddingStore
+from conversation_log import ConversationLog
+from user_manifest import UserManifest
+from name_index import normalize_name
+from atomic_file import write_atomic, write_json_atomic, locked
+
+# Keys that older, single-document user files carried inline
+LEGACY_KEYS = ('embedding', 'image_base64', 'conversations')
+
+
+# save_user() was given an id that is already registered
+class UserExists(ValueError):
+    pass
+
+
+class JsonUserStorage:
+    def __init__(self, storage_dir):
+        self.storage_dir = storage_dir
+        self.images_dir = os.path.join(storage_dir, "images")
+        self.conversations_dir = os.path.join(storage_dir, "conversations")
+        for directory in (storage_dir, self.images_dir, self.conversations_dir):
+            os.makedirs(directory, exist_ok=True)
+        self.embeddings = EmbeddingStore(os.path.join(storage_dir, "embeddings"))
+        self.conversations = ConversationLog(self.conversations_dir)
+        self.manifest = UserManifest(storage_dir, self._materialize)
+
+    def _user_path(self, user_id):
+        return os.path.join(self.storage_dir, f'{user_id}.json')
+
+    # The first use of a directory builds the manifest from the user files already in it
+    def _open_manifest(self, on_error=None):
+        self.manifest.open(lambda: self._scan_user_files(on_error))
+
+    # Bring a user file up to date with its committed record
+    def _materialize(self, user_data):
+        if self.load_user(user_data['user_id']) != user_data:
+            write_json_atomic(self._user_path(user_data['user_id']), user_data)
+
+    # Commit a user's metadata record to the manifest, then replace their JSON file
+    def write_user(self, user_data):
+        self.write_users([user_data])
+
+    # Commit many records with a single manifest fsync (migrations, bulk imports)
+    def write_users(self, records):
+        self._open_manifest()
+        self.manifest.commit(records)
+
+    # Load one user's metadata record (None if missing or unreadable)
+    def load_user(self, user_id, on_error=None):
+        try:
+            with open(self._user_path(user_id), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError as e:
+            if on_error:
+                on_error(f'{user_id}.json', e)
+            return None
+
+    # Load the metadata record of every user (no images, no conversations), replayed from the manifest
+    def load_all_users(self, on_error=None):
+        self._open_manifest(on_error)
+        self.manifest.refresh()
+        return self.manifest.snapshot()
+
+    # Users written by any process since the last call: {user_id: record, or None if removed}
+    def changed_users(self):
+        self._open_manifest()
+        self.manifest.refresh()
+        return {user_id: self.manifest.get(user_id) for user_id in self.manifest.take_changes()}
+
+    # Re-create the manifest from the user files (after editing the directory by hand)
+    def rescan(self, on_error=None):
+        self.manifest.rebuild(lambda: self._scan_user_files(on_error))
+
+    # Lookup by normalised name (see name_index.normalize_name); None if nobody has it.
+    # Scans the manifest; UserRepository keeps an index for the hot path.
+    def find_user_by_name(self, name):
+        self._open_manifest()
+        self.manifest.refresh()
+        key = normalize_name(name)
+        for user_data in self.manifest.snapshot().values():
+            if normalize_name(user_data['name']) == key:
+                return user_data
+        return None
+
+    # Parse every <user_id>.json in the directory
+    def _scan_user_files(self, on_error=None):
+        users = {}
+        for filename in os.listdir(self.storage_dir):
+            if filename.endswith('.json'):
+                user_id = filename[:-5]  # Remove .json extension
+                user_data = self.load_user(user_id, on_error=on_error)
+                if user_data is not None:
+                    users[user_id] = user_data
+        return users
+
+    # Save a new user: embedding to the binary store, image to the image store, metadata to JSON.
+    # Registrations are serialised across processes, and an id that is already committed is
+    # refused (UserExists) before anything is written, so one person can't overwrite another.
+    def save_user(self, user_id, name, embedding, image_bytes=None):
+        with locked(os.path.join(self.storage_dir, 'register')):
+            self._open_manifest()
+            self.manifest.refresh()
+            if user_id in self.manifest:
+                raise UserExists(f"User id {user_id} is already registered")
+            self.embeddings.append(user_id, embedding)
+            user_data = {
+                'user_id': user_id,
+                'name': name,
+                'created_at': datetime.now().isoformat(),
+            }
+            if image_bytes:
+                user_data['image_hash'] = self.save_image(image_bytes)
+            self.write_user(user_data)
+            return user_data
+
+    # Store image bytes under their SHA-256; identical images are written once
+    def save_image(self, image_bytes):
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
+        path = os.path.join(self.images_dir, image_hash)
+        if not os.path.exists(path):
+            write_atomic(path, image_bytes)
+        return image_hash
+
+    # Read a user's profile image bytes on demand (None if they have none)
+    def load_image(self, user_data):
+        image_hash = user_data.get('image_hash')
+        if not image_hash:
+            return None
+        path = os.path.join(self.images_dir, image_hash)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    # Read one user's conversation history on demand, oldest first
+    def load_conversations(self, user_id):
+        return self.conversations.read_all(user_id)
+
+    # The user's newest `limit` conversations, oldest first, read from the end of the journal
+    def load_recent_conversations(self, user_id, limit):
+        return self.conversations.read_latest(user_id, limit)
+
+    # One page of the user's conversations, newest first, and whether older ones exist
+    def load_conversation_page(self, user_id, page, page_size):
+        start = page * page_size
+        newest_first = self.load_recent_conversations(user_id, start + page_size + 1)[::-1]
+        return newest_first[start:start + page_size], len(newest_first) > start + page_size
+
+    # Seed a user's history from existing records, unless they already have one (imports)
+    def import_conversations(self, user_id, records):
+        self.conversations.import_records(user_id, records)
+
+    # Add conversation to user's history (a single fsynced append)
+    def add_conversation(self, user_id, messages):
+        if not os.path.exists(self._user_path(user_id)):
+            return False
+        self.conversations.append(user_id, {
+            'timestamp': datetime.now().isoformat(),
+            'messages': messages
+        })
+        return True
+
+    # Split older single-document user files (inline embedding, base64 image, conversations)
+    # into the new layout. Returns the ids that were migrated.
+    def migrate_legacy_users(self, users_db):
+        migrated = []
+        records = []
+        for user_id, user_data in users_db.items():
+            if not any(key in user_data for key in LEGACY_KEYS):
+                continue
+            embedding = user_data.pop('embedding', None)
+            if embedding is not None and user_id not in self.embeddings:
+                self.embeddings.append(user_id, embedding)
+            image_base64 = user_data.pop('image_base64', None)
+            if image_base64:
+                user_data['image_hash'] = self.save_image(base64.b64decode(image_base64))
+            conversations = user_data.pop('conversations', None)
+            if conversations:
+                self.conversations.import_records(user_id, conversations)
+            user_data.setdefault('user_id', user_id)
+            records.append(user_data)
+            migrated.append(user_id)
+        if records:
+            self.write_users(records)
+            # Drop the manifest entries that still carry the inline data
+            self.manifest.compact()
+        return migrated